@@ -0,0 +1,155 @@
+"""
+Admission control and statement timeouts of the API requests.
+
+At most EXPENSIVE_QUERY_CONCURRENCY expensive requests, as classified by
+the views, run at once on a host, across the worker processes: each holds
+an exclusive lock on one of as many slot files in ADMISSION_DIR. At most
+EXPENSIVE_QUERY_QUEUE_SIZE others, each holding a lock on a queue file,
+wait up to EXPENSIVE_QUERY_QUEUE_TIMEOUT seconds for a slot. The others,
+and those still waiting then, are shed: answered at once with a 503 and a
+Retry-After of ADMISSION_RETRY_AFTER seconds. The locks of a worker that
+dies are released with its files.
+
+The queries of each endpoint run under the statement_timeout of
+API_STATEMENT_TIMEOUTS, a request exceeding it is answered with a 503 too.
+Shed and timed out requests are counted in the /metrics.
+"""
+
+import asyncio
+import fcntl
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+from . import metrics
+from .exceptions import ServiceOverloadedError
+
+# Seconds between two attempts of a queued request to take a slot.
+POLL_INTERVAL = 0.01
+# SQLSTATE of a statement cancelled by statement_timeout.
+QUERY_CANCELED = "57014"
+
+
+def _lock_free_file(kind, count):
+    """
+    An open file of the count kind files locked by the caller, None if the
+    others hold them all.
+    """
+    directory = settings.ADMISSION_DIR
+    os.makedirs(directory, exist_ok=True)
+    for number in range(count):
+        file = open(os.path.join(directory, f"{kind}-{number}.lock"), "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            continue
+        return file
+    return None
+
+
+def _shed(route, reason):
+    """ServiceOverloadedError of a shed request, counted."""
+    metrics.increment(metrics.REQUESTS_SHED, route, reason)
+    return ServiceOverloadedError(
+        "Too many expensive requests, retry later", settings.ADMISSION_RETRY_AFTER
+    )
+
+
+def _queue(route):
+    """Lock of a queue file, raises ServiceOverloadedError if none is free."""
+    queued = _lock_free_file("queue", settings.EXPENSIVE_QUERY_QUEUE_SIZE)
+    if queued is None:
+        raise _shed(route, "queue_full")
+    return queued
+
+
+@contextmanager
+def admitted(route):
+    """
+    Runs the block of an expensive request in a slot, once one is free.
+    Raises ServiceOverloadedError if the request is shed.
+    """
+    if not settings.EXPENSIVE_QUERY_CONCURRENCY:
+        yield
+        return
+    slot = _lock_free_file("slot", settings.EXPENSIVE_QUERY_CONCURRENCY)
+    if slot is None:
+        with _queue(route):
+            deadline = time.monotonic() + settings.EXPENSIVE_QUERY_QUEUE_TIMEOUT
+            while slot is None:
+                if time.monotonic() >= deadline:
+                    raise _shed(route, "queue_timeout")
+                time.sleep(POLL_INTERVAL)
+                slot = _lock_free_file("slot", settings.EXPENSIVE_QUERY_CONCURRENCY)
+    with slot:
+        yield
+
+
+@asynccontextmanager
+async def admitted_async(route):
+    """admitted() waiting for a slot without blocking the event loop."""
+    if not settings.EXPENSIVE_QUERY_CONCURRENCY:
+        yield
+        return
+    slot = _lock_free_file("slot", settings.EXPENSIVE_QUERY_CONCURRENCY)
+    if slot is None:
+        with _queue(route):
+            deadline = time.monotonic() + settings.EXPENSIVE_QUERY_QUEUE_TIMEOUT
+            while slot is None:
+                if time.monotonic() >= deadline:
+                    raise _shed(route, "queue_timeout")
+                await asyncio.sleep(POLL_INTERVAL)
+                slot = _lock_free_file("slot", settings.EXPENSIVE_QUERY_CONCURRENCY)
+    with slot:
+        yield
+
+
+def statement_timeout_ms(endpoint):
+    """Statement timeout of the endpoint in milliseconds, 0 for none."""
+    return settings.API_STATEMENT_TIMEOUTS.get(endpoint, 0)
+
+
+@contextmanager
+def statement_timeout(alias, milliseconds):
+    """
+    Runs the queries of the block on the alias database under the timeout.
+    Set on the driver's connection, so that the query counts and timings of
+    the request are left as they are.
+    """
+    if not milliseconds:
+        yield
+        return
+    wrapper = connections[alias]
+    wrapper.ensure_connection()
+    with wrapper.connection.cursor() as cursor:
+        cursor.execute("SET statement_timeout = %s", [milliseconds])
+    try:
+        yield
+    finally:
+        # Pooled connections are handed to other requests as they are.
+        try:
+            with wrapper.wrap_database_errors:
+                if wrapper.connection is not None:
+                    with wrapper.connection.cursor() as cursor:
+                        cursor.execute("RESET statement_timeout")
+        except DatabaseError:
+            # Closed, or in a failed transaction rolled back anyway.
+            pass
+
+
+def is_statement_timeout(error):
+    """Whether the database error is a query cancelled by its timeout."""
+    cause = error.__cause__ if isinstance(error, DatabaseError) else None
+    return getattr(cause, "pgcode", None) == QUERY_CANCELED
+
+
+def timed_out(route):
+    """ServiceOverloadedError of a request whose query timed out, counted."""
+    metrics.increment(metrics.REQUESTS_TIMED_OUT, route)
+    return ServiceOverloadedError(
+        "The query took too long, retry later", settings.ADMISSION_RETRY_AFTER
+    )
@@ -22,10 +22,43 @@ class IllegalDateError(Exception):
         return f"{self.date_str} -> {self.message}"
 
 
+class IllegalFilterError(Exception):
+    """Exception raised for query parameters which cannot be combined.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ServiceOverloadedError(Exception):
+    """Exception raised for requests shed or timed out under load.
+
+    Attributes:
+        message -- explanation of the error
+        retry_after -- seconds after which the request may be retried
+    """
+
+    def __init__(self, message, retry_after):
+        self.message = message
+        self.retry_after = retry_after
+        super().__init__(self.message)
+
+
 def custom_exception_handler(exc, context):
     response = exception_handler(exc, context)
 
-    if isinstance(exc, IllegalDateError):
+    if isinstance(exc, (IllegalDateError, IllegalFilterError)):
         return Response({"error": exc.message}, status=status.HTTP_400_BAD_REQUEST)
 
+    if isinstance(exc, ServiceOverloadedError):
+        return Response(
+            {"error": exc.message},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(exc.retry_after)},
+        )
+
     return response
@@ -0,0 +1,313 @@
+"""
+Request metrics in the Prometheus text format, served at /metrics.
+
+Each process aggregates the timings of its requests (see common.timing)
+into histograms, counts its shed and timed out requests (see
+common.admission) and its database pool checkouts, waits and timeouts (see
+common.postgresql_pool) and writes them to <METRICS_DIR>/<pid>.json at most
+every METRICS_FLUSH_INTERVAL seconds, so that whichever gunicorn worker answers
+/metrics reports the sum over all the workers. Without METRICS_DIR each
+process reports its own requests only. The files of exited workers are
+kept, their counts stay in the totals until the directory is cleared at
+server start (see gunicorn.conf.py).
+"""
+
+import bisect
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Prefix of the metric names.
+NAMESPACE = "pricepaid"
+
+
+class Histogram:
+    """Cumulative histogram per label values, only ever observed."""
+
+    def __init__(self, name, documentation, labels, buckets):
+        self.name = f"{NAMESPACE}_{name}"
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # {label values: [count per bucket..., count above them, sum]}
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = [0] * (len(self.buckets) + 1) + [0.0]
+            self.series[label_values] = series
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self, series):
+        """Exposition lines of the histogram with the given series."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, values in sorted(series.items()):
+            labels = ",".join(
+                f'{label}="{_escape(value)}"'
+                for label, value in zip(self.labels, label_values)
+            )
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+                )
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+class Counter:
+    """Count per label values, only ever incremented."""
+
+    def __init__(self, name, documentation, labels):
+        self.name = f"{NAMESPACE}_{name}"
+        self.documentation = documentation
+        self.labels = labels
+        # {label values: [count]}
+        self.series = {}
+
+    def increment(self, *label_values):
+        self.series.setdefault(label_values, [0])[0] += 1
+
+    def render(self, series):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for label_values, values in sorted(series.items()):
+            labels = ",".join(
+                f'{label}="{_escape(value)}"'
+                for label, value in zip(self.labels, label_values)
+            )
+            lines.append(f"{self.name}{{{labels}}} {values[0]}")
+        return lines
+
+
+def _escape(value):
+    value = str(value).replace("\\", r"\\")
+    return value.replace('"', r"\"").replace("\n", r"\n")
+
+
+REQUEST_DURATION = Histogram(
+    "request_duration_seconds",
+    "Time to answer a request.",
+    ("route", "status"),
+    LATENCY_BUCKETS,
+)
+REQUEST_QUERIES = Histogram(
+    "request_db_queries",
+    "SQL queries run by a request.",
+    ("route",),
+    QUERY_COUNT_BUCKETS,
+)
+REQUEST_DB_DURATION = Histogram(
+    "request_db_duration_seconds",
+    "Time a request spent in SQL queries.",
+    ("route",),
+    LATENCY_BUCKETS,
+)
+REQUEST_PHASE_DURATION = Histogram(
+    "request_phase_duration_seconds",
+    "Time a request spent in a named phase, queries included.",
+    ("route", "phase"),
+    LATENCY_BUCKETS,
+)
+REQUESTS_SHED = Counter(
+    "requests_shed_total",
+    "Requests answered with a 503 without being served, as the queue of "
+    "their endpoint was full or their wait in it timed out.",
+    ("route", "reason"),
+)
+REQUESTS_TIMED_OUT = Counter(
+    "requests_timed_out_total",
+    "Requests answered with a 503 as a query exceeded the statement timeout "
+    "of their endpoint.",
+    ("route",),
+)
+DB_POOL_CHECKOUTS = Counter(
+    "db_pool_checkouts_total",
+    "Connections handed out by the database pool.",
+    ("pool",),
+)
+DB_POOL_CONNECTS = Counter(
+    "db_pool_connects_total",
+    "Connections opened by the database pool.",
+    ("pool",),
+)
+DB_POOL_DISCARDED = Counter(
+    "db_pool_discarded_total",
+    "Broken, expired or idle connections closed by the database pool.",
+    ("pool",),
+)
+DB_POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts_total",
+    "Checkouts which found no connection freed up within the pool timeout.",
+    ("pool",),
+)
+DB_POOL_WAIT = Histogram(
+    "db_pool_wait_seconds",
+    "Time a checkout which found every connection in use waited for one.",
+    ("pool",),
+    LATENCY_BUCKETS,
+)
+METRICS = {
+    metric.name: metric
+    for metric in [
+        REQUEST_DURATION,
+        REQUEST_QUERIES,
+        REQUEST_DB_DURATION,
+        REQUEST_PHASE_DURATION,
+        REQUESTS_SHED,
+        REQUESTS_TIMED_OUT,
+        DB_POOL_CHECKOUTS,
+        DB_POOL_CONNECTS,
+        DB_POOL_DISCARDED,
+        DB_POOL_TIMEOUTS,
+        DB_POOL_WAIT,
+    ]
+}
+_lock = threading.Lock()
+_pid = os.getpid()
+_flushed_at = 0.0
+
+
+def _reset_after_fork():
+    global _pid
+    if os.getpid() != _pid:
+        _pid = os.getpid()
+        for metric in METRICS.values():
+            metric.series = {}
+
+
+def route_of(request):
+    """Route label of the request, "unmatched" if it matched no URL."""
+    match = request.resolver_match
+    return match.route if match is not None else "unmatched"
+
+
+def observe_request(route, status, timings, total):
+    """Aggregates the timings of a finished request."""
+    with _lock:
+        _reset_after_fork()
+        REQUEST_DURATION.observe(total, route, str(status))
+        REQUEST_QUERIES.observe(timings.queries, route)
+        REQUEST_DB_DURATION.observe(timings.db_seconds, route)
+        for phase, seconds in timings.phases.items():
+            REQUEST_PHASE_DURATION.observe(seconds, route, phase)
+    _flush_if_due()
+
+
+def observe(histogram, value, *label_values):
+    with _lock:
+        _reset_after_fork()
+        histogram.observe(value, *label_values)
+    _flush_if_due()
+
+
+def increment(counter, *label_values):
+    with _lock:
+        _reset_after_fork()
+        counter.increment(*label_values)
+    _flush_if_due()
+
+
+def _flush_if_due():
+    if time.monotonic() - _flushed_at >= settings.METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def _snapshot():
+    with _lock:
+        _reset_after_fork()
+        return {
+            name: [[list(labels), list(values)] for labels, values in h.series.items()]
+            for name, h in METRICS.items()
+        }
+
+
+def flush():
+    """Writes the histograms of the process to METRICS_DIR."""
+    global _flushed_at
+    _flushed_at = time.monotonic()
+    directory = settings.METRICS_DIR
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    descriptor, path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(descriptor, "w") as file:
+        json.dump(_snapshot(), file)
+    os.replace(path, os.path.join(directory, f"{os.getpid()}.json"))
+
+
+def clear():
+    """Removes the files of the previous server run."""
+    if not settings.METRICS_DIR:
+        # The working directory otherwise.
+        return
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, "*.json")):
+        os.remove(path)
+
+
+def merged_series():
+    """{metric name: {label values: values}} summed over the processes."""
+    snapshots = [_snapshot()]
+    if settings.METRICS_DIR:
+        own = os.path.join(settings.METRICS_DIR, f"{os.getpid()}.json")
+        for path in glob.glob(os.path.join(settings.METRICS_DIR, "*.json")):
+            if path == own:
+                continue
+            try:
+                with open(path) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):  # replaced or removed meanwhile
+                continue
+    merged = {name: {} for name in METRICS}
+    for snapshot in snapshots:
+        for name, series in snapshot.items():
+            if name not in merged:
+                continue
+            for labels, values in series:
+                total = merged[name].setdefault(tuple(labels), [0] * len(values))
+                merged[name][tuple(labels)] = [a + b for a, b in zip(total, values)]
+    return merged
+
+
+def render_metrics():
+    lines = []
+    for name, series in merged_series().items():
+        lines.extend(METRICS[name].render(series))
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
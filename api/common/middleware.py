@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from . import metrics, slow_queries
+from .timing import (
+    current_timings,
+    end_request,
+    enable_query_timing,
+    install_query_timer,
+    start_request,
+)
+
+
+class RequestScopeMiddleware:
+    """
+    Sync and async capable middleware keeping per request state in a context
+    variable: start() before the view, end() and finish() after it. Unused
+    unless the enabled_setting is set.
+
+    install_wrapper() is called on the connections opened before the
+    middleware was loaded, enable_wrapper() wires it to those opened later.
+    """
+
+    sync_capable = True
+    async_capable = True
+    enabled_setting = None
+
+    def __init__(self, get_response):
+        if not getattr(settings, self.enabled_setting):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Tells Django to await the middleware.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        self.enable_wrapper()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        for connection in connections.all():
+            self.install_wrapper(connection)
+        state, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            self.end(token)
+        return self.finish(request, response, state)
+
+    async def __acall__(self, request):
+        state, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.end(token)
+        return self.finish(request, response, state)
+
+    def finish(self, request, response, state):
+        return response
+
+
+class ServerTimingMiddleware(RequestScopeMiddleware):
+    """
+    Times each request (see common.timing), adds a Server-Timing header with
+    its SQL, phase and total durations and aggregates them into the /metrics
+    histograms. Unused unless API_METRICS_ENABLED.
+    """
+
+    enabled_setting = "API_METRICS_ENABLED"
+
+    def enable_wrapper(self):
+        enable_query_timing()
+
+    def install_wrapper(self, connection):
+        install_query_timer(connection)
+
+    def start(self, request):
+        return start_request()
+
+    def end(self, token):
+        end_request(token)
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view returns.
+        timings = current_timings()
+        if timings is not None:
+            started = time.perf_counter()
+            response.add_post_render_callback(
+                lambda response: timings.add_phase(
+                    "render", time.perf_counter() - started
+                )
+            )
+        return response
+
+    def finish(self, request, response, timings):
+        total = timings.elapsed()
+        response["Server-Timing"] = timings.server_timing(total)
+        metrics.observe_request(
+            metrics.route_of(request), response.status_code, timings, total
+        )
+        return response
+
+
+class SlowQueryLogMiddleware(RequestScopeMiddleware):
+    """
+    Records the slow and sampled ORM queries of each request with their
+    plans (see common.slow_queries). Unused unless SLOW_QUERY_LOG_ENABLED.
+    """
+
+    enabled_setting = "SLOW_QUERY_LOG_ENABLED"
+
+    def enable_wrapper(self):
+        slow_queries.enable_slow_query_log()
+
+    def install_wrapper(self, connection):
+        slow_queries.install_slow_query_log(connection)
+
+    def start(self, request):
+        return None, slow_queries.start_request(request)
+
+    def end(self, token):
+        slow_queries.end_request(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        info = slow_queries.current_request()
+        if info is not None:
+            info.endpoint = request.resolver_match.route
@@ -0,0 +1,18 @@
+"""
+PostgreSQL backend keeping a pool of connections in each worker process.
+
+Use it as the ENGINE of a database and configure the pool with a POOL dict
+next to OPTIONS (see DATABASES in config/settings.py):
+
+- SIZE: connections per process, requests wait for a free one beyond it.
+- TIMEOUT: seconds a request waits for a free connection before failing.
+- MAX_LIFETIME: seconds after which a connection is closed instead of
+  being reused.
+- HEALTH_CHECK_INTERVAL: connections idle for longer are checked with a
+  round trip before they are handed out again.
+
+Django's "closing" of a connection (at the end of each request with
+CONN_MAX_AGE = 0) returns it to the pool, so the handshake is only paid by
+the first requests of a process. Pools are per process: a forked worker
+starts with empty pools and never touches the connections of its parent.
+"""
@@ -0,0 +1,50 @@
+from django.db.backends.postgresql import base
+
+from .creation import DatabaseCreation
+from .pool import get_pool
+
+# Keys of the POOL setting and the ConnectionPool arguments they set.
+POOL_OPTIONS = {
+    "SIZE": "size",
+    "TIMEOUT": "timeout",
+    "MAX_LIFETIME": "max_lifetime",
+    "HEALTH_CHECK_INTERVAL": "health_check_interval",
+}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+    # Pool of the current connection.
+    pool = None
+
+    def get_pool(self, conn_params):
+        # One pool per database and user, e.g. the test database and
+        # the maintenance database used to create it.
+        key = tuple(
+            [self.alias]
+            + [conn_params.get(name) for name in ("host", "port", "database", "user")]
+        )
+        options = {
+            POOL_OPTIONS[name]: value
+            for name, value in self.settings_dict.get("POOL", {}).items()
+        }
+        options["name"] = f"{self.alias}/{conn_params.get('database')}"
+        return get_pool(key, **options)
+
+    def get_new_connection(self, conn_params):
+        self.pool = self.get_pool(conn_params)
+        connection = self.pool.checkout(
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params)
+        )
+        # Like the parent does for a new connection.
+        self.isolation_level = self.settings_dict["OPTIONS"].get(
+            "isolation_level", connection.isolation_level
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is not None and self.pool is not None:
+            with self.wrap_database_errors:
+                self.pool.checkin(self.connection)
+        else:
+            super()._close()
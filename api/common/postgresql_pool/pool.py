@@ -0,0 +1,205 @@
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+from common import metrics
+
+logger = logging.getLogger(__name__)
+
+# {key: ConnectionPool} of the current process, see get_pool().
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+class PoolStats:
+    """
+    Counters of a pool since the process started, also exported at /metrics
+    labelled with the pool name (see common.metrics).
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.discarded = 0
+        # Checkouts which found every connection in use.
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of at most size psycopg2 connections. Idle connections
+    are handed out most recently used first.
+    """
+
+    def __init__(
+        self,
+        size,
+        timeout=10,
+        max_lifetime=None,
+        health_check_interval=0,
+        name="default",
+    ):
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.name = name
+        self.stats = PoolStats()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # [(connection, created_at, returned_at)], most recent last.
+        self._idle = []
+        self._created_at = {}
+
+    def checkout(self, connect):
+        """
+        A healthy idle connection, or a new one made by connect(). Raises
+        OperationalError if none is freed up within the timeout.
+        """
+        if not self._slots.acquire(blocking=False):
+            started = time.monotonic()
+            acquired = self._slots.acquire(timeout=self.timeout)
+            waited = time.monotonic() - started
+            with self._lock:
+                self.stats.waits += 1
+                self.stats.wait_seconds += waited
+                self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, waited)
+                if not acquired:
+                    self.stats.timeouts += 1
+            metrics.observe(metrics.DB_POOL_WAIT, waited, self.name)
+            if not acquired:
+                metrics.increment(metrics.DB_POOL_TIMEOUTS, self.name)
+                logger.warning(
+                    "No database connection freed up in %ss, pool of %s",
+                    self.timeout,
+                    self.size,
+                )
+                raise psycopg2.OperationalError(
+                    f"Timed out waiting for one of the {self.size} pooled connections"
+                )
+        try:
+            connection = self._reuse()
+            if connection is None:
+                connection = connect()
+                with self._lock:
+                    self._created_at[connection] = time.monotonic()
+                    self.stats.connects += 1
+                metrics.increment(metrics.DB_POOL_CONNECTS, self.name)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.stats.checkouts += 1
+        metrics.increment(metrics.DB_POOL_CHECKOUTS, self.name)
+        return connection
+
+    def _reuse(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection, created_at, returned_at = self._idle.pop()
+            now = time.monotonic()
+            if self._expired(created_at, now) or not self._healthy(
+                connection, now - returned_at
+            ):
+                self._discard(connection)
+                continue
+            return connection
+
+    def _expired(self, created_at, now):
+        return self.max_lifetime is not None and now - created_at >= self.max_lifetime
+
+    def _healthy(self, connection, idle_seconds):
+        if connection.closed:
+            return False
+        if idle_seconds < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def checkin(self, connection):
+        """Returns a checked out connection, rolling back any open transaction."""
+        try:
+            if not connection.closed and (
+                connection.get_transaction_status()
+                != extensions.TRANSACTION_STATUS_IDLE
+            ):
+                connection.rollback()
+        except psycopg2.Error:
+            pass
+        try:
+            with self._lock:
+                created_at = self._created_at.get(connection)
+            if connection.closed or created_at is None:
+                self._discard(connection)
+            else:
+                with self._lock:
+                    self._idle.append((connection, created_at, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def _discard(self, connection):
+        with self._lock:
+            self._created_at.pop(connection, None)
+            self.stats.discarded += 1
+        metrics.increment(metrics.DB_POOL_DISCARDED, self.name)
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def close_idle(self):
+        """Closes the idle connections, checked out ones are left alone."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _, _ in idle:
+            self._discard(connection)
+
+
+def _process_pools():
+    global _pools_pid
+    if _pools_pid != os.getpid():
+        # Forked: the inherited connections belong to the parent process,
+        # closing them here would close them for the parent too.
+        _pools.clear()
+        _pools_pid = os.getpid()
+    return _pools
+
+
+def get_pool(key, **options):
+    """The pool of the key in this process, created with the options."""
+    with _pools_lock:
+        pools = _process_pools()
+        if key not in pools:
+            pools[key] = ConnectionPool(**options)
+        return pools[key]
+
+
+def pool_stats():
+    """{pool key: PoolStats.as_dict()} of the pools of this process."""
+    with _pools_lock:
+        return {key: pool.stats.as_dict() for key, pool in _process_pools().items()}
+
+
+def close_pools():
+    """Closes the idle connections of the pools of this process."""
+    with _pools_lock:
+        pools = list(_process_pools().values())
+    for pool in pools:
+        pool.close_idle()
@@ -0,0 +1,124 @@
+"""
+Routing of the read-only API queries to the read replicas.
+
+DB_REPLICA_HOSTS adds a "replica_<n>" database per streaming replica (see
+config/settings.py). ReplicaRouter only sends reads to them inside a
+read_replica() block, which the read-only list views run in: one database
+is picked per block, round robin over the replicas or the least lagging one
+(DB_REPLICA_SELECTION), skipping those unreachable or more than
+DB_REPLICA_MAX_LAG seconds behind, and the primary when none is left.
+Writes, migrations and every query outside of a block (ingests, rollup
+refreshes, management commands) use the primary.
+
+Each process checks the lag of a replica on its first use after
+DB_REPLICA_CHECK_INTERVAL seconds, a replica failing a query is skipped
+until then.
+"""
+
+import contextvars
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+_read_alias = contextvars.ContextVar("read_alias", default=None)
+_turns = itertools.count()
+# {alias: (monotonic time of the check, lag in seconds or None if unusable)}
+_lags = {}
+
+# 0 on a replica which replayed all the WAL it received, else the age of
+# the last transaction replayed.
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+
+def check_lag(alias):
+    """Replication lag of the replica in seconds, None if unreachable."""
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except DatabaseError as error:
+        logger.warning("Replica %s is unavailable: %s", alias, error)
+        connections[alias].close()
+        return None
+    return None if lag is None else float(lag)
+
+
+def replica_lag(alias):
+    """Lag of the replica as of its last check, checked again if too old."""
+    checked_at, lag = _lags.get(alias, (None, None))
+    if (
+        checked_at is None
+        or time.monotonic() - checked_at >= settings.DB_REPLICA_CHECK_INTERVAL
+    ):
+        lag = check_lag(alias)
+        _lags[alias] = (time.monotonic(), lag)
+    return lag
+
+
+def mark_unavailable(alias):
+    """Skips the replica until its next check, e.g. after a failed query."""
+    _lags[alias] = (time.monotonic(), None)
+
+
+def forget_lags():
+    _lags.clear()
+
+
+def choose_read_alias():
+    """Database the reads of a read_replica() block go to."""
+    lags = {}
+    for alias in settings.DB_REPLICAS:
+        lag = replica_lag(alias)
+        if lag is not None and lag <= settings.DB_REPLICA_MAX_LAG:
+            lags[alias] = lag
+    if not lags:
+        return DEFAULT_DB_ALIAS
+    if settings.DB_REPLICA_SELECTION == "least_lag":
+        return min(lags, key=lags.get)
+    return list(lags)[next(_turns) % len(lags)]
+
+
+@contextmanager
+def read_replica(alias=None):
+    """
+    Routes the reads of the block to the alias database, by default the one
+    choose_read_alias() picks, and yields it.
+    """
+    token = _read_alias.set(alias or choose_read_alias())
+    try:
+        yield _read_alias.get()
+    finally:
+        _read_alias.reset(token)
+
+
+def current_read_alias():
+    """Database the reads go to, the primary outside of read_replica()."""
+    return _read_alias.get() or DEFAULT_DB_ALIAS
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Even for instances read from a replica.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,254 @@
+"""
+Slow query log of the API requests.
+
+SlowQueryLogMiddleware (common.middleware) keeps the endpoint and parameter
+shape (the sorted query parameter names) of the request being served in a
+context variable, and record_slow_query(), a database execute wrapper,
+records the ORM queries of the request taking more than
+SLOW_QUERY_THRESHOLD_MS, failing (e.g. cancelled by their statement
+timeout), or in a SLOW_QUERY_SAMPLE_RATE fraction of all of them, with
+their SQL, parameters, error and EXPLAIN plan. Queries run outside of a
+request, and the asyncpg queries of the async views, are not recorded.
+
+Plans are taken off the request path, by a thread of the worker on its own
+connection to the same database, which then writes the entry. Queries are
+only planned by default. With SLOW_QUERY_EXPLAIN_ANALYZE=True successful
+SELECT queries are explained with EXPLAIN (ANALYZE, BUFFERS), which runs
+them a second time, under a statement timeout of
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS, and are only planned if they exceed it.
+Entries are written without a plan while PENDING_PLANS others wait for
+theirs.
+
+Entries are JSON files in SLOW_QUERY_LOG_DIR written by every worker into
+a ring buffer of SLOW_QUERY_LOG_SIZE slots, the next slot being kept in a
+locked position file. manage.py slow_queries summarizes them.
+"""
+
+import contextvars
+import datetime
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.backends.signals import connection_created
+
+from .admission import is_statement_timeout
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("slow_query_request", default=None)
+
+ENTRY_PATTERN = "[0-9]*.json"
+# Runs of placeholders, e.g. of IN lists, fingerprinted as one.
+PLACEHOLDER_RUN = re.compile(r"%s(?:\s*,\s*%s)+")
+# Entries waiting for the explain thread at most.
+PENDING_PLANS = 100
+
+# (entry, alias, many, analyze) of the queries waiting for their plan.
+_pending = queue.Queue(PENDING_PLANS)
+_explainer = None
+_explainer_lock = threading.Lock()
+
+
+class RequestInfo:
+    def __init__(self, request):
+        self.endpoint = "unmatched"
+        self.shape = "&".join(sorted(request.GET))
+        self.query_string = request.META.get("QUERY_STRING", "")
+
+
+def start_request(request):
+    """Records the slow queries of the request from now on, returns a token."""
+    return _current.set(RequestInfo(request))
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def current_request():
+    """RequestInfo of the request being served, None outside of one."""
+    return _current.get()
+
+
+def fingerprint(sql):
+    """Short hash of the SQL, the same whatever the length of its IN lists."""
+    normalized = PLACEHOLDER_RUN.sub("%s, ...", " ".join(sql.split()))
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def record_slow_query(execute, sql, params, many, context):
+    """Database execute wrapper recording the slow, failed and sampled queries."""
+    request = _current.get()
+    if request is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    error = None
+    try:
+        return execute(sql, params, many, context)
+    except Exception as exception:
+        error = exception
+        raise
+    finally:
+        milliseconds = (time.perf_counter() - started) * 1000
+        if error is not None:
+            reason = "failed"
+        elif milliseconds >= settings.SLOW_QUERY_THRESHOLD_MS:
+            reason = "slow"
+        elif random.random() < settings.SLOW_QUERY_SAMPLE_RATE:
+            reason = "sampled"
+        else:
+            reason = None
+        if reason is not None:
+            entry = _entry(request, reason, milliseconds, sql, params, many, error)
+            _explain_later(entry, context["connection"].alias, many, error is None)
+
+
+def _entry(request, reason, milliseconds, sql, params, many, error):
+    return {
+        "time": datetime.datetime.utcnow().isoformat(timespec="milliseconds"),
+        "reason": reason,
+        "endpoint": request.endpoint,
+        "shape": request.shape,
+        "query_string": request.query_string,
+        "duration_ms": round(milliseconds, 3),
+        "fingerprint": fingerprint(sql),
+        "sql": sql,
+        "params": None if many else params,
+        "error": None if error is None else str(error).strip(),
+        "plan": None,
+    }
+
+
+def _explain_later(entry, alias, many, analyze):
+    """Hands the entry to the explain thread, started on first use."""
+    global _explainer
+    with _explainer_lock:
+        if _explainer is None or not _explainer.is_alive():
+            _explainer = threading.Thread(
+                target=_explain_pending, name="slow-query-explain", daemon=True
+            )
+            _explainer.start()
+    try:
+        _pending.put_nowait((entry, alias, many, analyze))
+    except queue.Full:
+        entry["explain_error"] = "Too many queries waiting for their plan"
+        append_entry(entry)
+
+
+def _explain_pending():
+    """Body of the explain thread."""
+    while True:
+        entry, alias, many, analyze = _pending.get()
+        try:
+            if not many:
+                try:
+                    entry["plan"] = explain(
+                        connections[alias], entry["sql"], entry["params"], analyze
+                    )
+                except DatabaseError as error:
+                    entry["explain_error"] = str(error).strip()
+            append_entry(entry)
+        except Exception:
+            logger.exception("Could not record a slow query")
+        finally:
+            if _pending.empty():
+                # Not held open between the bursts of slow queries.
+                connections.close_all()
+            _pending.task_done()
+
+
+def wait_for_plans():
+    """Waits until the entries handed to the explain thread are written."""
+    _pending.join()
+
+
+def explain(connection, sql, params, analyze=True):
+    """Lines of the EXPLAIN output of the query."""
+    if (
+        analyze
+        and settings.SLOW_QUERY_EXPLAIN_ANALYZE
+        and sql.lstrip()[:6].upper() in ("SELECT", "WITH")
+    ):
+        try:
+            return _explain(connection, "ANALYZE, BUFFERS, FORMAT TEXT", sql, params)
+        except DatabaseError as error:
+            if not is_statement_timeout(error):
+                raise
+    return _explain(connection, "FORMAT TEXT", sql, params)
+
+
+def _explain(connection, options, sql, params):
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SET LOCAL statement_timeout = %s",
+                [int(settings.SLOW_QUERY_EXPLAIN_TIMEOUT_MS)],
+            )
+            cursor.execute(f"EXPLAIN ({options}) {sql}", params)
+            return [row[0] for row in cursor.fetchall()]
+
+
+def install_slow_query_log(connection, **kwargs):
+    """Adds record_slow_query() to the execute wrappers of the connection."""
+    if record_slow_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_slow_query)
+
+
+def enable_slow_query_log():
+    """Connections opened from then on, in any thread, record slow queries."""
+    connection_created.connect(install_slow_query_log, dispatch_uid=__name__)
+
+
+def append_entry(entry):
+    """Writes the entry into the next slot of the ring buffer."""
+    directory = settings.SLOW_QUERY_LOG_DIR
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "position"), "a+") as position:
+        # Held until the entry is written, so slots are taken in order.
+        fcntl.flock(position, fcntl.LOCK_EX)
+        position.seek(0)
+        slot = int(position.read() or 0) % settings.SLOW_QUERY_LOG_SIZE
+        position.seek(0)
+        position.truncate()
+        position.write(str(slot + 1))
+        position.flush()
+        descriptor, path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(descriptor, "w") as file:
+            json.dump(entry, file, default=str)
+        os.replace(path, os.path.join(directory, f"{slot}.json"))
+
+
+def entries():
+    """The recorded entries, oldest first."""
+    recorded = []
+    pattern = os.path.join(settings.SLOW_QUERY_LOG_DIR, ENTRY_PATTERN)
+    for path in glob.glob(pattern):
+        slot = int(os.path.basename(path)[: -len(".json")])
+        if slot >= settings.SLOW_QUERY_LOG_SIZE:  # left by a larger buffer
+            continue
+        try:
+            with open(path) as file:
+                recorded.append(json.load(file))
+        except (OSError, ValueError):  # removed meanwhile
+            continue
+    return sorted(recorded, key=lambda entry: entry["time"])
+
+
+def clear():
+    directory = settings.SLOW_QUERY_LOG_DIR
+    for path in glob.glob(os.path.join(directory, ENTRY_PATTERN)):
+        os.remove(path)
+    if os.path.exists(os.path.join(directory, "position")):
+        os.remove(os.path.join(directory, "position"))
@@ -0,0 +1,115 @@
+"""
+Per-request timings: the number and duration of the SQL queries and the
+duration of named phases (e.g. "quantile", "binning", "serialization",
+"render") of the request being served.
+
+ServerTimingMiddleware (common.middleware) starts a RequestTimings for each
+request and keeps it in a context variable, so that it follows the request
+into async views and sync_to_async() threads. Code records into it with
+phase() and timed_query(), which cost a context variable lookup when no
+request is being timed. Phases are wall times and include the queries run
+within them.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+from django.db.backends.signals import connection_created
+
+_current = contextvars.ContextVar("request_timings", default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        # {phase: seconds} in the order the phases first ran.
+        self.phases = {}
+
+    def add_query(self, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+
+    def add_phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total):
+        """Server-Timing header value, durations in milliseconds."""
+        db = f'db;dur={self.db_seconds * 1000:.2f};desc="{self.queries} queries"'
+        metrics = [db]
+        metrics.extend(
+            f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()
+        )
+        metrics.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+def start_request():
+    """Times the current request from now on, returns (timings, token)."""
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def current_timings():
+    """Timings of the request being served, None outside of one."""
+    return _current.get()
+
+
+@contextmanager
+def phase(name):
+    """Adds the duration of the block to the phase of the current request."""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_phase(name, time.perf_counter() - started)
+
+
+@contextmanager
+def timed_query():
+    """Counts the block as a query of the current request."""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_query(time.perf_counter() - started)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper timing the queries of the current request."""
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add_query(time.perf_counter() - started)
+
+
+def install_query_timer(connection, **kwargs):
+    """Adds record_query() to the execute wrappers of the connection."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def enable_query_timing():
+    """Connections opened from then on, in any thread, time their queries."""
+    connection_created.connect(install_query_timer, dispatch_uid=__name__)
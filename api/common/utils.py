@@ -1,4 +1,5 @@
 import calendar
+import re
 from datetime import datetime
 
 from .exceptions import IllegalDateError
@@ -16,3 +17,41 @@ def from_year_month_to_datetime(date_str, last_day=False):
     except Exception:
         raise IllegalDateError(date_str)
     return date
+
+
+def canonical_postal_code(postal_code):
+    """
+    Upper-cases the postcode and separates its 3 character inward code
+    with a single space, e.g. "ls71nj" -> "LS7 1NJ".
+    """
+    postal_code = "".join(postal_code.split()).upper()
+    if len(postal_code) > 3:
+        postal_code = f"{postal_code[:-3]} {postal_code[-3:]}"
+    return postal_code
+
+
+def canonical_postal_sector(postal_sector):
+    """
+    Upper-cases the postcode sector and separates its inward digit with a
+    single space, e.g. "ls71" -> "LS7 1".
+    """
+    postal_sector = "".join(postal_sector.split()).upper()
+    if len(postal_sector) > 1:
+        postal_sector = f"{postal_sector[:-1]} {postal_sector[-1:]}"
+    return postal_sector
+
+
+def canonical_postal_prefix(postal_prefix):
+    """Upper-cases the postcode area or district, e.g. " ls7" -> "LS7"."""
+    return "".join(postal_prefix.split()).upper()
+
+
+def postal_code_levels(postal_code):
+    """
+    Area, district and sector of a canonical postcode,
+    e.g. "LS7 1NJ" -> ("LS", "LS7", "LS7 1").
+    """
+    district, _, inward = postal_code.partition(" ")
+    area = re.match(r"[A-Z]*", district).group()
+    sector = f"{district} {inward[:1]}".rstrip()
+    return area, district, sector
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+# The list endpoints are served by the async views (pricepaid.async_views).
+os.environ.setdefault('API_ASYNC_VIEWS', 'True')
 
 application = get_asgi_application()
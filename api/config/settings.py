@@ -36,6 +36,127 @@ POSTGRES_USER = env("POSTGRES_USER")
 POSTGRES_PASSWORD = env("POSTGRES_PASSWORD")
 POSTGRES_HOST = env("POSTGRES_HOST")
 POSTGRES_PORT = env("POSTGRES_PORT")
+# Connections kept open by each worker process and reused by its requests
+# (see common.postgresql_pool), 0 opens a new connection per request.
+DB_POOL_SIZE = env.int("DB_POOL_SIZE", 4)
+# Seconds a request waits for a free pooled connection before failing.
+DB_POOL_TIMEOUT = env.float("DB_POOL_TIMEOUT", 10)
+# Seconds after which a pooled connection is replaced by a new one.
+DB_CONN_MAX_LIFETIME = env.int("DB_CONN_MAX_LIFETIME", 3600)
+# Pooled connections idle for longer are checked before being reused.
+DB_HEALTH_CHECK_INTERVAL = env.int("DB_HEALTH_CHECK_INTERVAL", 30)
+
+# Price quantile sketches
+# Serve the count_transactions outlier bounds from the precomputed sketches
+# instead of sorting the matching prices. Bounds are then within the
+# relative accuracy of the exact ones, between 0.00033 and 1 (exclusive).
+# The sketches keep the accuracy they were built at until rebuilt
+# (manage.py build_rollups) after changing it.
+QUANTILE_SKETCH_ENABLED = env.bool("QUANTILE_SKETCH_ENABLED", False)
+QUANTILE_SKETCH_RELATIVE_ACCURACY = env.float(
+    "QUANTILE_SKETCH_RELATIVE_ACCURACY", 0.01
+)
+
+# Fine price histograms
+# Serve the count_transactions histograms by re-bucketing the transaction
+# counts per postcode, month and 100 wide price bucket kept at ingest
+# instead of scanning the matching rows. Exact when the outlier bounds are
+# multiples of 100, else the bin width can be one step of 100 off (see
+# pricepaid.fine_histograms).
+FINE_HISTOGRAMS_ENABLED = env.bool("FINE_HISTOGRAMS_ENABLED", False)
+
+# Response cache shared by the API workers
+# Locally a file based cache (put it under /dev/shm to keep it in shared
+# memory), in production e.g. django_redis.cache.RedisCache with a
+# redis:// location. Entries are invalidated by the dataset generation.
+API_CACHE_ENABLED = env.bool("API_CACHE_ENABLED", False)
+API_CACHE_BACKEND = env(
+    "API_CACHE_BACKEND", "django.core.cache.backends.filebased.FileBasedCache"
+)
+API_CACHE_LOCATION = env("API_CACHE_LOCATION", "/tmp/pricepaid-api-cache")
+# How long CDNs and other shared caches may hold a response (Cache-Control
+# s-maxage). Set it to the ingest interval, or purge the CDN after ingest.
+API_CACHE_CONTROL_S_MAXAGE = env.int("API_CACHE_CONTROL_S_MAXAGE", 86400)
+
+# Batch average price endpoint
+# Most specs a single POST may carry, they are all answered by one statement.
+BATCH_MAX_SPECS = env.int("BATCH_MAX_SPECS", 5000)
+
+# Query engine of the list endpoints
+# "postgres", or "memory" to answer them with NumPy from the column files
+# exported by manage.py export_column_store into COLUMN_STORE_DIR (see
+# pricepaid.column_store). Postgres answers while the export is stale.
+API_QUERY_ENGINE = env("API_QUERY_ENGINE", "postgres")
+COLUMN_STORE_DIR = env("COLUMN_STORE_DIR", "/tmp/pricepaid-columns")
+
+# Async views
+# Serve the list endpoints with the async views, on by default under ASGI
+# (gunicorn config.asgi -k uvicorn.workers.UvicornWorker, see config/asgi.py).
+# Each worker process keeps an asyncpg pool of at most ASYNC_DB_POOL_SIZE
+# connections.
+API_ASYNC_VIEWS = env.bool("API_ASYNC_VIEWS", False)
+ASYNC_DB_POOL_SIZE = env.int("ASYNC_DB_POOL_SIZE", 10)
+
+# Request metrics
+# Add a Server-Timing header (SQL, phases and total durations) to every
+# response and aggregate the timings into the Prometheus histograms served
+# at /metrics (see common.metrics). Each worker writes its histograms into
+# METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds so that /metrics
+# reports all the workers of the server.
+API_METRICS_ENABLED = env.bool("API_METRICS_ENABLED", True)
+METRICS_DIR = env("METRICS_DIR", "/tmp/pricepaid-metrics")
+METRICS_FLUSH_INTERVAL = env.float("METRICS_FLUSH_INTERVAL", 1.0)
+
+# Slow query log
+# Record the ORM queries of the API requests slower than
+# SLOW_QUERY_THRESHOLD_MS or failing, plus a SLOW_QUERY_SAMPLE_RATE fraction
+# of all of them, with their EXPLAIN plan into a ring buffer of the last
+# SLOW_QUERY_LOG_SIZE entries (see common.slow_queries). With
+# SLOW_QUERY_EXPLAIN_ANALYZE the plans come from EXPLAIN (ANALYZE, BUFFERS),
+# which runs the recorded queries a second time, in a background thread of
+# the worker, for at most SLOW_QUERY_EXPLAIN_TIMEOUT_MS milliseconds.
+# manage.py slow_queries summarizes the log.
+SLOW_QUERY_LOG_ENABLED = env.bool("SLOW_QUERY_LOG_ENABLED", False)
+SLOW_QUERY_THRESHOLD_MS = env.float("SLOW_QUERY_THRESHOLD_MS", 500)
+SLOW_QUERY_SAMPLE_RATE = env.float("SLOW_QUERY_SAMPLE_RATE", 0.0)
+SLOW_QUERY_EXPLAIN_ANALYZE = env.bool("SLOW_QUERY_EXPLAIN_ANALYZE", False)
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = env.int("SLOW_QUERY_EXPLAIN_TIMEOUT_MS", 5000)
+SLOW_QUERY_LOG_DIR = env("SLOW_QUERY_LOG_DIR", "/tmp/pricepaid-slow-queries")
+SLOW_QUERY_LOG_SIZE = env.int("SLOW_QUERY_LOG_SIZE", 1000)
+
+# Admission control
+# Statement timeout in milliseconds of the queries of each endpoint
+# (avg_prices, avg_prices_batch, count_transactions, missing or 0 for none).
+# At most EXPENSIVE_QUERY_CONCURRENCY expensive requests (count_transactions
+# narrowed by neither a date nor a postcode or sector) run at once on a
+# host, across the workers, and at most EXPENSIVE_QUERY_QUEUE_SIZE others
+# wait up to EXPENSIVE_QUERY_QUEUE_TIMEOUT seconds for their turn, 0
+# concurrency disables the limit. Requests shed or timed out are answered
+# with a 503 asking to retry after ADMISSION_RETRY_AFTER seconds (see
+# common.admission).
+API_STATEMENT_TIMEOUTS = env.dict(
+    "API_STATEMENT_TIMEOUTS",
+    {"avg_prices": 5000, "avg_prices_batch": 10000, "count_transactions": 30000},
+    subcast_values=int,
+)
+EXPENSIVE_QUERY_CONCURRENCY = env.int("EXPENSIVE_QUERY_CONCURRENCY", 4)
+EXPENSIVE_QUERY_QUEUE_SIZE = env.int("EXPENSIVE_QUERY_QUEUE_SIZE", 8)
+EXPENSIVE_QUERY_QUEUE_TIMEOUT = env.float("EXPENSIVE_QUERY_QUEUE_TIMEOUT", 2)
+ADMISSION_RETRY_AFTER = env.int("ADMISSION_RETRY_AFTER", 5)
+ADMISSION_DIR = env("ADMISSION_DIR", "/tmp/pricepaid-admission")
+
+# Read replicas
+# host:port of the streaming replicas of the database, each added as a
+# "replica_<n>" database with the credentials of the primary. The read-only
+# list endpoints query one of them, picked per request round robin or the
+# least lagging ("round_robin" or "least_lag"), among those reachable and at
+# most DB_REPLICA_MAX_LAG seconds behind, else the primary. Each worker
+# checks the lag of a replica at most every DB_REPLICA_CHECK_INTERVAL
+# seconds (see common.routers). Writes always go to the primary.
+DB_REPLICA_HOSTS = env.list("DB_REPLICA_HOSTS", [])
+DB_REPLICA_SELECTION = env("DB_REPLICA_SELECTION", "round_robin")
+DB_REPLICA_MAX_LAG = env.float("DB_REPLICA_MAX_LAG", 30)
+DB_REPLICA_CHECK_INTERVAL = env.float("DB_REPLICA_CHECK_INTERVAL", 5)
 
 # Production environment
 PROD_HOST = env("DJANGO_API_HOST")
@@ -53,6 +174,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     # 3rd-party apps
     "rest_framework",
     "drf_spectacular",
@@ -74,6 +196,8 @@ SPECTACULAR_SETTINGS = {
 }
 
 MIDDLEWARE = [
+    "common.middleware.ServerTimingMiddleware",
+    "common.middleware.SlowQueryLogMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -118,6 +242,48 @@ DATABASES = {
         "PORT": POSTGRES_PORT,
     }
 }
+if DB_POOL_SIZE:
+    # Requests still "close" their connection, which returns it to the pool.
+    DATABASES["default"].update(
+        ENGINE="common.postgresql_pool",
+        POOL={
+            "SIZE": DB_POOL_SIZE,
+            "TIMEOUT": DB_POOL_TIMEOUT,
+            "MAX_LIFETIME": DB_CONN_MAX_LIFETIME,
+            "HEALTH_CHECK_INTERVAL": DB_HEALTH_CHECK_INTERVAL,
+        },
+    )
+DB_REPLICAS = []
+for number, replica in enumerate(DB_REPLICA_HOSTS, start=1):
+    host, _, port = replica.partition(":")
+    alias = f"replica_{number}"
+    DATABASES[alias] = dict(
+        DATABASES["default"],
+        HOST=host,
+        PORT=port or "5432",
+        # An unreachable replica is skipped rather than waited for.
+        OPTIONS={"connect_timeout": 2},
+        # Tests only create the primary's database.
+        TEST={"MIRROR": "default"},
+    )
+    DB_REPLICAS.append(alias)
+DATABASE_ROUTERS = ["common.routers.ReplicaRouter"]
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "api": {
+        "BACKEND": API_CACHE_BACKEND,
+        "LOCATION": API_CACHE_LOCATION,
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+}
 
 
 # Password validation
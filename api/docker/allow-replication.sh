@@ -0,0 +1,3 @@
+#!/bin/sh
+# Lets the db-replica service stream the WAL of a freshly initialized db.
+echo "host replication all all md5" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,24 @@
+# Read by gunicorn from the working directory, see
+# https://docs.gunicorn.org/en/stable/settings.html#config-file
+
+import os
+
+
+def on_starting(server):
+    # Drops the request metrics of the previous run (see common.metrics).
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+    from common import metrics
+
+    metrics.clear()
+
+
+def worker_exit(server, worker):
+    # Imported late, workers load the app after the fork.
+    from common import metrics
+    from common.postgresql_pool.pool import close_pools, pool_stats
+
+    metrics.flush()
+
+    for key, stats in pool_stats().items():
+        server.log.info("Worker %s database pool %s: %s", worker.pid, key, stats)
+    close_pools()
@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class PricepaidConfig(AppConfig):
     name = "pricepaid"
+
+    def ready(self):
+        # Keeps the monthly rollups current for ORM writes.
+        from . import signals  # noqa: F401
+        from .sketches import check_accuracy
+
+        check_accuracy(settings.QUANTILE_SKETCH_RELATIVE_ACCURACY)
@@ -0,0 +1,81 @@
+"""
+asyncpg connection pools of the async views.
+
+Django's ORM is synchronous, so the async views query Postgres through
+asyncpg with the credentials of the database reads are routed to (see
+common.routers). Pools belong to the event loop they were created in, so
+there is one per running loop and database.
+"""
+
+import asyncio
+import contextvars
+import re
+from contextlib import contextmanager
+
+import asyncpg
+from common.routers import current_read_alias
+from common.timing import timed_query
+from django.conf import settings
+from django.db import connections
+
+_pools = {}
+# Seconds the queries of the request being served may take, None for no
+# limit. asyncpg cancels a query running longer.
+_timeout = contextvars.ContextVar("query_timeout", default=None)
+
+
+def numbered(sql):
+    """Rewrites the %s placeholders of a query into asyncpg's $1, $2, ..."""
+    numbers = iter(range(1, sql.count("%s") + 1))
+    return re.sub("%s", lambda _: f"${next(numbers)}", sql)
+
+
+async def _create_pool(alias):
+    database = connections[alias].settings_dict
+    return await asyncpg.create_pool(
+        host=database["HOST"] or None,
+        port=database["PORT"] or None,
+        user=database["USER"],
+        password=database["PASSWORD"],
+        database=database["NAME"],
+        min_size=1,
+        max_size=settings.ASYNC_DB_POOL_SIZE,
+    )
+
+
+async def get_pool(alias):
+    loop = asyncio.get_running_loop()
+    pool = _pools.get((loop, alias))
+    # Retried on the next request if the database was unreachable.
+    if pool is None or (pool.done() and pool.exception() is not None):
+        # Concurrent first requests share the pool being created.
+        pool = _pools[loop, alias] = loop.create_task(_create_pool(alias))
+    return await pool
+
+
+async def close_pool():
+    """Closes the pools of the running event loop, if any."""
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _pools if key[0] is loop]:
+        pool = _pools.pop(key)
+        if pool.done() and pool.exception() is not None:
+            continue
+        await (await pool).close()
+
+
+@contextmanager
+def query_timeout(seconds):
+    """Queries of the block taking longer raise asyncio.TimeoutError."""
+    token = _timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _timeout.reset(token)
+
+
+async def fetch(sql, params=()):
+    """Rows of a query written with %s placeholders."""
+    pool = await get_pool(current_read_alias())
+    async with pool.acquire() as conn:
+        with timed_query():
+            return await conn.fetch(numbered(sql), *params, timeout=_timeout.get())
@@ -0,0 +1,313 @@
+"""
+Async versions of the list views, serving the list endpoints when
+API_ASYNC_VIEWS is set, i.e. by default under ASGI (see config/asgi.py).
+
+They answer the same filters with the same JSON, ETag and cache headers as
+the DRF views, querying Postgres through asyncpg (pricepaid.async_db) so
+that a worker serves other requests while waiting on the database, and run
+the sub-queries that do not depend on each other concurrently. They only
+render JSON from Postgres: requests for a columnar format, and every request
+while API_QUERY_ENGINE is "memory", are answered by the DRF views in a
+thread.
+"""
+
+import asyncio
+import calendar
+import functools
+
+from asgiref.sync import sync_to_async
+from common import admission, metrics
+from common.exceptions import (IllegalDateError, IllegalFilterError,
+                               ServiceOverloadedError)
+from common.routers import choose_read_alias, read_replica
+from common.timing import phase
+from common.utils import from_year_month_to_datetime
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.utils.cache import get_conditional_response
+from rest_framework.settings import api_settings
+
+from .async_db import fetch, query_timeout
+from .batch import AVERAGE_PRICE_TYPES
+from .cache import (CACHE_ALIAS, count_cache_outcome, patch_version_headers,
+                    response_cache_key, response_etag)
+from .fine_histograms import buckets_histogram, merged_counts_query
+from .histogram import (LOWER_OUTLIER_BOUNDARY, UPPER_OUTLIER_BOUNDARY,
+                        bin_rows, bin_width_for)
+from .models import DatasetVersion, Postcode, Property, PropertyMonthlyRollup
+from .renderers import (ArrowStreamRenderer, FastJSONRenderer, JSONRows,
+                        ParquetRenderer)
+from .serializers import AvgPriceSerializer, TransactionCountSerializer
+from .sketches import buckets_outlier_bounds, merged_buckets_query
+from .views import (POSTCODE_FILTERS, PropertyAveragePriceList,
+                    PropertyTransactionCountList, get_average_price_filters,
+                    get_postcode_filter, is_expensive_count, rollup_key)
+
+
+def _json_response(data, status=200):
+    with phase("render"):
+        content = FastJSONRenderer().render(data)
+    return HttpResponse(
+        content, status=status, content_type=FastJSONRenderer.media_type
+    )
+
+
+async def _dataset_version():
+    rows = await fetch(
+        f"SELECT generation, updated_at FROM {DatasetVersion._meta.db_table} "
+        "WHERE id = 1"
+    )
+    if not rows:
+        version = await sync_to_async(DatasetVersion.current)()
+        return version.generation, version.updated_at
+    return rows[0]["generation"], rows[0]["updated_at"]
+
+
+async def _sketch_accuracy():
+    rows = await fetch(
+        f"SELECT sketch_relative_accuracy FROM {DatasetVersion._meta.db_table} "
+        "WHERE id = 1"
+    )
+    return rows[0][0] if rows else None
+
+
+async def _versioned_response(request, endpoint, filters, query, expensive=False):
+    """
+    Answers like CachedListMixin.list(): a 304 for a current conditional
+    request, else the cached or freshly queried rows. Unless the request is
+    conditional or the response cache has to be checked first, query() is
+    awaited concurrently with the dataset version lookup.
+
+    Like AdmissionControlMixin, only query() runs under the statement timeout
+    of the endpoint and, for an expensive request, in an admission slot.
+    """
+
+    async def admitted_query():
+        timeout = admission.statement_timeout_ms(endpoint) / 1000 or None
+        with query_timeout(timeout):
+            if not expensive:
+                return await query()
+            async with admission.admitted_async(metrics.route_of(request)):
+                return await query()
+
+    conditional = any(
+        header in request.META
+        for header in ("HTTP_IF_NONE_MATCH", "HTTP_IF_MODIFIED_SINCE")
+    )
+    if settings.API_CACHE_ENABLED or conditional:
+        generation, updated_at = await _dataset_version()
+        data = None
+    else:
+        (generation, updated_at), data = await asyncio.gather(
+            _dataset_version(), admitted_query()
+        )
+    etag = response_etag(endpoint, generation, filters)
+    last_modified = calendar.timegm(updated_at.utctimetuple())
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    if response is None and settings.API_CACHE_ENABLED:
+        # Entries are shared with the sync views, as lists of dicts.
+        cache = caches[CACHE_ALIAS]
+        key = response_cache_key(endpoint, generation, filters)
+        data = await sync_to_async(cache.get)(key)
+        outcome = "hits" if data is not None else "misses"
+        if data is None:
+            data = await admitted_query()
+            await sync_to_async(cache.set)(key, data.as_dicts())
+        await sync_to_async(count_cache_outcome)(endpoint, outcome)
+        response = _json_response(data)
+        response["X-Cache"] = "HIT" if outcome == "hits" else "MISS"
+    elif response is None:
+        response = _json_response(data if data is not None else await admitted_query())
+
+    patch_version_headers(response, etag, last_modified)
+    return response
+
+
+def _needs_sync_view(request):
+    """Whether only the DRF view answers the request as asked."""
+    if settings.API_QUERY_ENGINE == "memory":
+        return True
+    if request.GET.get(api_settings.URL_FORMAT_OVERRIDE, "json") != "json":
+        return True
+    accept = request.headers.get("Accept", "")
+    return any(
+        renderer.media_type in accept
+        for renderer in (ArrowStreamRenderer, ParquetRenderer)
+    )
+
+
+def _list_view(view_class):
+    """
+    GET only, on a read replica, invalid filters answered with a 400 and
+    shed or timed out requests with a 503 like the view_class DRF view,
+    which answers the requests _needs_sync_view() in a thread.
+    """
+    sync_view = view_class.as_view()
+
+    def render_sync(request):
+        return sync_view(request).render()
+
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request):
+            # require_GET() would hide the coroutine function from Django.
+            if request.method not in ("GET", "HEAD"):
+                return HttpResponseNotAllowed(["GET", "HEAD"])
+            if _needs_sync_view(request):
+                return await sync_to_async(render_sync)(request)
+            # Checking the replicas may query them.
+            alias = await sync_to_async(choose_read_alias)()
+            try:
+                with read_replica(alias):
+                    return await view(request)
+            except (IllegalDateError, IllegalFilterError) as error:
+                return _json_response({"error": error.message}, status=400)
+            except asyncio.TimeoutError:
+                return _overloaded_response(
+                    admission.timed_out(metrics.route_of(request))
+                )
+            except ServiceOverloadedError as error:
+                return _overloaded_response(error)
+
+        return wrapper
+
+    return decorator
+
+
+def _overloaded_response(error):
+    response = _json_response({"error": error.message}, status=503)
+    response["Retry-After"] = str(error.retry_after)
+    return response
+
+
+@_list_view(PropertyAveragePriceList)
+async def average_prices(request):
+    """Async PropertyAveragePriceList."""
+    filters = get_average_price_filters(request.GET)
+
+    conditions = ["postal_code = %s", "property_type = ANY(%s)"]
+    params = [rollup_key(filters), list(AVERAGE_PRICE_TYPES)]
+    if "from" in filters:
+        conditions.append("year * 100 + month BETWEEN %s AND %s")
+        params.extend(
+            filters[name].year * 100 + filters[name].month for name in ("from", "to")
+        )
+
+    async def query():
+        rows = await fetch(
+            f"""
+            SELECT property_type, month, year,
+                   SUM(price_sum)::numeric(20, 0) / SUM(price_count)::numeric(20, 0)
+            FROM {PropertyMonthlyRollup._meta.db_table}
+            WHERE {" AND ".join(conditions)}
+            GROUP BY 1, 2, 3
+            ORDER BY 3, 2, 1
+            """,
+            params,
+        )
+        with phase("serialization"):
+            return JSONRows(AvgPriceSerializer, [tuple(row) for row in rows])
+
+    return await _versioned_response(request, "avg_prices", filters, query)
+
+
+@_list_view(PropertyTransactionCountList)
+async def count_transactions(request):
+    """Async PropertyTransactionCountList."""
+    filters = get_postcode_filter(request.GET)
+    date = request.GET.get("date")
+    if date is not None:
+        filters["date"] = from_year_month_to_datetime(date)
+
+    joins, conditions, params = [], [], []
+    for name in POSTCODE_FILTERS:
+        if name in filters:
+            joins.append(
+                f"JOIN {Postcode._meta.db_table} AS d "
+                f"ON d.id = p.postcode_id AND d.{name} = %s"
+            )
+            params.append(filters[name])
+    year = month = None
+    if "date" in filters:
+        start_date = filters["date"].date()
+        last_day = calendar.monthrange(start_date.year, start_date.month)[1]
+        conditions.append("p.transfer_date BETWEEN %s AND %s")
+        params.extend([start_date, start_date.replace(day=last_day)])
+        year, month = start_date.year, start_date.month
+    rows_sql = f"""
+        FROM {Property._meta.db_table} AS p
+        {" ".join(joins)}
+        WHERE {" AND ".join(conditions) or "TRUE"}
+    """
+
+    async def exact_bounds():
+        rows = await fetch(
+            f"""
+            SELECT COUNT(*),
+                   percentile_disc({LOWER_OUTLIER_BOUNDARY}) WITHIN GROUP (ORDER BY p.price),
+                   percentile_disc({UPPER_OUTLIER_BOUNDARY}) WITHIN GROUP (ORDER BY p.price)
+            {rows_sql}
+            """,
+            params,
+        )
+        return tuple(rows[0])
+
+    async def bounds():
+        if settings.QUANTILE_SKETCH_ENABLED:
+            accuracy, buckets = await asyncio.gather(
+                _sketch_accuracy(),
+                fetch(*merged_buckets_query(rollup_key(filters), year, month)),
+            )
+            sketch_bounds = buckets_outlier_bounds(
+                [tuple(row) for row in buckets], accuracy
+            )
+            if sketch_bounds is not None:
+                return sketch_bounds
+        return await exact_bounds()
+
+    async def fine_histogram():
+        buckets = await fetch(*merged_counts_query(rollup_key(filters), year, month))
+        return buckets_histogram([tuple(row) for row in buckets])
+
+    async def query():
+        if settings.FINE_HISTOGRAMS_ENABLED:
+            with phase("binning"):
+                rows = await fine_histogram()
+            if rows is not None:
+                return JSONRows(
+                    TransactionCountSerializer,
+                    [(row["bin_range"], row["bin_size"]) for row in rows],
+                )
+        with phase("quantile"):
+            count, min_price, max_price = await bounds()
+        if count == 0:
+            return JSONRows(TransactionCountSerializer, [])
+        with phase("binning"):
+            bin_width = bin_width_for(min_price, max_price)
+            bins = await fetch(
+                f"""
+                SELECT LEAST(p.price, %s) / %s * %s, COUNT(*)
+                {rows_sql}
+                GROUP BY 1
+                ORDER BY 1
+                """,
+                [max_price, bin_width, bin_width] + params,
+            )
+            rows = bin_rows([tuple(row) for row in bins], bin_width)
+        with phase("serialization"):
+            return JSONRows(
+                TransactionCountSerializer,
+                [(row["bin_range"], row["bin_size"]) for row in rows],
+            )
+
+    return await _versioned_response(
+        request,
+        "count_transactions",
+        filters,
+        query,
+        expensive=is_expensive_count(filters),
+    )
@@ -0,0 +1,58 @@
+"""
+Average prices of many specs (a postcode filter and a month range) in one
+statement: the specs are joined to the monthly rollups as a VALUES list and
+the rollup rows are grouped by spec.
+"""
+from django.db import connections, router
+
+from .models import PropertyMonthlyRollup
+
+# Property types the average price endpoints report.
+AVERAGE_PRICE_TYPES = ("T", "D", "S", "F")
+# Month range of a spec without one, as year * 100 + month.
+ALL_PERIODS = (0, 999912)
+
+
+def batch_average_prices(specs):
+    """
+    Returns {spec id: [{"property_type", "month", "year", "avg_price"}]}
+    ordered by year and month for the {spec id: (rollup key, first period,
+    last period)} specs, periods written as year * 100 + month.
+    """
+    results = {spec_id: [] for spec_id in specs}
+    if not specs:
+        return results
+
+    values = ", ".join(["(%s, %s, %s, %s)"] * len(specs))
+    params = [
+        value
+        for spec_id, (postal_code, first, last) in specs.items()
+        for value in (spec_id, postal_code, first, last)
+    ]
+    # On a replica in the views' read_replica() blocks.
+    using = router.db_for_read(PropertyMonthlyRollup)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT s.id, r.property_type, r.month, r.year,
+                   SUM(r.price_sum)::numeric / SUM(r.price_count)
+            FROM (VALUES {values}) AS s(id, postal_code, first_period, last_period)
+            JOIN {PropertyMonthlyRollup._meta.db_table} AS r
+              ON r.postal_code = s.postal_code
+            WHERE r.property_type = ANY(%s)
+              AND r.year * 100 + r.month BETWEEN s.first_period AND s.last_period
+            GROUP BY 1, 2, 3, 4
+            ORDER BY 1, 4, 3, 2
+            """,
+            params + [list(AVERAGE_PRICE_TYPES)],
+        )
+        for spec_id, property_type, month, year, avg_price in cursor.fetchall():
+            results[spec_id].append(
+                {
+                    "property_type": property_type,
+                    "month": month,
+                    "year": year,
+                    "avg_price": avg_price,
+                }
+            )
+    return results
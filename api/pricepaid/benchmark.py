@@ -0,0 +1,202 @@
+"""
+Latency benchmark of the list endpoints.
+
+query_mix() draws a seeded sequence of requests, postcode, postcode level,
+date range and unfiltered ones, against both endpoints, and replay() sends
+them in process through the whole Django stack (middleware, views,
+rendering), recording the latency, status and database queries of each.
+summarize() turns the samples into a JSON report with latency percentiles,
+throughput and queries per request per scenario, per endpoint and overall,
+and compare() diffs two reports.
+
+The queries are counted on Django's connection, the async views (which
+query through asyncpg) report none.
+"""
+
+import statistics
+import time
+
+import numpy as np
+from common.utils import postal_code_levels
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from .models import POSTAL_LEVELS
+
+ENDPOINTS = {
+    "avg_prices": "/api/v1/properties/avg_prices",
+    "count_transactions": "/api/v1/properties/count_transactions",
+}
+# Longest date range of the average price requests, in years.
+MAX_RANGE_YEARS = 5
+# Latency figures compared by compare().
+COMPARED = ("p50_ms", "p95_ms", "p99_ms", "throughput")
+
+
+def _month(rng, dataset):
+    year = int(rng.integers(dataset.first_year, dataset.last_year + 1))
+    return year, int(rng.integers(1, 13))
+
+
+def _unfiltered(dataset, rng):
+    return {}
+
+
+def _postcode_level(level):
+    index = POSTAL_LEVELS.index(level)
+
+    def params(dataset, rng):
+        value = postal_code_levels(dataset.sample_postal_code(rng))[index]
+        return {f"postal_{level}": value}
+
+    return params
+
+
+def _postcode(dataset, rng):
+    return {"postal_code": dataset.sample_postal_code(rng)}
+
+
+def _date_range(dataset, rng):
+    year, month = _month(rng, dataset)
+    end_year = min(year + int(rng.integers(0, MAX_RANGE_YEARS)), dataset.last_year)
+    return {"from": f"{year}-{month:02}", "to": f"{end_year}-12"}
+
+
+def _date(dataset, rng):
+    year, month = _month(rng, dataset)
+    return {"date": f"{year}-{month:02}"}
+
+
+def _combined(*builders):
+    def params(dataset, rng):
+        combined = {}
+        for builder in builders:
+            combined.update(builder(dataset, rng))
+        return combined
+
+    return params
+
+
+# (endpoint, scenario, weight, parameters builder) of the replayed requests.
+QUERY_MIX = [
+    ("avg_prices", "unfiltered", 1, _unfiltered),
+    ("avg_prices", "postcode", 3, _postcode),
+    ("avg_prices", "district", 2, _postcode_level("district")),
+    ("avg_prices", "date_range", 2, _date_range),
+    ("avg_prices", "postcode_date_range", 2, _combined(_postcode, _date_range)),
+    ("count_transactions", "unfiltered", 1, _unfiltered),
+    ("count_transactions", "postcode", 3, _postcode),
+    ("count_transactions", "sector", 2, _postcode_level("sector")),
+    ("count_transactions", "date", 2, _date),
+    ("count_transactions", "area_date", 1, _combined(_postcode_level("area"), _date)),
+]
+
+
+def query_mix(dataset, count, seed=0):
+    """
+    count (endpoint, scenario, params) requests drawn from QUERY_MIX, the
+    same ones for the same dataset, count and seed.
+    """
+    rng = np.random.default_rng([seed, 2])
+    weights = np.array([weight for _, _, weight, _ in QUERY_MIX], dtype=float)
+    picks = rng.choice(len(QUERY_MIX), size=count, p=weights / weights.sum())
+    requests = []
+    for pick in picks.tolist():
+        endpoint, scenario, _, params = QUERY_MIX[pick]
+        requests.append((endpoint, scenario, params(dataset, rng)))
+    return requests
+
+
+def replay(requests, warmup=0):
+    """
+    Sends the requests one after the other, the first `warmup` ones
+    unrecorded. Returns (samples, elapsed seconds) with a (endpoint,
+    scenario, status, seconds, queries) sample per recorded request.
+    """
+    client = Client(HTTP_HOST="localhost")
+    for endpoint, _, params in requests[:warmup]:
+        client.get(ENDPOINTS[endpoint], params)
+    samples = []
+    began = time.perf_counter()
+    for endpoint, scenario, params in requests[warmup:]:
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = client.get(ENDPOINTS[endpoint], params)
+            seconds = time.perf_counter() - started
+        samples.append(
+            (endpoint, scenario, response.status_code, seconds, len(queries))
+        )
+    return samples, time.perf_counter() - began
+
+
+def summary(samples):
+    """Latency, throughput and query figures of (status, seconds, queries)."""
+    latencies = sorted(seconds for _, seconds, _ in samples)
+    queries = [count for _, _, count in samples]
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    else:
+        quantiles = latencies * 99
+    return {
+        "requests": len(samples),
+        "errors": sum(status != 200 for status, _, _ in samples),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_ms": round(quantiles[94] * 1000, 3),
+        "p99_ms": round(quantiles[98] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        # Sequential requests, the throughput of one busy worker.
+        "throughput": round(len(latencies) / sum(latencies), 3),
+        "queries_per_request": round(statistics.mean(queries), 3),
+        "max_queries": max(queries),
+    }
+
+
+def summarize(samples, elapsed):
+    """The JSON report of replay() samples."""
+    groups = {}
+    for endpoint, scenario, status, seconds, queries in samples:
+        sample = (status, seconds, queries)
+        groups.setdefault(("scenarios", f"{endpoint}/{scenario}"), []).append(sample)
+        groups.setdefault(("endpoints", endpoint), []).append(sample)
+    report = {
+        "overall": dict(
+            summary([sample[2:] for sample in samples]),
+            elapsed_seconds=round(elapsed, 3),
+            throughput=round(len(samples) / elapsed, 3),
+        ),
+        "endpoints": {},
+        "scenarios": {},
+    }
+    for (section, name), group in sorted(groups.items()):
+        report[section][name] = summary(group)
+    return report
+
+
+def compare(baseline, report):
+    """
+    {name: {figure: (baseline, current, change %)}} of the COMPARED figures
+    of the overall, endpoint and scenario summaries in both reports.
+    """
+    def summaries(data):
+        yield "overall", data["overall"]
+        for section in ("endpoints", "scenarios"):
+            yield from data[section].items()
+
+    before = dict(summaries(baseline))
+    changes = {}
+    for name, current in summaries(report):
+        if name not in before:
+            continue
+        changes[name] = {
+            figure: (
+                before[name][figure],
+                current[figure],
+                round((current[figure] / before[name][figure] - 1) * 100, 1)
+                if before[name][figure]
+                else None,
+            )
+            for figure in COMPARED
+        }
+    return changes
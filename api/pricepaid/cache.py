@@ -0,0 +1,158 @@
+"""
+HTTP and server side caching of the list views.
+
+Cached responses are shared by all API workers through the "api" cache
+backend (see CACHES in config/settings.py). Entries and ETags are keyed on
+the dataset generation and the normalized filters, so bumping DatasetVersion
+after an ingest invalidates them all at once.
+"""
+
+import calendar
+import hashlib
+from datetime import datetime
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+from .models import DatasetVersion
+
+CACHE_ALIAS = "api"
+KEY_PREFIX = "pricepaid"
+
+
+def normalized_params(filters):
+    """Canonical query string of the filters, months written as '%Y-%m'."""
+    params = []
+    for name, value in sorted(filters.items()):
+        if isinstance(value, datetime):
+            value = value.strftime("%Y-%m")
+        params.append((name, value))
+    return urlencode(params)
+
+
+def response_cache_key(view_name, generation, filters):
+    return f"{KEY_PREFIX}:{view_name}:{generation}:{normalized_params(filters)}"
+
+
+def count_cache_outcome(view_name, outcome):
+    cache = caches[CACHE_ALIAS]
+    key = f"{KEY_PREFIX}:stats:{view_name}:{outcome}"
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:  # evicted in between
+        cache.set(key, 1, timeout=None)
+
+
+def cache_stats(view_names):
+    """Returns {view_name: {"hits": int, "misses": int}}."""
+    cache = caches[CACHE_ALIAS]
+    return {
+        view_name: {
+            outcome: cache.get(f"{KEY_PREFIX}:stats:{view_name}:{outcome}", 0)
+            for outcome in ("hits", "misses")
+        }
+        for view_name in view_names
+    }
+
+
+def response_etag(view_name, generation, filters):
+    key = response_cache_key(view_name, generation, filters)
+    return quote_etag(hashlib.sha1(key.encode()).hexdigest())
+
+
+def representation(request):
+    """
+    Format of the response and the parameters of its media type, e.g.
+    "json;indent=4", None for plain JSON.
+    """
+    renderer_format = getattr(request.accepted_renderer, "format", "json")
+    media_type = getattr(request, "accepted_media_type", None) or ""
+    params = sorted(
+        "".join(param.split())
+        for param in media_type.split(";")[1:]
+        if param.strip() and not param.strip().startswith("q=")
+    )
+    if renderer_format == "json" and not params:
+        return None
+    return ";".join([renderer_format, *params])
+
+
+def patch_version_headers(response, etag, last_modified):
+    """Sets the ETag, Last-Modified, Vary and Cache-Control headers."""
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    patch_vary_headers(response, ["Accept"])
+    # Browsers revalidate every time, shared caches until the next ingest.
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=0,
+        s_maxage=settings.API_CACHE_CONTROL_S_MAXAGE,
+    )
+
+
+class CachedListMixin:
+    """
+    Versions list() responses by the dataset generation:
+
+    - Responses carry a strong ETag of the generation, normalized filters
+      and representation and the dataset Last-Modified date, and conditional requests are
+      answered with 304 before any queryset is built.
+    - When API_CACHE_ENABLED they are served from the shared response cache.
+
+    Views define cache_name and get_filters(), which returns the normalized
+    filters their queryset depends on. The dataset version of the request
+    is kept as dataset_version.
+    """
+
+    cache_name = None
+    dataset_version = None
+
+    def get_filters(self):
+        raise NotImplementedError
+
+    def list(self, request, *args, **kwargs):
+        version = self.dataset_version = DatasetVersion.current()
+        filters = self.get_filters()
+        # Other representations than plain JSON, e.g. the browsable API or
+        # indented JSON, get their own entries and ETags.
+        renderer_format = representation(request)
+        if renderer_format is not None:
+            filters = {**filters, "format": renderer_format}
+        etag = response_etag(self.cache_name, version.generation, filters)
+        last_modified = calendar.timegm(version.updated_at.utctimetuple())
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            if settings.API_CACHE_ENABLED:
+                key = response_cache_key(self.cache_name, version.generation, filters)
+                response = self.cached_list(key, request, *args, **kwargs)
+            else:
+                response = super().list(request, *args, **kwargs)
+
+        patch_version_headers(response, etag, last_modified)
+        return response
+
+    def cached_list(self, key, request, *args, **kwargs):
+        cache = caches[CACHE_ALIAS]
+        data = cache.get(key)
+        if data is not None:
+            count_cache_outcome(self.cache_name, "hits")
+            return Response(data, headers={"X-Cache": "HIT"})
+
+        response = super().list(request, *args, **kwargs)
+        data = response.data
+        if isinstance(data, list):
+            data = [dict(item) for item in data]
+        cache.set(key, data)
+        count_cache_outcome(self.cache_name, "misses")
+        response["X-Cache"] = "MISS"
+        return response
@@ -0,0 +1,332 @@
+"""
+In-memory column store answering the list endpoints with NumPy.
+
+export_column_store() writes the property rows into .npy column files
+sorted by postcode area, district, sector, postcode and transfer date, so
+that the rows of any postcode filter are one contiguous slice, together
+with a postcode index of those slices. Workers map the files read-only
+(np.load(mmap_mode="r")), so they share one copy in the page cache.
+
+Postgres stays the source of truth: a store is only used while the dataset
+generation it was exported at is current (see current_column_store()).
+
+Layout of <COLUMN_STORE_DIR>/generation-<n>-<suffix>/:
+
+- property_type.npy (int8), price.npy (int32) and month.npy (int16, year *
+  12 + month - 1) with one value per row;
+- offsets.npy (int64): rows of the i-th postcode are offsets[i]:offsets[i + 1];
+- <filter>_values.npy, <filter>_starts.npy and <filter>_ends.npy for each
+  postcode filter: its sorted values and their [start, end) postcode slices;
+- manifest.json: the generation and row count.
+
+<COLUMN_STORE_DIR>/current is a symlink to the latest export.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from decimal import Decimal
+
+import numpy as np
+from common.timing import phase
+from django.conf import settings
+from django.db import connection, transaction
+
+from .batch import AVERAGE_PRICE_TYPES
+from .histogram import (LOWER_OUTLIER_BOUNDARY, UPPER_OUTLIER_BOUNDARY,
+                        bin_rows, bin_width_for)
+from .models import PROPERTY_TYPES, DatasetVersion, Postcode, Property
+
+logger = logging.getLogger(__name__)
+
+ROW_COLUMNS = {"property_type": np.int8, "price": np.int32, "month": np.int16}
+# Postcode dictionary columns of the postcode filters.
+POSTCODE_COLUMNS = ("postal_code", "postal_area", "postal_district", "postal_sector")
+CURRENT = "current"
+# Rows fetched per round trip while exporting.
+EXPORT_CHUNK_SIZE = 100000
+
+_loaded = None
+_loaded_lock = threading.Lock()
+# Last generation a missing export was logged for.
+_missing_generation = None
+
+
+def month_number(year, month):
+    return year * 12 + month - 1
+
+
+def _group_slices(values):
+    """
+    (sorted distinct values, starts, ends) of the runs of equal values of an
+    array in which each value forms a single run.
+    """
+    if len(values) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return values, empty, empty
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    ends = np.r_[starts[1:], len(values)]
+    order = np.argsort(values[starts], kind="stable")
+    return values[starts][order], starts[order], ends[order]
+
+
+def export_column_store(directory=None):
+    """
+    Exports the property rows of the current dataset generation and points
+    the current symlink at them. Older exports are removed, workers still
+    mapping them keep their files until they reload. Returns the store.
+    """
+    directory = directory or settings.COLUMN_STORE_DIR
+    os.makedirs(directory, exist_ok=True)
+    snapshot = not connection.in_atomic_block
+    with transaction.atomic(), connection.cursor() as cursor:
+        if snapshot:
+            # One snapshot for the generation, the rows and the postcodes.
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        generation = DatasetVersion.current().generation
+        # Never overwrites the files of an export workers may be mapping.
+        path = tempfile.mkdtemp(prefix=f"generation-{generation}-", dir=directory)
+        os.chmod(path, 0o755)
+
+        cursor.execute(f"SELECT COUNT(*) FROM {Property._meta.db_table}")
+        rows = cursor.fetchone()[0]
+        columns = {
+            name: np.empty(rows, dtype=dtype) for name, dtype in ROW_COLUMNS.items()
+        }
+        postcode_ids = np.empty(rows, dtype=np.int32)
+        levels = ", ".join(f"d.{name}" for name in POSTCODE_COLUMNS[1:])
+        cursor.execute(
+            f"""
+            DECLARE pricepaid_column_export NO SCROLL CURSOR FOR
+            SELECT p.postcode_id, p.property_type, p.price,
+                   (EXTRACT(YEAR FROM p.transfer_date) * 12
+                    + EXTRACT(MONTH FROM p.transfer_date) - 1)::int
+            FROM {Property._meta.db_table} AS p
+            JOIN {Postcode._meta.db_table} AS d ON d.id = p.postcode_id
+            ORDER BY {levels}, d.postal_code, p.transfer_date
+            """
+        )
+        position = 0
+        while True:
+            cursor.execute(f"FETCH {EXPORT_CHUNK_SIZE} FROM pricepaid_column_export")
+            chunk = cursor.fetchall()
+            if not chunk:
+                break
+            chunk = np.array(chunk, dtype=np.int64).reshape(-1, 4)
+            end = position + len(chunk)
+            postcode_ids[position:end] = chunk[:, 0]
+            for index, name in enumerate(ROW_COLUMNS, start=1):
+                columns[name][position:end] = chunk[:, index]
+            position = end
+        cursor.execute("CLOSE pricepaid_column_export")
+
+        starts = np.flatnonzero(np.r_[True, postcode_ids[1:] != postcode_ids[:-1]])
+        if rows == 0:
+            starts = np.zeros(0, dtype=np.int64)
+        cursor.execute(
+            f"SELECT id, {', '.join(POSTCODE_COLUMNS)} FROM {Postcode._meta.db_table} "
+            "WHERE id = ANY(%s)",
+            [postcode_ids[starts].tolist()],
+        )
+        postcodes = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    for name, values in columns.items():
+        np.save(os.path.join(path, f"{name}.npy"), values)
+    np.save(os.path.join(path, "offsets.npy"), np.r_[starts, rows].astype(np.int64))
+    for index, name in enumerate(POSTCODE_COLUMNS):
+        values = np.array(
+            [postcodes[postcode_id][index] for postcode_id in postcode_ids[starts]],
+            dtype=str,
+        )
+        for suffix, array in zip(("values", "starts", "ends"), _group_slices(values)):
+            np.save(os.path.join(path, f"{name}_{suffix}.npy"), array)
+    with open(os.path.join(path, "manifest.json"), "w") as manifest:
+        json.dump({"generation": generation, "rows": rows}, manifest)
+
+    link = os.path.join(directory, CURRENT)
+    os.symlink(os.path.basename(path), f"{link}.tmp")
+    os.replace(f"{link}.tmp", link)
+    for name in os.listdir(directory):
+        if name.startswith("generation-") and name != os.path.basename(path):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return ColumnStore(path)
+
+
+class ColumnStore:
+    """Memory mapped export, see the module docstring."""
+
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        with open(os.path.join(path, "manifest.json")) as manifest:
+            info = json.load(manifest)
+        self.generation = info["generation"]
+        self.rows = info["rows"]
+        for name in [*ROW_COLUMNS, "offsets"]:
+            setattr(self, name, self._load(name))
+        self.postcode_filters = {
+            name: tuple(
+                self._load(f"{name}_{suffix}")
+                for suffix in ("values", "starts", "ends")
+            )
+            for name in POSTCODE_COLUMNS
+        }
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    def row_slice(self, filters):
+        """Slice of the rows matching the postcode filter of the filters."""
+        for name, (values, starts, ends) in self.postcode_filters.items():
+            if name in filters:
+                index = np.searchsorted(values, filters[name])
+                if index == len(values) or values[index] != filters[name]:
+                    return slice(0, 0)
+                return slice(
+                    int(self.offsets[starts[index]]), int(self.offsets[ends[index]])
+                )
+        return slice(0, self.rows)
+
+    def month_rows(self, filters, first, last):
+        """
+        (property types, prices, months) of the rows matching the postcode
+        filter within the months [first, last], None for no bound.
+        """
+        rows = self.row_slice(filters)
+        types = self.property_type[rows]
+        prices = self.price[rows]
+        months = self.month[rows]
+        if first is None and last is None:
+            return types, prices, months
+        if "postal_code" in filters:
+            # Rows of a single postcode are sorted by date.
+            start = 0 if first is None else np.searchsorted(months, first)
+            end = (
+                len(months) if last is None else np.searchsorted(months, last, "right")
+            )
+            return types[start:end], prices[start:end], months[start:end]
+        mask = np.ones(len(months), dtype=bool)
+        if first is not None:
+            mask &= months >= first
+        if last is not None:
+            mask &= months <= last
+        return types[mask], prices[mask], months[mask]
+
+    def average_prices(self, filters):
+        """
+        (property_type, month, year, avg_price) rows like the average price
+        view's, ordered by year, month and property type.
+        """
+        first = last = None
+        if "from" in filters:
+            first = month_number(filters["from"].year, filters["from"].month)
+            last = month_number(filters["to"].year, filters["to"].month)
+        types, prices, months = self.month_rows(filters, first, last)
+
+        codes = np.array(
+            [PROPERTY_TYPES.index(code) + 1 for code in AVERAGE_PRICE_TYPES]
+        )
+        reported = np.isin(types, codes)
+        types, prices, months = types[reported], prices[reported], months[reported]
+        if len(months) == 0:
+            return []
+
+        # One bin per (month, type), types ordered by their letters.
+        letters = sorted(AVERAGE_PRICE_TYPES)
+        type_ranks = np.zeros(len(PROPERTY_TYPES) + 1, dtype=np.int64)
+        for rank, letter in enumerate(letters):
+            type_ranks[PROPERTY_TYPES.index(letter) + 1] = rank
+        base = int(months.min())
+        keys = (months.astype(np.int64) - base) * len(letters) + type_ranks[types]
+        # Sums stay exact in float64 below 2 ** 53.
+        sums = np.bincount(keys, weights=prices)
+        counts = np.bincount(keys)
+        return [
+            (
+                letters[key % len(letters)],
+                (base + key // len(letters)) % 12 + 1,
+                (base + key // len(letters)) // 12,
+                Decimal(int(sums[key])) / counts[key],
+            )
+            for key in np.flatnonzero(counts).tolist()
+        ]
+
+    def price_histogram(self, filters):
+        """Rows of histogram.price_histogram() with exact outlier bounds."""
+        month = None
+        if "date" in filters:
+            month = month_number(filters["date"].year, filters["date"].month)
+        _, prices, _ = self.month_rows(filters, month, month)
+        count = len(prices)
+        if count == 0:
+            return []
+
+        with phase("quantile"):
+            # percentile_disc(f) is the ceil(f * count)-th smallest price.
+            ranks = [
+                max(int(np.ceil(boundary * count)) - 1, 0)
+                for boundary in (LOWER_OUTLIER_BOUNDARY, UPPER_OUTLIER_BOUNDARY)
+            ]
+            min_price, max_price = (
+                int(price) for price in np.partition(prices, ranks)[ranks]
+            )
+        with phase("binning"):
+            bin_width = bin_width_for(min_price, max_price)
+            indexes = np.minimum(prices, max_price) // bin_width
+            bins = [
+                (index * bin_width, count) for index, count in _bin_counts(indexes)
+            ]
+            return bin_rows(bins, bin_width)
+
+
+def _bin_counts(indexes):
+    """
+    (index, count) of the non-empty bins in index order. Counted from the
+    lowest index, in one counter per bin while there are no more bins than
+    rows, else by sorting: bins 1 wide (equal outlier bounds) of high prices
+    would otherwise take a counter per pound.
+    """
+    lowest = int(indexes.min())
+    if int(indexes.max()) - lowest < len(indexes):
+        counts = np.bincount(indexes - lowest)
+        filled = np.flatnonzero(counts)
+        return zip((filled + lowest).tolist(), counts[filled].tolist())
+    values, counts = np.unique(indexes, return_counts=True)
+    return zip(values.tolist(), counts.tolist())
+
+
+def load_column_store(directory=None):
+    """The current export of the directory, None if there is none."""
+    link = os.path.join(directory or settings.COLUMN_STORE_DIR, CURRENT)
+    if not os.path.exists(link):
+        return None
+    return ColumnStore(os.path.realpath(link))
+
+
+def current_column_store(generation):
+    """
+    The store of the process when the memory engine is selected and its
+    export is of the generation, else None and Postgres answers. A newer
+    export is mapped on the first request after it.
+    """
+    global _loaded, _missing_generation
+    if settings.API_QUERY_ENGINE != "memory":
+        return None
+    link = os.path.join(settings.COLUMN_STORE_DIR, CURRENT)
+    with _loaded_lock:
+        if _loaded is None or _loaded.generation != generation:
+            if os.path.exists(link) and (
+                _loaded is None or os.path.realpath(link) != _loaded.path
+            ):
+                _loaded = load_column_store()
+        if _loaded is not None and _loaded.generation == generation:
+            return _loaded
+        if _missing_generation != generation:
+            _missing_generation = generation
+            logger.warning(
+                "No column store export of generation %s, querying Postgres",
+                generation,
+            )
+        return None
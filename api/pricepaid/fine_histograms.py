@@ -0,0 +1,86 @@
+"""
+Price histograms of the count_transactions endpoint re-bucketed from the
+FinePriceHistogram counts instead of the property rows.
+
+The counts are kept per PRICE_BUCKET_WIDTH wide price bucket, and the bin
+widths of histogram.price_histogram() are multiples of it (DECIMAL_PLACES
+masking). The bin of a price is then a function of its bucket, and given
+the outlier bounds the bin counts are exact. The bucket of each outlier
+bound is also exact, but not the bound itself, which is taken as the lower
+end of its bucket. Bounds which are multiples of PRICE_BUCKET_WIDTH, like
+most Land Registry prices, give the exact histogram. Other bounds can be
+up to PRICE_BUCKET_WIDTH - 1 too low, and the bin width one
+PRICE_BUCKET_WIDTH step off the exact one when (max_price - min_price) /
+(MAX_BIN_COUNT - 1) is within PRICE_BUCKET_WIDTH / (MAX_BIN_COUNT - 1) of a
+multiple of PRICE_BUCKET_WIDTH.
+
+Without counts, or when both bounds fall in the same bucket (the exact bin
+width may then be 1), the histogram is computed from the rows.
+"""
+import math
+
+from django.db import connections, router
+
+from .histogram import (DECIMAL_PLACES, LOWER_OUTLIER_BOUNDARY,
+                        UPPER_OUTLIER_BOUNDARY, bin_rows, bin_width_for)
+from .models import FinePriceHistogram
+from .sketches import merged_buckets_query
+
+PRICE_BUCKET_WIDTH = pow(10, DECIMAL_PLACES)
+
+
+def bucket_key_sql(column):
+    """SQL expression mapping a price column to its bucket key."""
+    return f"({column} / {PRICE_BUCKET_WIDTH})"
+
+
+def merged_counts_query(postal_code=None, year=None, month=None):
+    """
+    (sql, params) merging the counts matching the postcode (all postcodes if
+    None) and month (all months if None) into sorted (key, count) rows.
+    """
+    return merged_buckets_query(postal_code, year, month, FinePriceHistogram)
+
+
+def fine_price_histogram(postal_code=None, year=None, month=None):
+    """
+    Rows of histogram.price_histogram() for the postcode and month re-bucketed
+    from the counts, or None if they cannot be.
+    """
+    using = router.db_for_read(FinePriceHistogram)
+    with connections[using].cursor() as cursor:
+        cursor.execute(*merged_counts_query(postal_code, year, month))
+        return buckets_histogram(cursor.fetchall())
+
+
+def buckets_histogram(buckets):
+    """fine_price_histogram() of sorted (key, count) merged buckets."""
+    count = sum(bucket_count for _, bucket_count in buckets)
+    if count == 0:
+        return None
+
+    # percentile_disc(f) is the ceil(f * count)-th smallest price.
+    ranks = [
+        math.ceil(LOWER_OUTLIER_BOUNDARY * count),
+        math.ceil(UPPER_OUTLIER_BOUNDARY * count),
+    ]
+    bound_keys, seen = [], 0
+    for key, bucket_count in buckets:
+        seen += bucket_count
+        while ranks and ranks[0] <= seen:
+            ranks.pop(0)
+            bound_keys.append(key)
+    min_key, max_key = bound_keys
+    if min_key == max_key:
+        return None
+
+    bin_width = bin_width_for(
+        min_key * PRICE_BUCKET_WIDTH, max_key * PRICE_BUCKET_WIDTH
+    )
+    # Buckets per bin, prices above max_price are counted in its bin.
+    step = bin_width // PRICE_BUCKET_WIDTH
+    bins = {}
+    for key, bucket_count in buckets:
+        bin_floor = min(key, max_key) // step * bin_width
+        bins[bin_floor] = bins.get(bin_floor, 0) + bucket_count
+    return bin_rows(sorted(bins.items()), bin_width)
@@ -0,0 +1,96 @@
+import math
+
+from common.timing import phase
+from django.db.models import Aggregate, Count, F, IntegerField, Value
+from django.db.models.functions import Least
+
+# Bin count is not constant.
+MAX_BIN_COUNT = 8
+# Zeros (i.e. masks) the last DECIMAL_PLACES digits of bin_width
+# to show more clear bin seperations.
+DECIMAL_PLACES = 2
+# Calculate bin_widht according to significant property prices.
+# (max_price - min_price)/bin_count produces very bad histograms.
+LOWER_OUTLIER_BOUNDARY = 0.05
+UPPER_OUTLIER_BOUNDARY = 0.95
+# To represent numbers in packed kilo metric.
+THOUSAND2K = 1000
+
+
+class PercentileDisc(Aggregate):
+    """
+    percentile_disc ordered-set aggregate, i.e. the ceil(fraction * count)-th
+    smallest value of the expression.
+    """
+
+    function = "percentile_disc"
+    template = "%(function)s(%(fraction)s) WITHIN GROUP (ORDER BY %(expressions)s)"
+
+    def __init__(self, expression, fraction, **extra):
+        super().__init__(expression, fraction=float(fraction), **extra)
+
+
+def outlier_bounds(queryset):
+    """
+    Returns (count, min_price, max_price) of the queryset in one statement,
+    where min_price and max_price are the prices at the lower and upper
+    outlier boundaries.
+    """
+    bounds = queryset.aggregate(
+        count=Count("id"),
+        min_price=PercentileDisc("price", LOWER_OUTLIER_BOUNDARY),
+        max_price=PercentileDisc("price", UPPER_OUTLIER_BOUNDARY),
+    )
+    return bounds["count"], bounds["min_price"], bounds["max_price"]
+
+
+def bin_width_for(min_price, max_price):
+    bin_width = (max_price - min_price) / (MAX_BIN_COUNT - 1)
+    mask_digit = pow(10, DECIMAL_PLACES)
+    bin_width = math.ceil(bin_width / mask_digit) * mask_digit
+    return 1 if bin_width == 0 else bin_width  # if max_price == min_price
+
+
+def bin_rows(bins, bin_width):
+    """Formats sorted (bin_floor, bin_size) pairs as response rows."""
+    return [
+        {
+            "bin_range": f"£{bin_floor // THOUSAND2K}k - "
+            f"£{(bin_floor + bin_width) // THOUSAND2K}k",
+            "bin_size": bin_size,
+        }
+        for bin_floor, bin_size in bins
+    ]
+
+
+def price_histogram(queryset, bounds=None):
+    """
+    Histogram of the queryset prices with at most MAX_BIN_COUNT bins between
+    the outlier boundaries. Prices above the upper boundary are counted in
+    the last bin, prices below the lower one in their own bins.
+
+    Runs two statements: outlier_bounds() and a GROUP BY over the bin floors.
+    Precomputed (count, min_price, max_price) bounds skip the first one.
+    """
+    if bounds is None:
+        with phase("quantile"):
+            bounds = outlier_bounds(queryset)
+    count, min_price, max_price = bounds
+    if count == 0:
+        return []
+
+    bin_width = bin_width_for(min_price, max_price)
+
+    # Integer division, so the floors are exact multiples of bin_width.
+    bins = (
+        queryset.annotate(
+            bin_floor=Least(F("price"), Value(max_price), output_field=IntegerField())
+            / Value(bin_width)
+            * Value(bin_width)
+        )
+        .values_list("bin_floor")
+        .annotate(bin_size=Count("id"))
+        .order_by("bin_floor")
+    )
+    with phase("binning"):
+        return bin_rows(bins, bin_width)
@@ -0,0 +1,169 @@
+import json
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from pricepaid.benchmark import COMPARED, compare, query_mix, replay, summarize
+from pricepaid.column_store import export_column_store
+from pricepaid.models import Property
+from pricepaid.synthetic import SyntheticDataset
+
+
+class Command(BaseCommand):
+    help = (
+        "Loads a seeded synthetic dataset into a separate benchmark database "
+        "and replays a mix of postcode, postcode level, date range and "
+        "unfiltered requests against both list endpoints. Writes a JSON report "
+        "of the latency percentiles, throughput and queries per request, and "
+        "compares it with a previous report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--first-year", type=int, default=1995)
+        parser.add_argument("--last-year", type=int, default=2020)
+        parser.add_argument(
+            "--requests", type=int, default=1000, help="Recorded requests."
+        )
+        parser.add_argument(
+            "--warmup", type=int, default=100, help="Unrecorded requests first."
+        )
+        parser.add_argument(
+            "--query-engine",
+            choices=["postgres", "memory"],
+            default=settings.API_QUERY_ENGINE,
+        )
+        parser.add_argument(
+            "--cache", action="store_true", help="Keep the response cache on."
+        )
+        parser.add_argument(
+            "--database",
+            default="pricepaid_benchmark",
+            help="Name of the benchmark database, created from the default one.",
+        )
+        parser.add_argument(
+            "--keepdb",
+            action="store_true",
+            help="Keep the benchmark database, and its dataset for the next run.",
+        )
+        parser.add_argument("--output", help="Report file, defaults to stdout.")
+        parser.add_argument("--compare", help="Report of a previous run.")
+        parser.add_argument(
+            "--max-regression",
+            type=float,
+            help="Fail when a p95 latency grew by more than this percentage.",
+        )
+
+    def handle(self, *args, **options):
+        if options["max_regression"] is not None and not options["compare"]:
+            raise CommandError("--max-regression needs --compare")
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as report:
+                baseline = json.load(report)
+
+        dataset = SyntheticDataset(
+            options["rows"],
+            options["seed"],
+            options["first_year"],
+            options["last_year"],
+        )
+        creation = connection.creation
+        old_name = connection.settings_dict["NAME"]
+        connection.settings_dict["TEST"]["NAME"] = options["database"]
+        creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False, keepdb=options["keepdb"]
+        )
+        try:
+            self.prepare(dataset)
+            report = self.run(dataset, options)
+        finally:
+            creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keepdb"])
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output + "\n")
+        else:
+            self.stdout.write(output)
+        if baseline is not None:
+            self.report_changes(baseline, report, options["max_regression"])
+
+    def log(self, message):
+        # Keeps stdout for the JSON report.
+        self.stderr.write(message, style_func=lambda text: text)
+
+    def prepare(self, dataset):
+        """Loads the dataset unless the database already holds it."""
+        table = Property._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT obj_description(%s::regclass)", [table])
+            if cursor.fetchone()[0] == dataset.signature:
+                self.log(f"Reusing the dataset of {dataset.signature}")
+                return
+        call_command(
+            "generate_data",
+            rows=dataset.rows,
+            seed=dataset.seed,
+            first_year=dataset.first_year,
+            last_year=dataset.last_year,
+            replace=True,
+            stdout=sys.stderr,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"COMMENT ON TABLE {table} IS %s", [dataset.signature])
+
+    def run(self, dataset, options):
+        requests = query_mix(
+            dataset, options["warmup"] + options["requests"], options["seed"]
+        )
+        # Only the default database points at the benchmark one, the
+        # replicas would serve the reads from the real dataset.
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            API_QUERY_ENGINE=options["query_engine"],
+            API_CACHE_ENABLED=options["cache"],
+            COLUMN_STORE_DIR=directory,
+            DB_REPLICAS=[],
+        ):
+            if options["query_engine"] == "memory":
+                export_column_store()
+            samples, elapsed = replay(requests, options["warmup"])
+
+        report = summarize(samples, elapsed)
+        report["dataset"] = dict(
+            json.loads(dataset.signature), postcodes=len(dataset.postal_codes)
+        )
+        report["settings"] = {
+            "query_engine": options["query_engine"],
+            "cache": options["cache"],
+            "quantile_sketch": settings.QUANTILE_SKETCH_ENABLED,
+            "async_views": settings.API_ASYNC_VIEWS,
+            "warmup": options["warmup"],
+        }
+        return report
+
+    def report_changes(self, baseline, report, max_regression):
+        changes = compare(baseline, report)
+        self.log(f"{'':<40}" + "".join(f"{figure:>28}" for figure in COMPARED))
+        regressions = []
+        for name, figures in changes.items():
+            cells = []
+            for figure in COMPARED:
+                before, after, change = figures[figure]
+                change = "n/a" if change is None else f"{change:+.1f}%"
+                cells.append(f"{before:>9} {after:>9} {change:>8}")
+            self.log(f"{name:<40}" + "".join(f"{cell:>28}" for cell in cells))
+            change = figures["p95_ms"][2]
+            if max_regression is not None and change is not None:
+                if change > max_regression:
+                    regressions.append(f"{name} p95 {change:+.1f}%")
+        if regressions:
+            raise CommandError(f"Latency regressions: {', '.join(regressions)}")
+        if max_regression is not None:
+            self.log(f"No p95 latency grew by more than {max_regression}%")
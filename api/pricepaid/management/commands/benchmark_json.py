@@ -0,0 +1,70 @@
+import decimal
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from pricepaid.renderers import FastJSONRenderer, JSONRows
+from pricepaid.serializers import AvgPriceSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmarks rendering avg_prices rows as JSON through "
+        "AvgPriceSerializer and JSONRenderer against JSONRows and "
+        "FastJSONRenderer, and checks that both produce the same bytes. "
+        "No database access."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=100000)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        # Like the rollup averages, numerics with a long fraction.
+        rows = [
+            (
+                random.choice("TDSF"),
+                random.randint(1, 12),
+                random.randint(1995, 2021),
+                decimal.Decimal(random.randint(50000, 1000000))
+                / decimal.Decimal(random.randint(1, 50)),
+            )
+            for _ in range(options["rows"])
+        ]
+        names = list(AvgPriceSerializer().fields)
+
+        def serialized():
+            data = AvgPriceSerializer(
+                [dict(zip(names, row)) for row in rows], many=True
+            ).data
+            return JSONRenderer().render(data)
+
+        def fast():
+            return FastJSONRenderer().render(JSONRows(AvgPriceSerializer, rows))
+
+        if serialized() != fast():
+            raise CommandError("The fast path output differs from the serializers'.")
+
+        timings = {}
+        for name, render in [("serializer", serialized), ("fast", fast)]:
+            timings[name] = min(
+                self.time(render) for _ in range(options["repeat"])
+            )
+            self.stdout.write(
+                f"{name:>10}: {timings[name] * 1000:8.1f} ms "
+                f"({options['rows'] / timings[name]:,.0f} rows/s)"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Same bytes, {timings['serializer'] / timings['fast']:.1f}x faster"
+            )
+        )
+
+    @staticmethod
+    def time(render):
+        started = time.perf_counter()
+        render()
+        return time.perf_counter() - started
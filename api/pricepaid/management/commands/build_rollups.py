@@ -0,0 +1,59 @@
+import time
+
+from common.exceptions import IllegalDateError
+from common.utils import from_year_month_to_datetime
+from django.core.management.base import BaseCommand, CommandError
+
+from pricepaid.models import DatasetVersion
+from pricepaid.rollups import rebuild_monthly_rollups, refresh_affected_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the monthly price rollups backing /properties/avg_prices. "
+        "Run it after each ingest; pass --from/--to to rebuild only the "
+        "months that were loaded, or --affected to refresh the postcode-months "
+        "changed by an incremental ingest."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--from", dest="start", help="First month to rebuild, e.g. 2021-01."
+        )
+        parser.add_argument(
+            "--to", dest="end", help="Last month to rebuild, e.g. 2021-03."
+        )
+        parser.add_argument(
+            "--affected",
+            action="store_true",
+            help="Refresh only the postcode-months recorded by populate_db.py --update.",
+        )
+
+    def handle(self, *args, **options):
+        start, end = options["start"], options["end"]
+        if (start is None) != (end is None):
+            raise CommandError("--from and --to must be given together.")
+        if options["affected"] and start is not None:
+            raise CommandError("--affected cannot be combined with --from/--to.")
+
+        if start is not None:
+            try:
+                start_date = from_year_month_to_datetime(start)
+                end_date = from_year_month_to_datetime(end)
+            except IllegalDateError as error:
+                raise CommandError(str(error))
+            start = (start_date.year, start_date.month)
+            end = (end_date.year, end_date.month)
+
+        began = time.perf_counter()
+        if options["affected"]:
+            refreshed = refresh_affected_rollups()
+            message = f"{refreshed} postcode-months refreshed"
+        else:
+            rebuild_monthly_rollups(start, end)
+            message = "Monthly rollups built"
+        # Invalidates the cached responses computed from the previous data.
+        DatasetVersion.bump()
+        self.stdout.write(
+            self.style.SUCCESS(f"{message} in {time.perf_counter() - began:.1f}s")
+        )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from pricepaid.cache import cache_stats
+from pricepaid.models import DatasetVersion
+from pricepaid.views import PropertyAveragePriceList, PropertyTransactionCountList
+
+
+class Command(BaseCommand):
+    help = "Prints the response cache hit and miss counters of the API views."
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Dataset {DatasetVersion.current()}")
+        views = [PropertyAveragePriceList, PropertyTransactionCountList]
+        stats = cache_stats([view.cache_name for view in views])
+        for view_name, counters in stats.items():
+            total = counters["hits"] + counters["misses"]
+            ratio = counters["hits"] / total if total else 0
+            self.stdout.write(
+                f"{view_name}: {counters['hits']} hits, "
+                f"{counters['misses']} misses ({ratio:.1%} hit ratio)"
+            )
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from pricepaid.column_store import export_column_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports the property rows into the column files answering the list "
+        "endpoints when API_QUERY_ENGINE is memory. Run it after each ingest, "
+        "the files are only used while their dataset generation is current."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dir", help="Directory of the exports, defaults to COLUMN_STORE_DIR."
+        )
+
+    def handle(self, *args, **options):
+        began = time.perf_counter()
+        store = export_column_store(options["dir"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Exported {store.rows} rows of generation {store.generation} "
+                f"to {store.path} in {time.perf_counter() - began:.1f}s"
+            )
+        )
@@ -0,0 +1,79 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from pricepaid.models import (AffectedPeriod, DatasetVersion,
+                              FinePriceHistogram, Postcode,
+                              PriceQuantileSketch, Property,
+                              PropertyMonthlyRollup)
+from pricepaid.rollups import rebuild_monthly_rollups
+from pricepaid.synthetic import CHUNK_SIZE, SyntheticDataset
+
+
+class Command(BaseCommand):
+    help = (
+        "Loads a seeded synthetic price paid dataset with binary COPY, builds "
+        "the rollups and bumps the dataset generation. The same options "
+        "always generate the same rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--first-year", type=int, default=1995)
+        parser.add_argument("--last-year", type=int, default=2020)
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+        parser.add_argument(
+            "--replace",
+            action="store_true",
+            help="Delete the properties, postcodes and rollups first.",
+        )
+
+    def handle(self, *args, **options):
+        dataset = SyntheticDataset(
+            options["rows"],
+            options["seed"],
+            options["first_year"],
+            options["last_year"],
+        )
+        if options["replace"]:
+            tables = [
+                model._meta.db_table
+                for model in (
+                    Property,
+                    Postcode,
+                    PropertyMonthlyRollup,
+                    PriceQuantileSketch,
+                    FinePriceHistogram,
+                    AffectedPeriod,
+                )
+            ]
+            with connection.cursor() as cursor:
+                # TRUNCATE fails while deferred foreign key checks are pending.
+                cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+                cursor.execute(f"TRUNCATE {', '.join(tables)}")
+
+        began = time.perf_counter()
+        loaded = 0
+
+        def on_rows(count):
+            nonlocal loaded
+            loaded += count
+            rate = loaded / (time.perf_counter() - began)
+            self.stdout.write(f"{loaded}/{dataset.rows} rows ({rate:,.0f} rows/s)")
+
+        dataset.load(options["chunk_size"], on_rows=on_rows)
+        load_seconds = time.perf_counter() - began
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Property._meta.db_table}")
+            cursor.execute(f"ANALYZE {Postcode._meta.db_table}")
+        rebuild_monthly_rollups()
+        DatasetVersion.bump()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{dataset.rows} rows of {len(dataset.postal_codes)} postcodes "
+                f"loaded in {load_seconds:.1f}s, rollups built in "
+                f"{time.perf_counter() - began - load_seconds:.1f}s"
+            )
+        )
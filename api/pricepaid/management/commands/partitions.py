@@ -0,0 +1,81 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from pricepaid.models import DatasetVersion
+from pricepaid.partitions import (FIRST_YEAR, attach_year_partition,
+                                  create_year_partitions,
+                                  detach_year_partition,
+                                  rebuild_year_partition, year_partitions)
+from pricepaid.rollups import rebuild_monthly_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Manages the yearly partitions of the property table: list them, "
+        "create the missing ones (moving their rows out of the default "
+        "partition), detach a cold year, attach it back, or rebuild one "
+        "year without touching the others."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action", choices=["list", "create", "detach", "attach", "rebuild"]
+        )
+        parser.add_argument(
+            "years",
+            nargs="*",
+            type=int,
+            help=f"Years to act on, create defaults to {FIRST_YEAR} to this year.",
+        )
+
+    def handle(self, *args, **options):
+        action, years = options["action"], options["years"]
+        if action == "list":
+            self.list_partitions()
+            return
+        if action == "create" and not years:
+            years = range(FIRST_YEAR, datetime.date.today().year + 1)
+        if not years:
+            raise CommandError(f"{action} needs at least one year.")
+
+        partitions = year_partitions()
+        if action != "create":
+            missing = [year for year in years if year not in partitions]
+            if missing:
+                raise CommandError(f"No partition for {missing}.")
+
+        began = time.perf_counter()
+        try:
+            if action == "create":
+                years = create_year_partitions(years)
+            for year in years:
+                if action == "detach":
+                    detach_year_partition(year)
+                elif action == "attach":
+                    attach_year_partition(year)
+                elif action == "rebuild":
+                    rebuild_year_partition(year)
+        except DatabaseError as error:
+            raise CommandError(str(error))
+
+        if action in ("detach", "attach"):
+            # The rows of the years left or joined the table.
+            for year in years:
+                rebuild_monthly_rollups((year, 1), (year, 12))
+            DatasetVersion.bump()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{action}: {', '.join(map(str, years)) or 'nothing to do'} "
+                f"in {time.perf_counter() - began:.1f}s"
+            )
+        )
+
+    def list_partitions(self):
+        for year, (attached, rows, size) in year_partitions().items():
+            state = "attached" if attached else "detached"
+            self.stdout.write(
+                f"{year}: {state}, ~{rows} rows, {size / 2 ** 20:.1f} MiB"
+            )
@@ -0,0 +1,78 @@
+import statistics
+
+from common import slow_queries
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarizes the slow query log: the recorded queries grouped by "
+        "endpoint, parameter shape (the query parameter names of the request) "
+        "and SQL, worst first, with the SQL, parameters and plan of the "
+        "slowest query of each group."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", type=int, default=10, help="Groups shown, worst first."
+        )
+        parser.add_argument("--endpoint", help="Only the queries of this route.")
+        parser.add_argument(
+            "--clear", action="store_true", help="Empty the log afterwards."
+        )
+
+    def handle(self, *args, **options):
+        entries = slow_queries.entries()
+        if options["endpoint"]:
+            entries = [
+                entry for entry in entries if entry["endpoint"] == options["endpoint"]
+            ]
+        groups = {}
+        for entry in entries:
+            key = (entry["endpoint"], entry["shape"], entry["fingerprint"])
+            groups.setdefault(key, []).append(entry)
+        ranked = sorted(
+            groups.values(),
+            key=lambda group: max(entry["duration_ms"] for entry in group),
+            reverse=True,
+        )
+
+        self.stdout.write(
+            f"{len(entries)} queries logged in {settings.SLOW_QUERY_LOG_DIR} "
+            f"({len(groups)} groups)"
+        )
+        for rank, group in enumerate(ranked[: options["limit"]], 1):
+            self.write_group(rank, group)
+
+        if options["clear"]:
+            slow_queries.clear()
+            self.stdout.write("Log cleared")
+
+    def write_group(self, rank, group):
+        worst = max(group, key=lambda entry: entry["duration_ms"])
+        durations = [entry["duration_ms"] for entry in group]
+        reasons = [entry["reason"] for entry in group]
+        self.stdout.write("")
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(
+                f"#{rank} {worst['endpoint']} "
+                f"?{worst['shape'] or '(no parameters)'} "
+                f"query {worst['fingerprint']}"
+            )
+        )
+        self.stdout.write(
+            f"  {len(group)} queries ({reasons.count('slow')} slow, "
+            f"{reasons.count('failed')} failed, {reasons.count('sampled')} sampled), "
+            f"max {max(durations):.1f} ms, median "
+            f"{statistics.median(durations):.1f} ms, last at {group[-1]['time']}"
+        )
+        self.stdout.write(f"  Slowest, ?{worst['query_string']} at {worst['time']}:")
+        self.stdout.write(f"  {' '.join(worst['sql'].split())}")
+        self.stdout.write(f"  Parameters: {worst['params']}")
+        if worst.get("error"):
+            self.stdout.write(f"  Error: {worst['error']}")
+        if worst["plan"] is None:
+            self.stdout.write(f"  No plan: {worst.get('explain_error', 'executemany')}")
+        for line in worst["plan"] or []:
+            self.stdout.write(f"    {line}")
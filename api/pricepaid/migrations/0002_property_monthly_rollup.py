@@ -0,0 +1,29 @@
+# Generated by Django 3.1.7 on 2026-10-17 02:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricepaid', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PropertyMonthlyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('postal_code', models.CharField(max_length=50)),
+                ('property_type', models.CharField(max_length=1)),
+                ('year', models.SmallIntegerField()),
+                ('month', models.SmallIntegerField()),
+                ('price_sum', models.BigIntegerField()),
+                ('price_count', models.IntegerField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='propertymonthlyrollup',
+            constraint=models.UniqueConstraint(fields=('postal_code', 'property_type', 'year', 'month'), name='pricepaid_rollup_key'),
+        ),
+    ]
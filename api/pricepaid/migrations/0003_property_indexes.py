@@ -0,0 +1,35 @@
+from django.contrib.postgres.indexes import BrinIndex
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('pricepaid', '0002_property_monthly_rollup'),
+    ]
+
+    operations = [
+        # Django 3.1 cannot express INCLUDE columns, hence the raw SQL.
+        migrations.RunSQL(
+            sql=(
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS "pricepaid_pc_date_cover_idx" '
+                'ON "pricepaid_property" ("postal_code", "transfer_date") '
+                'INCLUDE ("price", "property_type");'
+            ),
+            reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS "pricepaid_pc_date_cover_idx";',
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='property',
+                    index=models.Index(fields=['postal_code', 'transfer_date'], name='pricepaid_pc_date_cover_idx'),
+                ),
+            ],
+        ),
+        AddIndexConcurrently(
+            model_name='property',
+            index=BrinIndex(fields=['transfer_date'], name='pricepaid_date_brin_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.7 on 2026-10-17 02:40
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricepaid', '0003_property_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceQuantileSketch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('postal_code', models.CharField(max_length=50)),
+                ('year', models.SmallIntegerField()),
+                ('month', models.SmallIntegerField()),
+                ('bucket_keys', django.contrib.postgres.fields.ArrayField(base_field=models.SmallIntegerField(), size=None)),
+                ('bucket_counts', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=None)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pricequantilesketch',
+            constraint=models.UniqueConstraint(fields=('postal_code', 'year', 'month'), name='pricepaid_sketch_key'),
+        ),
+    ]
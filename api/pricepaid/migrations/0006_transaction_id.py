@@ -0,0 +1,56 @@
+# Generated by Django 3.1.7 on 2026-10-17 02:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('pricepaid', '0005_dataset_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AffectedPeriod',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('postal_code', models.CharField(max_length=50)),
+                ('year', models.SmallIntegerField()),
+                ('month', models.SmallIntegerField()),
+            ],
+        ),
+        # The unique index is built concurrently and then attached as the
+        # constraint, so the live table is not locked while it is built.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.AddField(
+                    model_name='property',
+                    name='transaction_id',
+                    field=models.UUIDField(blank=True, null=True),
+                ),
+                migrations.RunSQL(
+                    sql=[
+                        'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "pricepaid_property_transaction_id_key" '
+                        'ON "pricepaid_property" ("transaction_id");',
+                        'ALTER TABLE "pricepaid_property" ADD CONSTRAINT "pricepaid_property_transaction_id_key" '
+                        'UNIQUE USING INDEX "pricepaid_property_transaction_id_key";',
+                    ],
+                    reverse_sql='ALTER TABLE "pricepaid_property" DROP CONSTRAINT IF EXISTS "pricepaid_property_transaction_id_key";',
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='property',
+                    name='transaction_id',
+                    field=models.UUIDField(blank=True, null=True, unique=True),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='affectedperiod',
+            constraint=models.UniqueConstraint(fields=('postal_code', 'year', 'month'), name='pricepaid_affected_key'),
+        ),
+    ]
@@ -0,0 +1,99 @@
+import datetime
+
+from django.db import migrations, models
+
+TABLE = 'pricepaid_property'
+# First year of the price paid data.
+FIRST_YEAR = 1995
+
+INDEXES = [
+    'CREATE INDEX "pricepaid_pc_date_cover_idx" ON "{table}" '
+    '("postal_code", "transfer_date") INCLUDE ("price", "property_type");',
+    'CREATE INDEX "pricepaid_date_brin_idx" ON "{table}" USING brin ("transfer_date");',
+]
+
+
+def _years(cursor, table):
+    cursor.execute(
+        f'SELECT EXTRACT(YEAR FROM MIN(transfer_date))::int, '
+        f'EXTRACT(YEAR FROM MAX(transfer_date))::int FROM "{table}"'
+    )
+    first, last = cursor.fetchone()
+    this_year = datetime.date.today().year
+    return range(min(first or FIRST_YEAR, FIRST_YEAR), max(last or this_year, this_year) + 1)
+
+
+def _swap_tables(schema_editor, partitioned):
+    """
+    Copies the table into a new partitioned (or plain) one and drops the old
+    table, keeping the id sequence. The indexes are built after the copy.
+    """
+    execute = schema_editor.execute
+    old = f'{TABLE}_old'
+    execute(f'ALTER TABLE "{TABLE}" RENAME TO "{old}"')
+    execute(f'ALTER TABLE "{old}" DROP CONSTRAINT "{TABLE}_pkey"')
+    execute(f'ALTER TABLE "{old}" DROP CONSTRAINT IF EXISTS "{TABLE}_transaction_id_key"')
+    execute(f'DROP INDEX IF EXISTS "{TABLE}_transaction_id_idx"')
+    execute('DROP INDEX "pricepaid_pc_date_cover_idx"')
+    execute('DROP INDEX "pricepaid_date_brin_idx"')
+
+    if partitioned:
+        execute(
+            f'CREATE TABLE "{TABLE}" (LIKE "{old}" INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE ("transfer_date")'
+        )
+        with schema_editor.connection.cursor() as cursor:
+            years = _years(cursor, old)
+        for year in years:
+            execute(
+                f'CREATE TABLE "{TABLE}_y{year}" PARTITION OF "{TABLE}" '
+                f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+            )
+        execute(f'CREATE TABLE "{TABLE}_default" PARTITION OF "{TABLE}" DEFAULT')
+    else:
+        execute(f'CREATE TABLE "{TABLE}" (LIKE "{old}" INCLUDING DEFAULTS)')
+    execute(f'INSERT INTO "{TABLE}" SELECT * FROM "{old}"')
+    execute(f'ALTER SEQUENCE "{TABLE}_id_seq" OWNED BY "{TABLE}"."id"')
+    execute(f'DROP TABLE "{old}"')
+
+    if partitioned:
+        # Unique constraints of a partitioned table must include the
+        # partition key, transaction ids are only indexed.
+        execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_pkey" PRIMARY KEY ("id", "transfer_date")')
+        execute(f'CREATE INDEX "{TABLE}_transaction_id_idx" ON "{TABLE}" ("transaction_id")')
+    else:
+        execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_pkey" PRIMARY KEY ("id")')
+        execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_transaction_id_key" UNIQUE ("transaction_id")')
+    for index in INDEXES:
+        execute(index.format(table=TABLE))
+
+
+def partition_property(apps, schema_editor):
+    _swap_tables(schema_editor, partitioned=True)
+
+
+def unpartition_property(apps, schema_editor):
+    _swap_tables(schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricepaid', '0006_transaction_id'),
+    ]
+
+    operations = [
+        # Rewrites the whole table under an exclusive lock.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(partition_property, unpartition_property),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='property',
+                    name='transaction_id',
+                    field=models.UUIDField(blank=True, db_index=True, null=True),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,169 @@
+import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+import pricepaid.models
+
+TABLE = 'pricepaid_property'
+POSTCODE_TABLE = 'pricepaid_postcode'
+# First year of the price paid data.
+FIRST_YEAR = 1995
+# pricepaid.models.PROPERTY_TYPES when the migration was written.
+PROPERTY_TYPES = ('D', 'S', 'T', 'F', 'O')
+PROPERTY_TYPE_ARRAY = f"(ARRAY[{', '.join(repr(code) for code in PROPERTY_TYPES)}]::varchar[])"
+
+# Fixed width columns first, largest alignment first, to avoid padding.
+COMPACT_COLUMNS = f"""
+    "transaction_id" uuid NULL,
+    "id" integer NOT NULL DEFAULT nextval('{TABLE}_id_seq'),
+    "postcode_id" integer NOT NULL,
+    "price" integer NOT NULL,
+    "transfer_date" date NOT NULL,
+    "property_type" smallint NOT NULL
+"""
+COMPACT_SELECT = f"""
+    SELECT p."transaction_id", p."id", d."id", p."price", p."transfer_date"::date,
+           array_position({PROPERTY_TYPE_ARRAY}, p."property_type")
+    FROM "{TABLE}_old" AS p
+    JOIN "{POSTCODE_TABLE}" AS d ON d."postal_code" = p."postal_code"
+"""
+COMPACT_INDEXES = [
+    f'CREATE INDEX "pricepaid_pc_date_cover_idx" ON "{TABLE}" '
+    f'("postcode_id", "transfer_date") INCLUDE ("price", "property_type");',
+    f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_postcode_id_fk" FOREIGN KEY ("postcode_id") '
+    f'REFERENCES "{POSTCODE_TABLE}" ("id") DEFERRABLE INITIALLY DEFERRED;',
+]
+
+WIDE_COLUMNS = f"""
+    "id" integer NOT NULL DEFAULT nextval('{TABLE}_id_seq'),
+    "postal_code" varchar(50) NOT NULL,
+    "property_type" varchar(1) NOT NULL,
+    "price" integer NOT NULL,
+    "transfer_date" timestamp with time zone NOT NULL,
+    "transaction_id" uuid NULL
+"""
+WIDE_SELECT = f"""
+    SELECT p."id", d."postal_code", {PROPERTY_TYPE_ARRAY}[p."property_type"], p."price",
+           p."transfer_date"::timestamp with time zone, p."transaction_id"
+    FROM "{TABLE}_old" AS p
+    JOIN "{POSTCODE_TABLE}" AS d ON d."id" = p."postcode_id"
+"""
+WIDE_INDEXES = [
+    f'CREATE INDEX "pricepaid_pc_date_cover_idx" ON "{TABLE}" '
+    f'("postal_code", "transfer_date") INCLUDE ("price", "property_type");',
+]
+
+
+def _rewrite_table(schema_editor, columns, select, indexes):
+    """
+    Copies the partitioned table into a new one with the given columns,
+    partitioned alike, and drops the old table. The indexes are built after
+    the copy.
+    """
+    execute = schema_editor.execute
+    old = f'{TABLE}_old'
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass',
+            [TABLE],
+        )
+        partitions = [name for name, in cursor.fetchall()]
+        cursor.execute(
+            f'SELECT EXTRACT(YEAR FROM MIN(transfer_date))::int, '
+            f'EXTRACT(YEAR FROM MAX(transfer_date))::int FROM "{TABLE}"'
+        )
+        first, last = cursor.fetchone()
+
+    execute(f'ALTER TABLE "{TABLE}" RENAME TO "{old}"')
+    for partition in partitions:
+        execute(f'ALTER TABLE "{partition}" RENAME TO "{partition}_old"')
+    execute(f'ALTER TABLE "{old}" DROP CONSTRAINT "{TABLE}_pkey"')
+    execute(f'ALTER TABLE "{old}" DROP CONSTRAINT IF EXISTS "{TABLE}_postcode_id_fk"')
+    execute(f'DROP INDEX "{TABLE}_transaction_id_idx"')
+    execute('DROP INDEX "pricepaid_pc_date_cover_idx"')
+    execute('DROP INDEX "pricepaid_date_brin_idx"')
+
+    execute(f'CREATE TABLE "{TABLE}" ({columns}) PARTITION BY RANGE ("transfer_date")')
+    this_year = datetime.date.today().year
+    for year in range(min(first or FIRST_YEAR, FIRST_YEAR), max(last or this_year, this_year) + 1):
+        execute(
+            f'CREATE TABLE "{TABLE}_y{year}" PARTITION OF "{TABLE}" '
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+        )
+    execute(f'CREATE TABLE "{TABLE}_default" PARTITION OF "{TABLE}" DEFAULT')
+    execute(f'INSERT INTO "{TABLE}" {select}')
+    execute(f'ALTER SEQUENCE "{TABLE}_id_seq" OWNED BY "{TABLE}"."id"')
+    execute(f'DROP TABLE "{old}"')
+
+    execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_pkey" PRIMARY KEY ("id", "transfer_date")')
+    execute(f'CREATE INDEX "{TABLE}_transaction_id_idx" ON "{TABLE}" ("transaction_id")')
+    execute(f'CREATE INDEX "pricepaid_date_brin_idx" ON "{TABLE}" USING brin ("transfer_date")')
+    for index in indexes:
+        execute(index)
+    execute(f'ANALYZE "{TABLE}"')
+
+
+def compact_property(apps, schema_editor):
+    schema_editor.execute(
+        f'INSERT INTO "{POSTCODE_TABLE}" ("postal_code") '
+        f'SELECT DISTINCT "postal_code" FROM "{TABLE}" ORDER BY 1'
+    )
+    _rewrite_table(schema_editor, COMPACT_COLUMNS, COMPACT_SELECT, COMPACT_INDEXES)
+
+
+def expand_property(apps, schema_editor):
+    _rewrite_table(schema_editor, WIDE_COLUMNS, WIDE_SELECT, WIDE_INDEXES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricepaid', '0007_partition_property'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Postcode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('postal_code', models.CharField(max_length=50, unique=True)),
+            ],
+        ),
+        # Rewrites the whole table under an exclusive lock.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(compact_property, expand_property),
+            ],
+            state_operations=[
+                migrations.RemoveIndex(
+                    model_name='property',
+                    name='pricepaid_pc_date_cover_idx',
+                ),
+                migrations.RemoveField(
+                    model_name='property',
+                    name='postal_code',
+                ),
+                migrations.AddField(
+                    model_name='property',
+                    name='postcode',
+                    field=models.ForeignKey(db_index=False, default=None, on_delete=django.db.models.deletion.PROTECT, to='pricepaid.postcode'),
+                    preserve_default=False,
+                ),
+                migrations.AlterField(
+                    model_name='property',
+                    name='property_type',
+                    field=pricepaid.models.PropertyTypeField(),
+                ),
+                migrations.AlterField(
+                    model_name='property',
+                    name='transfer_date',
+                    field=models.DateField(),
+                ),
+                migrations.AddIndex(
+                    model_name='property',
+                    index=models.Index(fields=['postcode', 'transfer_date'], name='pricepaid_pc_date_cover_idx'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,57 @@
+from django.db import migrations, models
+
+POSTCODE_TABLE = 'pricepaid_postcode'
+# common.utils.postal_code_levels() in SQL.
+DERIVE_LEVELS = f"""
+    UPDATE "{POSTCODE_TABLE}" AS d
+    SET "postal_area" = substring(l.district FROM '^[A-Z]*'),
+        "postal_district" = l.district,
+        "postal_sector" = rtrim(l.district || ' ' || left(l.inward, 1))
+    FROM (
+        SELECT "id", split_part("postal_code", ' ', 1) AS district,
+               split_part("postal_code", ' ', 2) AS inward
+        FROM "{POSTCODE_TABLE}"
+    ) AS l
+    WHERE l."id" = d."id"
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricepaid', '0008_compact_property'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postcode',
+            name='postal_area',
+            field=models.CharField(default='', max_length=10),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='postcode',
+            name='postal_district',
+            field=models.CharField(default='', max_length=10),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='postcode',
+            name='postal_sector',
+            field=models.CharField(default='', max_length=10),
+            preserve_default=False,
+        ),
+        migrations.RunSQL(DERIVE_LEVELS, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='postcode',
+            index=models.Index(fields=['postal_area'], name='pricepaid_pc_area_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='postcode',
+            index=models.Index(fields=['postal_district'], name='pricepaid_pc_district_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='postcode',
+            index=models.Index(fields=['postal_sector'], name='pricepaid_pc_sector_idx'),
+        ),
+    ]
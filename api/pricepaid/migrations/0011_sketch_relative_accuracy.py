@@ -0,0 +1,19 @@
+# Generated by Django 3.1.7 on 2026-10-17 05:07
+
+from django.db import migrations, models
+import pricepaid.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pricepaid', '0010_fine_price_histogram'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasetversion',
+            name='sketch_relative_accuracy',
+            field=models.FloatField(default=pricepaid.models.configured_sketch_accuracy),
+        ),
+    ]
@@ -1,14 +1,269 @@
+from common.utils import postal_code_levels
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import BrinIndex
 from django.db import models
+from django.utils import timezone
 from django_cte import CTEManager
 
+# Postal code key of the rollup rows which aggregate every postcode.
+ALL_POSTAL_CODES = "*"
+
+# Postcode levels coarser than a postcode ("LS7 1NJ" is in area "LS",
+# district "LS7" and sector "LS7 1"). Their rollup rows are keyed by
+# postal_level_key(), e.g. "district:LS7".
+POSTAL_LEVELS = ("area", "district", "sector")
+
+
+def postal_level_key(level, value):
+    return f"{level}:{value}"
+
+
+# Land Registry property type codes, stored as their position in the tuple
+# (starting from 1). Only ever append to it.
+PROPERTY_TYPES = ("D", "S", "T", "F", "O")
+
+
+def property_type_sql(column):
+    """SQL expression mapping a stored property type column to its code."""
+    codes = ", ".join(f"'{code}'" for code in PROPERTY_TYPES)
+    return f"(ARRAY[{codes}]::varchar[])[{column}]"
+
+
+class PropertyTypeField(models.Field):
+    """Property type code ("D", "S", ...) stored as a smallint."""
+
+    def get_internal_type(self):
+        return "SmallIntegerField"
+
+    def from_db_value(self, value, expression, connection):
+        return self.to_python(value)
+
+    def to_python(self, value):
+        if value is None or value in PROPERTY_TYPES:
+            return value
+        return PROPERTY_TYPES[int(value) - 1]
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        return PROPERTY_TYPES.index(value) + 1
+
+
+class Postcode(models.Model):
+    """
+    Postcode dictionary, properties refer to their postcode by id. The
+    levels of the postcode are derived when it is added, see
+    common.utils.postal_code_levels().
+    """
+
+    postal_code = models.CharField(max_length=50, unique=True)
+    postal_area = models.CharField(max_length=10)
+    postal_district = models.CharField(max_length=10)
+    postal_sector = models.CharField(max_length=10)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["postal_area"], name="pricepaid_pc_area_idx"),
+            models.Index(fields=["postal_district"], name="pricepaid_pc_district_idx"),
+            models.Index(fields=["postal_sector"], name="pricepaid_pc_sector_idx"),
+        ]
+
+    @classmethod
+    def intern(cls, postal_code):
+        return cls.objects.get_or_create(postal_code=postal_code)[0]
+
+    def save(self, *args, **kwargs):
+        (
+            self.postal_area,
+            self.postal_district,
+            self.postal_sector,
+        ) = postal_code_levels(self.postal_code)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.postal_code
+
 
 class Property(models.Model):
+    """
+    Price paid transaction. The table is range partitioned by transfer year
+    (migration 0007, see pricepaid.partitions), so its primary key is
+    (id, transfer_date) in the database.
+    """
+
     objects = CTEManager()
-    postal_code = models.CharField(max_length=50)
-    property_type = models.CharField(max_length=1)
+    # Land Registry "Transaction unique identifier", matches monthly updates.
+    # Not unique in the database: unique constraints of a partitioned table
+    # must include transfer_date.
+    transaction_id = models.UUIDField(null=True, blank=True, db_index=True)
+    # Indexed by the covering index below.
+    postcode = models.ForeignKey(Postcode, models.PROTECT, db_index=False)
+    property_type = PropertyTypeField()
     price = models.IntegerField()
-    transfer_date = models.DateTimeField()
+    transfer_date = models.DateField()
+
+    class Meta:
+        indexes = [
+            # Created with INCLUDE (price, property_type) in migration 0008
+            # so that the filtered aggregations can use index-only scans.
+            models.Index(
+                fields=["postcode", "transfer_date"],
+                name="pricepaid_pc_date_cover_idx",
+            ),
+            BrinIndex(fields=["transfer_date"], name="pricepaid_date_brin_idx"),
+        ]
+
+    @property
+    def postal_code(self):
+        return self.postcode.postal_code
 
     def __str__(self):
         return self.postal_code
+
+
+class PropertyMonthlyRollup(models.Model):
+    """
+    Pre-aggregated price sum and transaction count per
+    (postal_code, property_type, year, month).
+
+    Rows keyed by ALL_POSTAL_CODES hold the totals over all postcodes and
+    rows keyed by postal_level_key() the totals over a postcode area,
+    district or sector.
+    """
+
+    postal_code = models.CharField(max_length=50)
+    property_type = models.CharField(max_length=1)
+    year = models.SmallIntegerField()
+    month = models.SmallIntegerField()
+    price_sum = models.BigIntegerField()
+    price_count = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["postal_code", "property_type", "year", "month"],
+                name="pricepaid_rollup_key",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.postal_code} {self.property_type} {self.year}-{self.month}"
+
+
+class PriceQuantileSketch(models.Model):
+    """
+    Mergeable price quantile sketch per (postal_code, year, month): the
+    transaction counts of the non-empty logarithmic price buckets, see
+    pricepaid.sketches.
+
+    Rows keyed by ALL_POSTAL_CODES hold the sketches over all postcodes and
+    rows keyed by postal_level_key() the sketches over a postcode level.
+    """
+
+    postal_code = models.CharField(max_length=50)
+    year = models.SmallIntegerField()
+    month = models.SmallIntegerField()
+    bucket_keys = ArrayField(models.SmallIntegerField())
+    bucket_counts = ArrayField(models.IntegerField())
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["postal_code", "year", "month"],
+                name="pricepaid_sketch_key",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.postal_code} {self.year}-{self.month}"
+
+
+class FinePriceHistogram(models.Model):
+    """
+    Price histogram per (postal_code, year, month): the transaction counts
+    of the non-empty PRICE_BUCKET_WIDTH wide price buckets, see
+    pricepaid.fine_histograms.
+
+    Rows keyed by ALL_POSTAL_CODES hold the histograms over all postcodes
+    and rows keyed by postal_level_key() the histograms over a postcode
+    level.
+    """
+
+    postal_code = models.CharField(max_length=50)
+    year = models.SmallIntegerField()
+    month = models.SmallIntegerField()
+    bucket_keys = ArrayField(models.IntegerField())
+    bucket_counts = ArrayField(models.IntegerField())
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["postal_code", "year", "month"],
+                name="pricepaid_fine_histogram_key",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.postal_code} {self.year}-{self.month}"
+
+
+class AffectedPeriod(models.Model):
+    """
+    Postcode-month changed by an incremental ingest (populate_db.py
+    --update) whose rollups and sketches are not refreshed yet.
+    """
+
+    postal_code = models.CharField(max_length=50)
+    year = models.SmallIntegerField()
+    month = models.SmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["postal_code", "year", "month"],
+                name="pricepaid_affected_key",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.postal_code} {self.year}-{self.month}"
+
+
+def configured_sketch_accuracy():
+    return settings.QUANTILE_SKETCH_RELATIVE_ACCURACY
+
+
+class DatasetVersion(models.Model):
+    """
+    Generation number of the price paid data, bumped whenever the data
+    changes. Derived responses are only valid for the generation they were
+    computed from.
+
+    sketch_relative_accuracy is the accuracy the price quantile sketches
+    were last fully rebuilt at, which their bucket keys are read and updated
+    with (see pricepaid.sketches).
+    """
+
+    generation = models.BigIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+    sketch_relative_accuracy = models.FloatField(default=configured_sketch_accuracy)
+
+    @classmethod
+    def current(cls):
+        # Read first, get_or_create() would go to the primary database.
+        return (
+            cls.objects.filter(pk=1).first() or cls.objects.get_or_create(pk=1)[0]
+        )
+
+    @classmethod
+    def bump(cls):
+        updated = cls.objects.filter(pk=1).update(
+            generation=models.F("generation") + 1, updated_at=timezone.now()
+        )
+        if not updated:
+            cls.objects.get_or_create(pk=1)
+
+    def __str__(self):
+        return f"generation {self.generation}"
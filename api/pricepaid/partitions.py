@@ -0,0 +1,151 @@
+"""
+Yearly range partitions of the property table.
+
+The table is partitioned by RANGE (transfer_date) with one partition per
+calendar year, named <table>_y<year>, and a default partition holding the
+rows of years without one. Queries filtering on transfer_date only scan
+the partitions of the years they cover.
+
+A detached partition keeps its rows in a plain table of the same name,
+invisible to the API, until it is attached again.
+"""
+import datetime
+import re
+
+from django.db import connection, transaction
+
+from .models import Property
+
+# First year of the price paid data.
+FIRST_YEAR = 1995
+
+
+def _table():
+    return Property._meta.db_table
+
+
+def partition_name(year):
+    return f"{_table()}_y{year}"
+
+
+def default_partition_name():
+    return f"{_table()}_default"
+
+
+def year_bounds(year):
+    """[start, end) transfer dates of the year partition."""
+    return datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)
+
+
+def year_partitions():
+    """
+    Returns {year: (attached, estimated rows, bytes)} of the attached and
+    detached year partitions.
+    """
+    pattern = re.compile(rf"^{re.escape(_table())}_y(\d{{4}})$")
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, i.inhrelid IS NOT NULL, c.reltuples::bigint,
+                   pg_total_relation_size(c.oid)
+            FROM pg_class AS c
+            LEFT JOIN pg_inherits AS i
+                   ON i.inhrelid = c.oid AND i.inhparent = %s::regclass
+            WHERE c.relkind = 'r' AND c.relname LIKE %s
+            """,
+            [_table(), f"{_table()}_y%"],
+        )
+        partitions = {}
+        for name, attached, rows, size in cursor.fetchall():
+            match = pattern.match(name)
+            if match:
+                partitions[int(match.group(1))] = (attached, max(rows, 0), size)
+    return dict(sorted(partitions.items()))
+
+
+def _attach(cursor, name, year):
+    # ALTER TABLE fails while deferred foreign key checks are pending.
+    cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+    # The CHECK constraint spares ATTACH the scan validating the rows.
+    start, end = year_bounds(year)
+    cursor.execute(
+        f"""
+        ALTER TABLE {name} ADD CONSTRAINT {name}_bounds
+        CHECK (transfer_date IS NOT NULL
+               AND transfer_date >= %s AND transfer_date < %s)
+        """,
+        [start, end],
+    )
+    cursor.execute(
+        f"ALTER TABLE {_table()} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+        [start, end],
+    )
+    cursor.execute(f"ALTER TABLE {name} DROP CONSTRAINT {name}_bounds")
+
+
+def create_year_partitions(years):
+    """
+    Creates the missing partitions of the years, moving their rows out of
+    the default partition. Years with a detached partition are skipped.
+    Returns the created years.
+    """
+    existing = year_partitions()
+    created = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for year in sorted(set(years) - set(existing)):
+            name = partition_name(year)
+            start, end = year_bounds(year)
+            cursor.execute(
+                f"CREATE TABLE {name} (LIKE {_table()} INCLUDING DEFAULTS)"
+            )
+            cursor.execute(
+                f"""
+                WITH moved AS (
+                    DELETE FROM {default_partition_name()}
+                    WHERE transfer_date >= %s AND transfer_date < %s
+                    RETURNING *
+                )
+                INSERT INTO {name} SELECT * FROM moved
+                """,
+                [start, end],
+            )
+            _attach(cursor, name, year)
+            created.append(year)
+    return created
+
+
+def detach_year_partition(year):
+    """Detaches the year partition, its rows no longer belong to the table."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE {_table()} DETACH PARTITION {partition_name(year)}"
+        )
+
+
+def attach_year_partition(year):
+    """Attaches a detached year partition back."""
+    with transaction.atomic(), connection.cursor() as cursor:
+        _attach(cursor, partition_name(year), year)
+
+
+def rebuild_year_partition(year):
+    """
+    Rewrites the year partition ordered by (postcode, transfer_date) and
+    rebuilds its indexes. The other partitions are not touched.
+    """
+    name = partition_name(year)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE {name}_rebuild (LIKE {_table()} INCLUDING DEFAULTS)"
+        )
+        cursor.execute(
+            f"""
+            INSERT INTO {name}_rebuild
+            SELECT * FROM {name} ORDER BY postcode_id, transfer_date
+            """
+        )
+        cursor.execute(f"ALTER TABLE {_table()} DETACH PARTITION {name}")
+        cursor.execute(f"DROP TABLE {name}")
+        cursor.execute(f"ALTER TABLE {name}_rebuild RENAME TO {name}")
+        _attach(cursor, name, year)
+        cursor.execute(f"ANALYZE {name}")
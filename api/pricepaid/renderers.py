@@ -0,0 +1,182 @@
+"""
+Renderers skipping the serializers of the list views.
+
+- Columnar renderers (Arrow IPC stream and Parquet): views using
+  ColumnarListMixin hand them a pyarrow Table built column by column from
+  the queryset value tuples. Anything else (error responses) is rendered
+  as JSON.
+- FastJSONRenderer: views using FastJSONListMixin hand it JSONRows, value
+  tuples encoded in one pass by orjson, byte for byte like the serializer
+  and JSONRenderer would.
+"""
+import decimal
+from collections.abc import Sequence
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+from common.timing import phase
+from rest_framework import serializers
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.response import Response
+
+
+def columnar_table(schema, rows):
+    """pyarrow Table of the schema from value tuples in schema order."""
+    columns = list(zip(*rows)) or [[] for _ in schema]
+    return pa.Table.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+class ColumnarRenderer(BaseRenderer):
+    columnar = True
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, pa.Table):
+            response = (renderer_context or {}).get("response")
+            if response is not None:
+                response["Content-Type"] = JSONRenderer.media_type
+            return JSONRenderer().render(data, accepted_media_type, renderer_context)
+        sink = pa.BufferOutputStream()
+        self.write(data, sink)
+        return sink.getvalue().to_pybytes()
+
+    def write(self, table, sink):
+        raise NotImplementedError
+
+
+class ArrowStreamRenderer(ColumnarRenderer):
+    media_type = "application/vnd.apache.arrow.stream"
+    format = "arrow"
+
+    def write(self, table, sink):
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+class ParquetRenderer(ColumnarRenderer):
+    media_type = "application/vnd.apache.parquet"
+    format = "parquet"
+
+    def write(self, table, sink):
+        pq.write_table(table, sink)
+
+
+class ColumnarListMixin:
+    """
+    Answers list() with a pyarrow Table when a columnar renderer was
+    negotiated (Accept header or ?format=arrow|parquet).
+
+    Views define columnar_schema and get_columnar_rows(), which returns the
+    response rows as value tuples in schema order.
+    """
+
+    columnar_schema = None
+
+    def get_columnar_rows(self):
+        raise NotImplementedError
+
+    def list(self, request, *args, **kwargs):
+        if getattr(request.accepted_renderer, "columnar", False):
+            # Runs the queries outside of the serialization phase.
+            rows = list(self.get_columnar_rows())
+            with phase("serialization"):
+                return Response(columnar_table(self.columnar_schema, rows))
+        return super().list(request, *args, **kwargs)
+
+
+class JSONRows(Sequence):
+    """
+    Response rows as value tuples in the order of the serializer fields,
+    read as a sequence of dicts. Decimal fields are formatted like
+    serializers.DecimalField does, the other values are taken as they are.
+    """
+
+    def __init__(self, serializer_class, rows):
+        fields = serializer_class().fields
+        self.names = list(fields)
+        formatters = {
+            index: _decimal_formatter(field)
+            for index, field in enumerate(fields.values())
+            if isinstance(field, serializers.DecimalField)
+        }
+        if formatters:
+            rows = [
+                tuple(
+                    formatters[index](value) if index in formatters else value
+                    for index, value in enumerate(row)
+                )
+                for row in rows
+            ]
+        self.rows = list(rows)
+
+    def __getitem__(self, index):
+        return dict(zip(self.names, self.rows[index]))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence):
+            return self.as_dicts() == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def as_dicts(self):
+        return [dict(zip(self.names, row)) for row in self.rows]
+
+
+def _decimal_formatter(field):
+    """DecimalField.to_representation() for non-null decimal values."""
+    context = decimal.Context(prec=field.max_digits, rounding=field.rounding)
+    exponent = decimal.Decimal(".1") ** field.decimal_places
+
+    def format_decimal(value):
+        return "{:f}".format(value.quantize(exponent, context=context))
+
+    return format_decimal
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer encoding JSONRows with orjson. Indented output and any
+    other data go through JSONRenderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, JSONRows):
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data.as_dicts(), accepted_media_type, renderer_context)
+        # \u2028 and \u2029 are escaped like JSONRenderer does.
+        return (
+            orjson.dumps(data.as_dicts())
+            .replace("\u2028".encode(), b"\\u2028")
+            .replace("\u2029".encode(), b"\\u2029")
+        )
+
+
+class FastJSONListMixin:
+    """
+    Answers JSON list() requests with JSONRows instead of serializing the
+    rows field by field, unless fast_json is False.
+
+    Views define get_json_rows(), which returns the response rows as value
+    tuples in the order of the serializer fields.
+    """
+
+    fast_json = True
+
+    def get_json_rows(self):
+        raise NotImplementedError
+
+    def list(self, request, *args, **kwargs):
+        if self.fast_json and isinstance(request.accepted_renderer, FastJSONRenderer):
+            rows = list(self.get_json_rows())
+            with phase("serialization"):
+                return Response(JSONRows(self.get_serializer_class(), rows))
+        return super().list(request, *args, **kwargs)
@@ -0,0 +1,493 @@
+import datetime
+
+from common.utils import postal_code_levels
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import fine_histograms, sketches
+from .models import (ALL_POSTAL_CODES, POSTAL_LEVELS, AffectedPeriod,
+                     DatasetVersion, FinePriceHistogram, Postcode,
+                     PriceQuantileSketch, Property, PropertyMonthlyRollup,
+                     postal_level_key, property_type_sql)
+
+
+def _property_rows():
+    """
+    Property rows with their postal code and property type code, like the
+    rollups key them. Conditions on the columns are pushed down into it.
+    """
+    return f"""
+        (SELECT d.postal_code, {property_type_sql("p.property_type")} AS property_type,
+                p.price, p.transfer_date
+         FROM {Property._meta.db_table} AS p
+         JOIN {Postcode._meta.db_table} AS d ON d.id = p.postcode_id)
+    """
+
+
+def _tables():
+    return _property_rows(), PropertyMonthlyRollup._meta.db_table
+
+
+def _bucket_counts(sketch_accuracy):
+    """
+    (model, bucket key SQL of a price column) of the bucket counts kept per
+    (postal_code, year, month) along the rollups, the sketches at the
+    accuracy.
+    """
+    return [
+        (
+            PriceQuantileSketch,
+            lambda column: sketches.bucket_key_sql(column, sketch_accuracy),
+        ),
+        (FinePriceHistogram, fine_histograms.bucket_key_sql),
+    ]
+
+
+def _aggregate_keys():
+    """
+    SQL expressions of the keys of the rows aggregating the postcode of a
+    postcode dictionary row d: the national key and one key per level.
+    """
+    return [f"'{ALL_POSTAL_CODES}'"] + [
+        f"'{postal_level_key(level, '')}' || d.postal_{level}"
+        for level in POSTAL_LEVELS
+    ]
+
+
+def aggregate_keys(postal_code):
+    """Keys of the rows aggregating the postcode, see _aggregate_keys()."""
+    return [ALL_POSTAL_CODES] + [
+        postal_level_key(level, value)
+        for level, value in zip(POSTAL_LEVELS, postal_code_levels(postal_code))
+    ]
+
+
+def _month_bounds(start, end):
+    """
+    Returns [first day of start month, first day of the month after end)
+    for (year, month) tuples start and end.
+    """
+    start_date = datetime.date(start[0], start[1], 1)
+    end_year, end_month = end[0] + end[1] // 12, end[1] % 12 + 1
+    stop_date = datetime.date(end_year, end_month, 1)
+    return start_date, stop_date
+
+
+def rebuild_monthly_rollups(start=None, end=None):
+    """
+    Recomputes the monthly rollups, price quantile sketches and fine price
+    histograms from the property table.
+
+    If start and end (inclusive (year, month) tuples) are given only
+    that month range is rebuilt, otherwise the whole table is.
+    """
+    property_table, rollup_table = _tables()
+    postcode_table = Postcode._meta.db_table
+
+    property_filter, property_params = "", []
+    period_filter, period_params = "TRUE", []
+    if start is not None and end is not None:
+        property_filter = "WHERE transfer_date >= %s AND transfer_date < %s"
+        property_params = list(_month_bounds(start, end))
+        period_filter = "(year * 100 + month) BETWEEN %s AND %s"
+        period_params = [start[0] * 100 + start[1], end[0] * 100 + end[1]]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        if start is not None and end is not None:
+            sketch_accuracy = sketches.built_accuracy()
+        else:
+            # Only full rebuilds change the accuracy of the sketches.
+            sketch_accuracy = settings.QUANTILE_SKETCH_RELATIVE_ACCURACY
+            DatasetVersion.current()
+            DatasetVersion.objects.filter(pk=1).update(
+                sketch_relative_accuracy=sketch_accuracy
+            )
+        cursor.execute(
+            f"DELETE FROM {rollup_table} WHERE {period_filter}", period_params
+        )
+        cursor.execute(
+            f"""
+            INSERT INTO {rollup_table}
+                (postal_code, property_type, year, month, price_sum, price_count)
+            SELECT postal_code, property_type,
+                   EXTRACT(YEAR FROM transfer_date), EXTRACT(MONTH FROM transfer_date),
+                   SUM(price), COUNT(*)
+            FROM {property_table} AS p
+            {property_filter}
+            GROUP BY 1, 2, 3, 4
+            """,
+            property_params,
+        )
+        # National and level totals are combined from the postcode rollups
+        # just built.
+        for key in _aggregate_keys():
+            cursor.execute(
+                f"""
+                INSERT INTO {rollup_table}
+                    (postal_code, property_type, year, month, price_sum, price_count)
+                SELECT {key}, r.property_type, r.year, r.month,
+                       SUM(r.price_sum), SUM(r.price_count)
+                FROM {rollup_table} AS r
+                JOIN {postcode_table} AS d ON d.postal_code = r.postal_code
+                WHERE {period_filter}
+                GROUP BY 1, 2, 3, 4
+                """,
+                period_params,
+            )
+        for model, key_sql in _bucket_counts(sketch_accuracy):
+            _rebuild_bucket_counts(
+                cursor,
+                model._meta.db_table,
+                key_sql("price"),
+                property_filter,
+                property_params,
+                period_filter,
+                period_params,
+            )
+        cursor.execute(
+            f"DELETE FROM {AffectedPeriod._meta.db_table} WHERE {period_filter}",
+            period_params,
+        )
+
+
+def _rebuild_bucket_counts(
+    cursor,
+    counts_table,
+    key_sql,
+    property_filter,
+    property_params,
+    period_filter,
+    period_params,
+):
+    property_table = _property_rows()
+    postcode_table = Postcode._meta.db_table
+
+    cursor.execute(f"DELETE FROM {counts_table} WHERE {period_filter}", period_params)
+    cursor.execute(
+        f"""
+        INSERT INTO {counts_table}
+            (postal_code, year, month, bucket_keys, bucket_counts)
+        SELECT postal_code, year, month,
+               array_agg(key ORDER BY key), array_agg(count ORDER BY key)
+        FROM (
+            SELECT postal_code,
+                   EXTRACT(YEAR FROM transfer_date) AS year,
+                   EXTRACT(MONTH FROM transfer_date) AS month,
+                   {key_sql} AS key,
+                   COUNT(*) AS count
+            FROM {property_table} AS p
+            {property_filter}
+            GROUP BY 1, 2, 3, 4
+        ) AS buckets
+        GROUP BY 1, 2, 3
+        """,
+        property_params,
+    )
+    # National and level counts are merged from the postcode counts just
+    # built.
+    for key in _aggregate_keys():
+        cursor.execute(
+            f"""
+            INSERT INTO {counts_table}
+                (postal_code, year, month, bucket_keys, bucket_counts)
+            SELECT postal_code, year, month,
+                   array_agg(key ORDER BY key), array_agg(count ORDER BY key)
+            FROM (
+                SELECT {key} AS postal_code, s.year, s.month, bucket.key,
+                       SUM(bucket.count) AS count
+                FROM {counts_table} AS s
+                JOIN {postcode_table} AS d ON d.postal_code = s.postal_code,
+                     unnest(s.bucket_keys, s.bucket_counts) AS bucket(key, count)
+                WHERE {period_filter}
+                GROUP BY 1, 2, 3, 4
+            ) AS buckets
+            GROUP BY 1, 2, 3
+            """,
+            period_params,
+        )
+
+
+def apply_to_monthly_rollups(postal_code, property_type, transfer_date, price, sign=1):
+    """
+    Adds (sign=1) or removes (sign=-1) a single transaction to the
+    postcode, national and level rollups, sketches and fine price
+    histograms without rescanning the property table.
+    """
+    _, rollup_table = _tables()
+    postal_codes = [postal_code] + aggregate_keys(postal_code)
+    key = [property_type, transfer_date.year, transfer_date.month]
+    delta = [sign * price, sign]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {rollup_table} AS r
+                (postal_code, property_type, year, month, price_sum, price_count)
+            VALUES {", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(postal_codes))}
+            ON CONFLICT (postal_code, property_type, year, month) DO UPDATE
+            SET price_sum = r.price_sum + EXCLUDED.price_sum,
+                price_count = r.price_count + EXCLUDED.price_count
+            """,
+            [value for code in postal_codes for value in [code] + key + delta],
+        )
+        if sign < 0:
+            cursor.execute(
+                f"""
+                DELETE FROM {rollup_table}
+                WHERE postal_code = ANY(%s) AND property_type = %s
+                  AND year = %s AND month = %s AND price_count <= 0
+                """,
+                [postal_codes] + key,
+            )
+
+        for model, key_sql in _bucket_counts(sketches.built_accuracy()):
+            counts_table = model._meta.db_table
+            # The bucket key is computed in SQL, as by the rebuilds.
+            bucket = f"(%s, %s, %s, ARRAY[{key_sql('%s::bigint')}], ARRAY[%s])"
+            cursor.execute(
+                f"""
+                INSERT INTO {counts_table} AS h
+                    (postal_code, year, month, bucket_keys, bucket_counts)
+                VALUES {", ".join([bucket] * len(postal_codes))}
+                ON CONFLICT (postal_code, year, month) DO UPDATE
+                SET (bucket_keys, bucket_counts) = (
+                    SELECT COALESCE(array_agg(key ORDER BY key), '{{}}'),
+                           COALESCE(array_agg(count ORDER BY key), '{{}}')
+                    FROM (
+                        SELECT key, SUM(count)::integer AS count
+                        FROM (
+                            SELECT * FROM unnest(h.bucket_keys, h.bucket_counts)
+                            UNION ALL
+                            SELECT *
+                            FROM unnest(EXCLUDED.bucket_keys, EXCLUDED.bucket_counts)
+                        ) AS buckets(key, count)
+                        GROUP BY key
+                        HAVING SUM(count) > 0
+                    ) AS merged
+                )
+                """,
+                [
+                    value
+                    for code in postal_codes
+                    for value in [code] + key[1:] + [price, sign]
+                ],
+            )
+            if sign < 0:
+                cursor.execute(
+                    f"""
+                    DELETE FROM {counts_table}
+                    WHERE postal_code = ANY(%s) AND year = %s AND month = %s
+                      AND 0 >= ALL(bucket_counts)
+                    """,
+                    [postal_codes] + key[1:],
+                )
+
+
+def refresh_affected_rollups():
+    """
+    Recomputes the rollups, sketches and fine price histograms of the
+    AffectedPeriod postcode-months only, adjusts the national and level rows
+    by the difference and clears the AffectedPeriod rows. Returns the number
+    of refreshed postcode-months.
+    """
+    property_table, rollup_table = _tables()
+    postcode_table = Postcode._meta.db_table
+    affected_table = AffectedPeriod._meta.db_table
+    # Rows of the affected postcode-months.
+    affected_join = """
+        JOIN pricepaid_refresh_affected AS a
+          ON p.postal_code = a.postal_code
+         AND p.transfer_date >= a.period_start
+         AND p.transfer_date < (a.period_start + INTERVAL '1 month')::date
+    """
+    affected_match = """
+        r.postal_code = a.postal_code AND r.year = a.year AND r.month = a.month
+    """
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            """
+            DROP TABLE IF EXISTS pricepaid_refresh_affected,
+                                 pricepaid_refresh_rollup_delta,
+                                 pricepaid_refresh_emptied,
+                                 pricepaid_refresh_bucket_delta;
+            CREATE TEMP TABLE pricepaid_refresh_affected
+                (postal_code varchar(50), year smallint, month smallint,
+                 period_start date);
+            CREATE TEMP TABLE pricepaid_refresh_rollup_delta
+                (postal_code varchar(50), property_type varchar(1),
+                 year smallint, month smallint,
+                 price_sum bigint, price_count integer);
+            CREATE TEMP TABLE pricepaid_refresh_emptied (id integer);
+            CREATE TEMP TABLE pricepaid_refresh_bucket_delta
+                (postal_code varchar(50), year smallint, month smallint,
+                 key integer, count integer);
+            """
+        )
+        cursor.execute(
+            f"""
+            WITH claimed AS (
+                DELETE FROM {affected_table} RETURNING postal_code, year, month
+            )
+            INSERT INTO pricepaid_refresh_affected
+            SELECT DISTINCT postal_code, year, month, make_date(year, month, 1)
+            FROM claimed
+            """
+        )
+        refreshed = cursor.rowcount
+
+        # Postcode rollups, remembering the old and new values as deltas.
+        cursor.execute(
+            f"""
+            WITH old AS (
+                DELETE FROM {rollup_table} AS r
+                USING pricepaid_refresh_affected AS a
+                WHERE {affected_match}
+                RETURNING r.postal_code, r.property_type, r.year, r.month,
+                          r.price_sum, r.price_count
+            )
+            INSERT INTO pricepaid_refresh_rollup_delta
+            SELECT postal_code, property_type, year, month, -price_sum, -price_count
+            FROM old
+            """
+        )
+        cursor.execute(
+            f"""
+            WITH new AS (
+                INSERT INTO {rollup_table}
+                    (postal_code, property_type, year, month, price_sum, price_count)
+                SELECT p.postal_code, p.property_type, a.year, a.month,
+                       SUM(p.price), COUNT(*)
+                FROM {property_table} AS p
+                {affected_join}
+                GROUP BY 1, 2, 3, 4
+                RETURNING postal_code, property_type, year, month,
+                          price_sum, price_count
+            )
+            INSERT INTO pricepaid_refresh_rollup_delta SELECT * FROM new
+            """
+        )
+        for key in _aggregate_keys():
+            cursor.execute(
+                f"""
+                WITH upserted AS (
+                    INSERT INTO {rollup_table} AS r
+                        (postal_code, property_type, year, month,
+                         price_sum, price_count)
+                    SELECT {key}, x.property_type, x.year, x.month,
+                           SUM(x.price_sum), SUM(x.price_count)
+                    FROM pricepaid_refresh_rollup_delta AS x
+                    JOIN {postcode_table} AS d ON d.postal_code = x.postal_code
+                    GROUP BY 1, 2, 3, 4
+                    ON CONFLICT (postal_code, property_type, year, month) DO UPDATE
+                    SET price_sum = r.price_sum + EXCLUDED.price_sum,
+                        price_count = r.price_count + EXCLUDED.price_count
+                    RETURNING r.id, r.price_count
+                )
+                INSERT INTO pricepaid_refresh_emptied
+                SELECT id FROM upserted WHERE price_count <= 0
+                """
+            )
+        cursor.execute(
+            f"""
+            DELETE FROM {rollup_table}
+            WHERE id IN (SELECT id FROM pricepaid_refresh_emptied)
+            """
+        )
+
+        # Postcode sketches and histograms, then the national and level ones
+        # merged with the deltas.
+        for model, key_sql in _bucket_counts(sketches.built_accuracy()):
+            counts_table = model._meta.db_table
+            cursor.execute("TRUNCATE pricepaid_refresh_bucket_delta")
+            cursor.execute(
+                f"""
+                WITH old AS (
+                    DELETE FROM {counts_table} AS r
+                    USING pricepaid_refresh_affected AS a
+                    WHERE {affected_match}
+                    RETURNING r.postal_code, r.year, r.month,
+                              r.bucket_keys, r.bucket_counts
+                )
+                INSERT INTO pricepaid_refresh_bucket_delta
+                SELECT old.postal_code, old.year, old.month,
+                       bucket.key, -bucket.count
+                FROM old,
+                     unnest(old.bucket_keys, old.bucket_counts) AS bucket(key, count)
+                """
+            )
+            cursor.execute(
+                f"""
+                WITH new AS (
+                    INSERT INTO {counts_table}
+                        (postal_code, year, month, bucket_keys, bucket_counts)
+                    SELECT postal_code, year, month,
+                           array_agg(key ORDER BY key), array_agg(count ORDER BY key)
+                    FROM (
+                        SELECT p.postal_code, a.year, a.month,
+                               {key_sql("p.price")} AS key, COUNT(*) AS count
+                        FROM {property_table} AS p
+                        {affected_join}
+                        GROUP BY 1, 2, 3, 4
+                    ) AS buckets
+                    GROUP BY 1, 2, 3
+                    RETURNING postal_code, year, month, bucket_keys, bucket_counts
+                )
+                INSERT INTO pricepaid_refresh_bucket_delta
+                SELECT new.postal_code, new.year, new.month,
+                       bucket.key, bucket.count
+                FROM new,
+                     unnest(new.bucket_keys, new.bucket_counts) AS bucket(key, count)
+                """
+            )
+            for key in _aggregate_keys():
+                cursor.execute(
+                    f"""
+                    WITH delta AS (
+                        SELECT {key} AS postal_code, x.year, x.month, x.key, x.count
+                        FROM pricepaid_refresh_bucket_delta AS x
+                        JOIN {postcode_table} AS d ON d.postal_code = x.postal_code
+                    ),
+                    targets AS (
+                        SELECT DISTINCT postal_code, year, month FROM delta
+                    ),
+                    old AS (
+                        DELETE FROM {counts_table} AS s
+                        USING targets AS t
+                        WHERE s.postal_code = t.postal_code
+                          AND s.year = t.year AND s.month = t.month
+                        RETURNING s.postal_code, s.year, s.month,
+                                  s.bucket_keys, s.bucket_counts
+                    ),
+                    merged AS (
+                        SELECT postal_code, year, month, key, SUM(count) AS count
+                        FROM (
+                            SELECT old.postal_code, old.year, old.month,
+                                   bucket.key, bucket.count
+                            FROM old,
+                                 unnest(old.bucket_keys, old.bucket_counts)
+                                     AS bucket(key, count)
+                            UNION ALL
+                            SELECT postal_code, year, month, key, count FROM delta
+                        ) AS buckets
+                        GROUP BY 1, 2, 3, 4
+                        HAVING SUM(count) > 0
+                    )
+                    INSERT INTO {counts_table}
+                        (postal_code, year, month, bucket_keys, bucket_counts)
+                    SELECT postal_code, year, month,
+                           array_agg(key ORDER BY key), array_agg(count ORDER BY key)
+                    FROM merged
+                    GROUP BY 1, 2, 3
+                    """
+                )
+
+        cursor.execute(
+            """
+            DROP TABLE pricepaid_refresh_affected,
+                       pricepaid_refresh_rollup_delta,
+                       pricepaid_refresh_emptied,
+                       pricepaid_refresh_bucket_delta
+            """
+        )
+    return refreshed
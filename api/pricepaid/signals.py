@@ -0,0 +1,38 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import DatasetVersion, Property
+from .rollups import apply_to_monthly_rollups
+
+
+def _apply(instance, sign):
+    apply_to_monthly_rollups(
+        instance.postal_code,
+        instance.property_type,
+        instance.transfer_date,
+        instance.price,
+        sign=sign,
+    )
+
+
+@receiver(pre_save, sender=Property)
+def remove_previous_from_rollups(sender, instance, raw=False, **kwargs):
+    """Takes the stored version of an updated row out of the rollups."""
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    previous = sender.objects.select_related("postcode").filter(pk=instance.pk).first()
+    if previous is not None:
+        _apply(previous, sign=-1)
+
+
+@receiver(post_save, sender=Property)
+def add_to_rollups(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _apply(instance, sign=1)
+        DatasetVersion.bump()
+
+
+@receiver(post_delete, sender=Property)
+def remove_from_rollups(sender, instance, **kwargs):
+    _apply(instance, sign=-1)
+    DatasetVersion.bump()
@@ -0,0 +1,133 @@
+"""
+Mergeable quantile sketches of property prices.
+
+A sketch counts the prices falling in logarithmic buckets
+(gamma^(key - 1), gamma^key] with gamma = (1 + accuracy) / (1 - accuracy).
+Reporting 2 * gamma^key / (gamma + 1) for a bucket is then within the
+relative accuracy of any price in it, whatever the number of rows, and two
+sketches merge exactly by adding their counts per key.
+
+QUANTILE_SKETCH_RELATIVE_ACCURACY is the accuracy of full rebuilds, stored
+in DatasetVersion.sketch_relative_accuracy. The sketches are read, updated
+and partially rebuilt at the stored accuracy, so that keys of different
+accuracies are never mixed until the next full rebuild.
+"""
+import math
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+
+from .histogram import LOWER_OUTLIER_BOUNDARY, UPPER_OUTLIER_BOUNDARY
+from .models import ALL_POSTAL_CODES, DatasetVersion, PriceQuantileSketch
+
+# Bucket keys are smallints, prices integers.
+MAX_BUCKET_KEY = 2 ** 15 - 1
+MAX_PRICE = 2 ** 31 - 1
+
+
+def sketch_gamma(accuracy=None):
+    if accuracy is None:
+        accuracy = settings.QUANTILE_SKETCH_RELATIVE_ACCURACY
+    return (1 + accuracy) / (1 - accuracy)
+
+
+def check_accuracy(accuracy):
+    """
+    Raises ImproperlyConfigured unless the accuracy is in (0, 1) and the
+    bucket key of any price fits in the sketches.
+    """
+    if not 0 < accuracy < 1:
+        raise ImproperlyConfigured(
+            "QUANTILE_SKETCH_RELATIVE_ACCURACY should be between 0 and 1"
+        )
+    if math.log(MAX_PRICE) / math.log(sketch_gamma(accuracy)) > MAX_BUCKET_KEY:
+        gamma = math.exp(math.log(MAX_PRICE) / MAX_BUCKET_KEY)
+        raise ImproperlyConfigured(
+            "QUANTILE_SKETCH_RELATIVE_ACCURACY should be at least "
+            f"{(gamma - 1) / (gamma + 1):.6f}"
+        )
+
+
+def built_accuracy():
+    """Relative accuracy the stored sketches were built at."""
+    return DatasetVersion.current().sketch_relative_accuracy
+
+
+def bucket_key_sql(column, accuracy=None):
+    """SQL expression mapping a price column to its sketch bucket key."""
+    return f"CEIL(LN(GREATEST({column}, 1)) / {math.log(sketch_gamma(accuracy))!r})"
+
+
+def bucket_value(key, accuracy=None):
+    gamma = sketch_gamma(accuracy)
+    return round(2 * gamma ** key / (gamma + 1))
+
+
+def merged_buckets_query(postal_code=None, year=None, month=None, model=None):
+    """
+    (sql, params) merging the sketches matching the postcode (all postcodes
+    if None) and month (all months if None) into sorted (key, count) rows.
+    model is PriceQuantileSketch by default, or another model with the same
+    fields, e.g. FinePriceHistogram.
+    """
+    if model is None:
+        model = PriceQuantileSketch
+    if postal_code is None:
+        postal_code = ALL_POSTAL_CODES
+    conditions, params = ["postal_code = %s"], [postal_code]
+    if year is not None and month is not None:
+        conditions.append("year = %s AND month = %s")
+        params.extend([year, month])
+
+    sql = f"""
+        SELECT bucket.key, SUM(bucket.count)
+        FROM {model._meta.db_table},
+             unnest(bucket_keys, bucket_counts) AS bucket(key, count)
+        WHERE {" AND ".join(conditions)}
+        GROUP BY bucket.key
+        ORDER BY bucket.key
+    """
+    return sql, params
+
+
+def merged_buckets(postal_code=None, year=None, month=None):
+    """
+    Merges the sketches matching the postcode (all postcodes if None) and
+    month (all months if None) into sorted (key, count) pairs.
+    """
+    using = router.db_for_read(PriceQuantileSketch)
+    with connections[using].cursor() as cursor:
+        cursor.execute(*merged_buckets_query(postal_code, year, month))
+        return cursor.fetchall()
+
+
+def sketch_outlier_bounds(postal_code=None, year=None, month=None, accuracy=None):
+    """
+    Approximate counterpart of histogram.outlier_bounds() read from the
+    sketches: (count, min_price, max_price), or None if no sketch matches.
+    accuracy is the one they were built at, by default read from the
+    DatasetVersion.
+    """
+    if accuracy is None:
+        accuracy = built_accuracy()
+    return buckets_outlier_bounds(merged_buckets(postal_code, year, month), accuracy)
+
+
+def buckets_outlier_bounds(buckets, accuracy):
+    """sketch_outlier_bounds() of sorted (key, count) merged buckets."""
+    count = sum(bucket_count for _, bucket_count in buckets)
+    if count == 0:
+        return None
+
+    ranks = [
+        math.ceil(LOWER_OUTLIER_BOUNDARY * count),
+        math.ceil(UPPER_OUTLIER_BOUNDARY * count),
+    ]
+    prices, seen = [], 0
+    for key, bucket_count in buckets:
+        seen += bucket_count
+        while ranks and ranks[0] <= seen:
+            ranks.pop(0)
+            prices.append(bucket_value(key, accuracy))
+    return count, prices[0], prices[1]
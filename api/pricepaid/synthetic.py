@@ -0,0 +1,436 @@
+"""
+Deterministic synthetic price paid dataset.
+
+SyntheticDataset(rows, seed) describes the same rows on every run: a
+postcode dictionary shaped like the UK one (areas of very different sizes,
+about ten sectors per district and up to 150 postcodes per sector) and
+transactions whose postcode popularity, property type mix, yearly volumes
+and log-normal prices (by area, postcode, type and year) look like the
+Land Registry data. Rows are generated in blocks, each from its own seeded
+generator, and loaded with binary COPY, so that tens of millions of rows
+never need to fit in memory.
+
+ExpectedAggregates(dataset) computes the averages and price distributions
+the API should answer from the same chunks, for tests to check responses
+against without keeping the rows.
+"""
+
+import datetime
+import io
+import json
+import math
+
+import numpy as np
+from common.utils import postal_code_levels
+from django.db import connection, transaction
+
+from .models import POSTAL_LEVELS, PROPERTY_TYPES, Postcode, Property
+
+# Postcode areas, the London ones are the pricier ones.
+AREAS = (
+    "AB AL B BA BB BD BH BL BN BR BS BT CA CB CF CH CM CO CR CT CV CW DA DD "
+    "DE DG DH DL DN DT DY E EC EH EN EX FK FY G GL GU HA HD HG HP HR HS HU "
+    "HX IG IP IV KA KT KW KY L LA LD LE LL LN LS LU M ME MK ML N NE NG NN NP "
+    "NR NW OL OX PA PE PH PL PO PR RG RH RM S SA SE SG SK SL SM SN SO SP SR "
+    "SS ST SW SY TA TD TF TN TQ TR TS TW UB W WA WC WD WF WN WR WS WV YO"
+).split()
+LONDON_AREAS = {"E", "EC", "N", "NW", "SE", "SW", "W", "WC"}
+# Letters of the unit part of a postcode ("NJ" of "LS7 1NJ").
+UNIT_LETTERS = "ABDEFGHJLNPQRSTUWXYZ"
+POSTCODES_PER_SECTOR = 150
+# Transactions per postcode over 1995-2020 in the Land Registry data.
+ROWS_PER_POSTCODE = 18
+
+# Share of the transactions and price multiplier of each property type.
+PROPERTY_TYPE_SHARES = {"D": 0.23, "S": 0.27, "T": 0.29, "F": 0.18, "O": 0.03}
+PROPERTY_TYPE_PRICES = {"D": 1.6, "S": 1.0, "T": 0.85, "F": 0.8, "O": 1.3}
+# Relative yearly volumes, the slump after 2007 included.
+YEAR_VOLUMES = {
+    1995: 0.75, 1996: 0.9, 1997: 1.0, 1998: 1.0, 1999: 1.1, 2000: 1.05,
+    2001: 1.15, 2002: 1.25, 2003: 1.15, 2004: 1.2, 2005: 1.05, 2006: 1.25,
+    2007: 1.2, 2008: 0.65, 2009: 0.6, 2010: 0.65, 2011: 0.65, 2012: 0.65,
+    2013: 0.75, 2014: 0.9, 2015: 0.95, 2016: 0.95, 2017: 0.95, 2018: 0.95,
+    2019: 0.9, 2020: 0.8,
+}
+# More sales in summer than in winter.
+MONTH_VOLUMES = (0.75, 0.75, 0.9, 0.9, 1.0, 1.1, 1.2, 1.15, 1.05, 1.05, 1.0, 1.15)
+MEDIAN_PRICE_1995 = 55000
+YEARLY_PRICE_GROWTH = 0.06
+PRICE_SIGMA = 0.45
+MIN_PRICE = 1000
+
+CHUNK_SIZE = 1000000
+# Rows generated from one seeded generator.
+BLOCK_SIZE = 65536
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + b"\x00" * 8
+PGCOPY_TRAILER = b"\xff\xff"
+PG_EPOCH_ORDINAL = datetime.date(2000, 1, 1).toordinal()
+# Binary COPY tuple of (postcode_id, price, transfer_date, property_type):
+# the field count, then the byte length and value of each field.
+COPY_COLUMNS = ("postcode_id", "price", "transfer_date", "property_type")
+COPY_ROW = np.dtype(
+    [
+        ("fields", ">i2"),
+        ("postcode_id_size", ">i4"),
+        ("postcode_id", ">i4"),
+        ("price_size", ">i4"),
+        ("price", ">i4"),
+        ("transfer_date_size", ">i4"),
+        ("transfer_date", ">i4"),
+        ("property_type_size", ">i4"),
+        ("property_type", ">i2"),
+    ]
+)
+
+
+def unit_code(number):
+    """Unit letters of the number-th unit of a sector, e.g. 0 -> "AA"."""
+    first, second = divmod(number, len(UNIT_LETTERS))
+    return UNIT_LETTERS[first] + UNIT_LETTERS[second]
+
+
+class SyntheticDataset:
+    """
+    Seeded description of `rows` transactions from first_year to last_year,
+    see the module docstring. postal_codes and property_types restrict the
+    rows to the given postcodes and property type codes.
+    """
+
+    def __init__(
+        self,
+        rows,
+        seed=0,
+        first_year=1995,
+        last_year=2020,
+        postal_codes=None,
+        property_types=None,
+    ):
+        if first_year > last_year:
+            raise ValueError("first_year must not be after last_year")
+        self.rows = rows
+        self.seed = seed
+        self.first_year = first_year
+        self.last_year = last_year
+        self.property_types = tuple(property_types or PROPERTY_TYPES)
+        self._given_postal_codes = postal_codes is not None
+        rng = np.random.default_rng([seed, 0])
+
+        # A few areas are much larger than the others.
+        area_weights = rng.lognormal(0, 0.8, len(AREAS))
+        area_prices = {
+            area: price * (2.2 if area in LONDON_AREAS else 1)
+            for area, price in zip(AREAS, rng.lognormal(0, 0.25, len(AREAS)))
+        }
+        # Units are numbered in a scattered order, not AA, AB, AD...
+        units = rng.permutation(len(UNIT_LETTERS) ** 2)[:POSTCODES_PER_SECTOR]
+
+        if postal_codes is None:
+            postcode_count = max(1, math.ceil(rows / ROWS_PER_POSTCODE))
+            area_sizes = np.maximum(
+                1, np.round(area_weights / area_weights.sum() * postcode_count)
+            ).astype(np.int64)
+            postal_codes = []
+            for area, size in zip(AREAS, area_sizes.tolist()):
+                for number in range(size):
+                    sector, unit = divmod(number, POSTCODES_PER_SECTOR)
+                    district, sector = divmod(sector, 10)
+                    postal_codes.append(
+                        f"{area}{district + 1} {sector}{unit_code(units[unit])}"
+                    )
+        self.postal_codes = list(postal_codes)
+        self.postcode_levels = [
+            postal_code_levels(postal_code) for postal_code in self.postal_codes
+        ]
+        # Postcode popularity is skewed, a few see many transactions.
+        popularity = rng.lognormal(0, 1.0, len(self.postal_codes))
+        self.postcode_weights = popularity / popularity.sum()
+        self._postcode_cdf = np.cumsum(self.postcode_weights)
+        self._postcode_prices = np.array(
+            [area_prices.get(area, 1.0) for area, _, _ in self.postcode_levels]
+        ) * rng.lognormal(0, 0.2, len(self.postal_codes))
+
+        self.months = np.array(
+            [
+                year * 12 + month
+                for year in range(first_year, last_year + 1)
+                for month in range(12)
+            ]
+        )
+        month_weights = np.array(
+            [
+                YEAR_VOLUMES.get(month // 12, 1.0) * MONTH_VOLUMES[month % 12]
+                for month in self.months
+            ]
+        )
+        self._month_cdf = np.cumsum(month_weights / month_weights.sum())
+        # Ordinals of the first day of each month and of the month after.
+        self._first_days = np.array(
+            [
+                datetime.date(month // 12, month % 12 + 1, 1).toordinal()
+                for month in range(self.months[0], self.months[-1] + 2)
+            ]
+        )
+        type_shares = np.array(
+            [PROPERTY_TYPE_SHARES[code] for code in self.property_types]
+        )
+        self._type_cdf = np.cumsum(type_shares / type_shares.sum())
+        # Stored codes (1-5) and price multipliers of the property types.
+        self._type_codes = np.array(
+            [PROPERTY_TYPES.index(code) + 1 for code in self.property_types]
+        )
+        self._type_prices = np.array(
+            [PROPERTY_TYPE_PRICES[code] for code in self.property_types]
+        )
+
+    @property
+    def signature(self):
+        """JSON text telling the dataset apart from other ones."""
+        signature = {
+            "rows": self.rows,
+            "seed": self.seed,
+            "first_year": self.first_year,
+            "last_year": self.last_year,
+        }
+        if self.property_types != PROPERTY_TYPES:
+            signature["property_types"] = self.property_types
+        if self._given_postal_codes:
+            signature["postal_codes"] = self.postal_codes
+        return json.dumps(signature, sort_keys=True)
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """
+        Yields the rows in chunks of (postcode indexes, property type codes
+        1-5, prices, transfer date ordinals) arrays. The rows do not depend
+        on chunk_size.
+        """
+        pending, pending_rows = [], 0
+        for number, start in enumerate(range(0, self.rows, BLOCK_SIZE)):
+            block = self._block(number, min(BLOCK_SIZE, self.rows - start))
+            pending.append(block)
+            pending_rows += len(block[0])
+            while pending_rows >= chunk_size:
+                columns = [np.concatenate(column) for column in zip(*pending)]
+                yield tuple(column[:chunk_size] for column in columns)
+                pending = [tuple(column[chunk_size:] for column in columns)]
+                pending_rows -= chunk_size
+        if pending_rows:
+            yield tuple(np.concatenate(column) for column in zip(*pending))
+
+    def _block(self, number, size):
+        """Rows of the number-th block, each seeded on its own."""
+        rng = np.random.default_rng([self.seed, 1, number])
+        postcodes = np.minimum(
+            np.searchsorted(self._postcode_cdf, rng.random(size)),
+            len(self.postal_codes) - 1,
+        )
+        types = np.minimum(
+            np.searchsorted(self._type_cdf, rng.random(size)),
+            len(self.property_types) - 1,
+        )
+        months = self.months[
+            np.minimum(
+                np.searchsorted(self._month_cdf, rng.random(size)),
+                len(self.months) - 1,
+            )
+        ]
+        years = months // 12
+        month_starts = self._first_days[months - self.months[0]]
+        month_lengths = self._first_days[months - self.months[0] + 1] - month_starts
+        days = month_starts + (rng.random(size) * month_lengths).astype(np.int64)
+
+        medians = (
+            MEDIAN_PRICE_1995
+            * self._postcode_prices[postcodes]
+            * self._type_prices[types]
+            * np.exp(YEARLY_PRICE_GROWTH * (years - 1995))
+        )
+        prices = medians * rng.lognormal(0, PRICE_SIGMA, size)
+        # Prices are mostly round figures.
+        prices = np.clip(np.round(prices / 250) * 250, MIN_PRICE, 2 ** 31 - 1)
+        return postcodes, self._type_codes[types], prices.astype(np.int64), days
+
+    def load(self, chunk_size=CHUNK_SIZE, on_rows=None):
+        """
+        Adds the postcodes and the rows to the database with binary COPY.
+        on_rows(count) is called after each chunk. Returns the row count.
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            postcode_ids = self._load_postcodes(cursor)
+            loaded = 0
+            for postcodes, types, prices, days in self.chunks(chunk_size):
+                data = np.zeros(len(postcodes), dtype=COPY_ROW)
+                data["fields"] = len(COPY_COLUMNS)
+                data["postcode_id_size"] = data["price_size"] = 4
+                data["transfer_date_size"] = 4
+                data["property_type_size"] = 2
+                data["postcode_id"] = postcode_ids[postcodes]
+                data["price"] = prices
+                data["transfer_date"] = days - PG_EPOCH_ORDINAL
+                data["property_type"] = types
+                cursor.copy_expert(
+                    f"COPY {Property._meta.db_table} ({', '.join(COPY_COLUMNS)}) "
+                    "FROM STDIN WITH (FORMAT binary)",
+                    io.BytesIO(PGCOPY_HEADER + data.tobytes() + PGCOPY_TRAILER),
+                )
+                loaded += len(postcodes)
+                if on_rows:
+                    on_rows(len(postcodes))
+        return loaded
+
+    def _load_postcodes(self, cursor):
+        """Adds the postcodes, returns their ids by postcode index."""
+        table = Postcode._meta.db_table
+        cursor.execute(
+            "CREATE TEMP TABLE pricepaid_synthetic_postcodes "
+            "(number integer, postal_code varchar(50)) ON COMMIT DROP"
+        )
+        cursor.copy_expert(
+            "COPY pricepaid_synthetic_postcodes FROM STDIN",
+            io.StringIO(
+                "".join(
+                    f"{number}\t{postal_code}\n"
+                    for number, postal_code in enumerate(self.postal_codes)
+                )
+            ),
+        )
+        # Levels derived like common.utils.postal_code_levels().
+        cursor.execute(
+            f"""
+            INSERT INTO {table}
+                (postal_code, postal_area, postal_district, postal_sector)
+            SELECT postal_code, substring(district FROM '^[A-Z]*'), district,
+                   rtrim(district || ' ' || left(inward, 1))
+            FROM (
+                SELECT postal_code, split_part(postal_code, ' ', 1) AS district,
+                       split_part(postal_code, ' ', 2) AS inward
+                FROM pricepaid_synthetic_postcodes
+            ) AS new_postcodes
+            ORDER BY 1
+            ON CONFLICT DO NOTHING
+            """
+        )
+        cursor.execute(
+            f"""
+            SELECT d.id FROM pricepaid_synthetic_postcodes AS s
+            JOIN {table} AS d ON d.postal_code = s.postal_code
+            ORDER BY s.number
+            """
+        )
+        return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+    def sample_postal_code(self, rng):
+        """A postcode picked by popularity, like a user looking one up."""
+        index = min(
+            int(np.searchsorted(self._postcode_cdf, rng.random())),
+            len(self.postal_codes) - 1,
+        )
+        return self.postal_codes[index]
+
+
+class ExpectedAggregates:
+    """
+    What the API should answer for a SyntheticDataset, aggregated from its
+    chunks without the database: the price sum and count per (postcode,
+    property type, month) and the count of each price per (postcode,
+    month). It grows with the distinct groups and prices, not the rows.
+    """
+
+    # Prices are below 2 ** 31, keys below are (group << PRICE_BITS) | price.
+    PRICE_BITS = 31
+
+    def __init__(self, dataset, chunk_size=CHUNK_SIZE):
+        self.dataset = dataset
+        self._months = len(dataset.months)
+        self._types = len(PROPERTY_TYPES) + 1
+        total_keys, sums, counts, price_keys, price_counts = [], [], [], [], []
+        for postcodes, types, prices, days in dataset.chunks(chunk_size):
+            months = np.searchsorted(dataset._first_days, days, "right") - 1
+            keys, inverse = np.unique(
+                (postcodes * self._types + types) * self._months + months,
+                return_inverse=True,
+            )
+            total_keys.append(keys)
+            sums.append(np.bincount(inverse, weights=prices).astype(np.int64))
+            counts.append(np.bincount(inverse))
+            keys, counted = np.unique(
+                ((postcodes * self._months + months) << self.PRICE_BITS) | prices,
+                return_counts=True,
+            )
+            price_keys.append(keys)
+            price_counts.append(counted)
+        self._total_keys, self._sums = self._merge(total_keys, sums)
+        _, self._counts = self._merge(total_keys, counts)
+        self._price_keys, self._price_counts = self._merge(price_keys, price_counts)
+
+    @staticmethod
+    def _merge(keys, values):
+        """Distinct keys of the chunks and the sums of their values."""
+        if not keys:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        merged, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        sums = np.zeros(len(merged), dtype=np.int64)
+        np.add.at(sums, inverse, np.concatenate(values))
+        return merged, sums
+
+    def _postcodes(self, filters):
+        """Indexes of the postcodes matching the postcode filter."""
+        if "postal_code" in filters:
+            return np.flatnonzero(
+                np.array(self.dataset.postal_codes) == filters["postal_code"]
+            )
+        for index, level in enumerate(POSTAL_LEVELS):
+            if f"postal_{level}" in filters:
+                return np.array(
+                    [
+                        number
+                        for number, levels in enumerate(self.dataset.postcode_levels)
+                        if levels[index] == filters[f"postal_{level}"]
+                    ],
+                    dtype=np.int64,
+                )
+        return np.arange(len(self.dataset.postal_codes))
+
+    def _month_index(self, year, month):
+        return year * 12 + month - 1 - self.dataset.months[0]
+
+    def price_totals(self, start=None, end=None, **filters):
+        """
+        {(property type, year, month): (price sum, count)} of the rows
+        matching the postcode filter (postal_code=, postal_area=, ...) and
+        the inclusive (year, month) bounds.
+        """
+        months = self._total_keys % self._months
+        types = self._total_keys // self._months % self._types
+        postcodes = self._total_keys // (self._months * self._types)
+        selected = np.isin(postcodes, self._postcodes(filters))
+        if start is not None:
+            selected &= months >= self._month_index(*start)
+        if end is not None:
+            selected &= months <= self._month_index(*end)
+
+        totals = {}
+        for month, code, price_sum, count in zip(
+            months[selected].tolist(),
+            types[selected].tolist(),
+            self._sums[selected].tolist(),
+            self._counts[selected].tolist(),
+        ):
+            year, month = divmod(int(self.dataset.months[month]), 12)
+            key = (PROPERTY_TYPES[code - 1], year, month + 1)
+            previous_sum, previous_count = totals.get(key, (0, 0))
+            totals[key] = (previous_sum + price_sum, previous_count + count)
+        return totals
+
+    def price_counts(self, date=None, **filters):
+        """
+        Sorted (price, count) pairs of the rows matching the postcode filter
+        and, if given, the (year, month) date.
+        """
+        groups = self._price_keys >> self.PRICE_BITS
+        selected = np.isin(groups // self._months, self._postcodes(filters))
+        if date is not None:
+            selected &= groups % self._months == self._month_index(*date)
+        prices = self._price_keys[selected] & (2 ** self.PRICE_BITS - 1)
+        distinct, inverse = np.unique(prices, return_inverse=True)
+        counts = np.bincount(inverse, weights=self._price_counts[selected])
+        return list(zip(distinct.tolist(), counts.astype(np.int64).tolist()))
@@ -1,12 +1,56 @@
+import asyncio
 import datetime
+import fcntl
+import glob
+import json
 import math
+import os
 import random
-from collections import defaultdict
+import shutil
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from io import StringIO
 from operator import itemgetter
+from urllib.parse import urlencode
+from unittest import mock
 
-from django.test import TestCase
+import psycopg2
+import pyarrow
+import pyarrow.parquet
+from asgiref.sync import async_to_sync
+from common import metrics, routers, slow_queries
+from common.middleware import ServerTimingMiddleware
+from common.postgresql_pool import pool as pool_module
+from common.postgresql_pool.pool import ConnectionPool, get_pool
+from common.routers import read_replica
+from common.utils import postal_code_levels
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, connections, router
+from django.db.models import F
+from django.test import (AsyncRequestFactory, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 
-from .models import Property
+from . import async_views, benchmark, column_store
+from .async_db import close_pool, fetch, query_timeout
+from .cache import cache_stats
+from .fine_histograms import PRICE_BUCKET_WIDTH
+from .histogram import outlier_bounds
+from .management.commands import benchmark_api
+from .models import (ALL_POSTAL_CODES, AffectedPeriod, DatasetVersion,
+                     FinePriceHistogram, Postcode, PriceQuantileSketch,
+                     Property, PropertyMonthlyRollup)
+from .partitions import (create_year_partitions, default_partition_name,
+                         partition_name, year_partitions)
+from .renderers import ArrowStreamRenderer, JSONRows, ParquetRenderer
+from .rollups import rebuild_monthly_rollups
+from .sketches import check_accuracy, sketch_gamma, sketch_outlier_bounds
+from .synthetic import ExpectedAggregates, SyntheticDataset
+from .views import PropertyAveragePriceList, PropertyTransactionCountList
 
 # Set seed for pseudo random number
 random.seed(10)
@@ -31,32 +75,89 @@ def random_date_generate(start_date, end_date):
     return random_date
 
 
+def server_timings(response):
+    """{name: (duration ms, description)} of the Server-Timing header."""
+    timings = {}
+    for metric in response["Server-Timing"].split(", "):
+        name, *params = metric.split(";")
+        params = dict(param.split("=", 1) for param in params)
+        timings[name] = (float(params["dur"]), params.get("desc", "").strip('"'))
+    return timings
+
+
+def expected_histogram(price_counts, bound_rounding=1):
+    """
+    Computes the expected count_transactions response for the given
+    (price, count) pairs sorted by price, with the outlier bounds rounded
+    down to a multiple of bound_rounding unless they then are equal.
+    """
+    count = sum(price_count for _, price_count in price_counts)
+    if count == 0:
+        return []
+
+    def nth_price(number):
+        seen = 0
+        for price, price_count in price_counts:
+            seen += price_count
+            if seen >= number:
+                return price
+
+    min_price = nth_price(math.ceil(LOWER_OUTLIER_BOUNDARY * count))
+    max_price = nth_price(math.ceil(UPPER_OUTLIER_BOUNDARY * count))
+    if min_price // bound_rounding != max_price // bound_rounding:
+        min_price = min_price // bound_rounding * bound_rounding
+        max_price = max_price // bound_rounding * bound_rounding
+
+    bin_width = (max_price - min_price) / (MAX_BIN_COUNT - 1)
+    mask_digit = pow(10, DECIMAL_PLACES)
+    bin_width = math.ceil(bin_width / mask_digit) * mask_digit
+    bin_width = 1 if bin_width == 0 else bin_width
+
+    bin_counts = defaultdict(int)
+    for price, price_count in price_counts:
+        if price > max_price:
+            bin_floor = int(max_price / bin_width) * bin_width
+        else:
+            bin_floor = int(price / bin_width) * bin_width
+        bin_counts[bin_floor] += price_count
+
+    bins = sorted(bin_counts.items(), key=lambda item: item[0])
+
+    expected_bins = []
+    for bin_floor, bin_size in bins:
+        bin_start = bin_floor // THOUSAND2K
+        bin_end = (bin_floor + bin_width) // THOUSAND2K
+        expected_bins.append(
+            {"bin_range": f"£{bin_start}k - £{bin_end}k", "bin_size": bin_size}
+        )
+    return expected_bins
+
+
 class BaseTest(TestCase):
     @classmethod
     def setUpTestData(cls):
         """
-        Generates n (i.e. TEST_SAMPLE_COUNT) number of test sample.
+        Loads n (i.e. TEST_SAMPLE_COUNT) synthetic test samples and the
+        aggregates expected from them.
         """
-        cls.year, cls.month, cls.day = 2020, 5, 1
-        start_date = datetime.date(cls.year, cls.month, cls.day)
-        end_date = datetime.date(cls.year + TEST_YEAR_RANGE_SIZE, cls.month, cls.day)
+        cls.year, cls.month = 2020, 5
 
         cls.post_codes = ["MK18 5JF", "CM9 6UR", "BS23 2QX", "HP13 6YB"]
 
         cls.property_types = ["T", "D", "S", "F"]
 
-        price_range = (50000, 1000000)
-
-        cls.data = []
-        for _ in range(TEST_SAMPLE_COUNT):
-            random_date = random_date_generate(start_date, end_date)
-            property = Property.objects.create(
-                postal_code=random.choice(cls.post_codes),
-                property_type=random.choice(cls.property_types),
-                price=random.randint(price_range[0], price_range[1]),
-                transfer_date=random_date,
-            )
-            cls.data.append(property.__dict__)
+        dataset = SyntheticDataset(
+            TEST_SAMPLE_COUNT,
+            seed=10,
+            first_year=cls.year,
+            last_year=cls.year + TEST_YEAR_RANGE_SIZE - 1,
+            postal_codes=cls.post_codes,
+            property_types=cls.property_types,
+        )
+        dataset.load()
+        rebuild_monthly_rollups()
+        DatasetVersion.bump()
+        cls.expected = ExpectedAggregates(dataset)
 
 
 class AveragePriceTest(BaseTest):
@@ -93,10 +194,20 @@ class AveragePriceTest(BaseTest):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.data.get("error"), error_message)
 
+    def test_wildcard_postal_code(self):
+        # Not the national totals stored under it.
+        for url in ["avg_prices", "count_transactions"]:
+            response = self.client.get(
+                f"/api/v1/properties/{url}", {"postal_code": "*"}
+            )
+
+            error_message = "postal_code cannot contain '*'"
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data.get("error"), error_message)
+
     def test_average_prices(self):
         start_year, end_year = self.year, self.year + 1
         start_month, end_month = self.month, self.month
-        start_day, end_day = 1, 1
         postal_code = random.choice(self.post_codes)
         params = {
             "from": f"{start_year}-{start_month}",
@@ -105,34 +216,192 @@ class AveragePriceTest(BaseTest):
         }
 
         response = self.client.get("/api/v1/properties/avg_prices", params)
-        start_date = datetime.date(start_year, start_month, start_day)
-        end_date = datetime.date(end_year, end_month, end_day)
 
-        # {"property_type" : {"year" : {"month"  : float}}}
-        expected_avg_prices = defaultdict(
-            lambda: defaultdict(lambda: defaultdict(list))
+        # {(property_type, year, month): (price sum, count)}
+        expected_avg_prices = self.expected.price_totals(
+            (start_year, start_month), (end_year, end_month), postal_code=postal_code
         )
-        for item in self.data:
-            if item["postal_code"] == postal_code:
-                if start_date <= item["transfer_date"] <= end_date:
-                    pt = item["property_type"]
-                    year = item["transfer_date"].year
-                    month = item["transfer_date"].month
-                    price = item["price"]
-                    expected_avg_prices[pt][year][month].append(price)
 
-        def avg(lst):
-            return round(sum(lst) / len(lst), 2)
+        self.assertEqual(len(response.data), len(expected_avg_prices))
+        for item in response.data:
+            price_sum, count = expected_avg_prices[
+                (item["property_type"], item["year"], item["month"])
+            ]
+            self.assertEqual(float(item["avg_price"]), round(price_sum / count, 2))
+
 
+    def test_average_prices_all_postcodes(self):
+        response = self.client.get("/api/v1/properties/avg_prices")
+
+        expected_avg_prices = self.expected.price_totals()
+
+        self.assertEqual(len(response.data), len(expected_avg_prices))
         for item in response.data:
-            pt = item["property_type"]
-            year = item["year"]
-            month = item["month"]
-            avg_price = item["avg_price"]
+            price_sum, count = expected_avg_prices[
+                (item["property_type"], item["year"], item["month"])
+            ]
+            self.assertEqual(float(item["avg_price"]), round(price_sum / count, 2))
+
+    def test_rollups_rebuild_matches_incremental(self):
+        # The fixture rows are bulk loaded, these go through the signals.
+        for number in range(20):
+            Property.objects.create(
+                postcode=Postcode.intern(random.choice(self.post_codes)),
+                property_type=random.choice(self.property_types),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(self.year, self.month, 1 + number),
+            )
+        Property.objects.filter(transfer_date__day__lte=5).first().delete()
+        updated = Property.objects.filter(transfer_date__day__gte=25).first()
+        updated.price += 150
+        updated.save()
+
+        def rollup_rows():
+            rollups = PropertyMonthlyRollup.objects.order_by(
+                "postal_code", "property_type", "year", "month"
+            ).values_list(
+                "postal_code",
+                "property_type",
+                "year",
+                "month",
+                "price_sum",
+                "price_count",
+            )
+            sketches, histograms = [
+                model.objects.order_by("postal_code", "year", "month").values_list(
+                    "postal_code", "year", "month", "bucket_keys", "bucket_counts"
+                )
+                for model in (PriceQuantileSketch, FinePriceHistogram)
+            ]
+            return list(rollups), list(sketches), list(histograms)
+
+        incremental = rollup_rows()
+        call_command("build_rollups", stdout=StringIO())
+        self.assertEqual(rollup_rows(), incremental)
 
+        call_command(
+            "build_rollups",
+            "--from",
+            f"{self.year}-{self.month}",
+            "--to",
+            f"{self.year}-{self.month + 1}",
+            stdout=StringIO(),
+        )
+        self.assertEqual(rollup_rows(), incremental)
+
+    def test_sketches_follow_saves_and_deletes(self):
+        def bucket_counts():
+            rows = PriceQuantileSketch.objects.filter(
+                postal_code__in=[ALL_POSTAL_CODES, "LS7 1NJ"], year=2001, month=6
+            ).values_list("postal_code", "bucket_keys", "bucket_counts")
+            return {
+                (postal_code, key): count
+                for postal_code, keys, counts in rows
+                for key, count in zip(keys, counts)
+            }
+
+        before = bucket_counts()
+        sale = Property.objects.create(
+            postcode=Postcode.intern("LS7 1NJ"),
+            property_type="T",
+            price=250000,
+            transfer_date=datetime.date(2001, 6, 15),
+        )
+        key = math.ceil(math.log(250000) / math.log(sketch_gamma()))
+        saved = bucket_counts()
+        for postal_code in (ALL_POSTAL_CODES, "LS7 1NJ"):
             self.assertEqual(
-                float(avg_price), avg(expected_avg_prices[pt][year][month])
+                saved[postal_code, key], before.get((postal_code, key), 0) + 1
+            )
+
+        sale.delete()
+        self.assertEqual(bucket_counts(), before)
+
+    def test_refresh_affected_rollups(self):
+        def aggregate_rows():
+            rollups = PropertyMonthlyRollup.objects.order_by(
+                "postal_code", "property_type", "year", "month"
+            ).values_list(
+                "postal_code", "property_type", "year", "month", "price_sum", "price_count"
             )
+            sketches, histograms = [
+                model.objects.order_by("postal_code", "year", "month").values_list(
+                    "postal_code", "year", "month", "bucket_keys", "bucket_counts"
+                )
+                for model in (PriceQuantileSketch, FinePriceHistogram)
+            ]
+            return list(rollups), list(sketches), list(histograms)
+
+        call_command("build_rollups", stdout=StringIO())
+
+        # Change rows behind the signals' back, as populate_db.py --update does.
+        changed = list(Property.objects.order_by("id")[:30])
+        Property.objects.filter(pk__in=[p.pk for p in changed[:10]]).update(
+            price=F("price") + 12345
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {Property._meta.db_table} WHERE id = ANY(%s)",
+                [[p.pk for p in changed[10:20]]],
+            )
+        Property.objects.bulk_create(
+            [
+                Property(
+                    postcode=Postcode.intern("LS7 1NJ"),
+                    property_type="D",
+                    price=310000,
+                    transfer_date=datetime.date(2020, 6, 3),
+                )
+            ]
+        )
+        periods = {
+            (p.postal_code, p.transfer_date.year, p.transfer_date.month)
+            for p in changed[:20]
+        } | {("LS7 1NJ", 2020, 6)}
+        AffectedPeriod.objects.bulk_create(
+            [AffectedPeriod(postal_code=c, year=y, month=m) for c, y, m in periods]
+        )
+
+        call_command("build_rollups", "--affected", stdout=StringIO())
+        refreshed = aggregate_rows()
+        self.assertFalse(AffectedPeriod.objects.exists())
+
+        call_command("build_rollups", stdout=StringIO())
+        self.assertEqual(refreshed, aggregate_rows())
+
+    def test_rollups_follow_updates_and_deletes(self):
+        property = Property.objects.first()
+        rollup = PropertyMonthlyRollup.objects.get(
+            postal_code=property.postal_code,
+            property_type=property.property_type,
+            year=property.transfer_date.year,
+            month=property.transfer_date.month,
+        )
+
+        property.price += 1000
+        property.save()
+        rollup.refresh_from_db()
+        self.assertEqual(
+            rollup.price_sum,
+            sum(
+                Property.objects.filter(
+                    postcode__postal_code=rollup.postal_code,
+                    property_type=rollup.property_type,
+                    transfer_date__year=rollup.year,
+                    transfer_date__month=rollup.month,
+                ).values_list("price", flat=True)
+            ),
+        )
+
+        count = rollup.price_count
+        property.delete()
+        self.assertEqual(
+            PropertyMonthlyRollup.objects.filter(pk=rollup.pk)
+            .values_list("price_count", flat=True)
+            .first()
+            or 0,
+            count - 1,
+        )
 
 
 class TransactionCountTest(BaseTest):
@@ -180,48 +449,1738 @@ class TransactionCountTest(BaseTest):
 
         response = self.client.get("/api/v1/properties/count_transactions", params)
 
-        filtered_set = []
-
-        for item in self.data:
-            if item["postal_code"] == postal_code:
-                if (
-                    year == item["transfer_date"].year
-                    and month == item["transfer_date"].month
-                ):
-                    filtered_set.append(item)
-
-        count = len(filtered_set)
-        if count == 0:
+        expected_bins = expected_histogram(
+            self.expected.price_counts((year, month), postal_code=postal_code)
+        )
+        if not expected_bins:
             self.assertEqual(response.data, [])
             return
 
-        normal_range_start = math.ceil(LOWER_OUTLIER_BOUNDARY * count)
-        normal_range_end = math.ceil(UPPER_OUTLIER_BOUNDARY * count)
-        filtered_set = sorted(filtered_set, key=itemgetter("price"))
+        self.assertEqual(len(expected_bins), len(response.data))
+        for expected, actual in zip(expected_bins, response.data):
+            self.assertEqual(expected["bin_range"], actual["bin_range"])
+            self.assertEqual(expected["bin_size"], actual["bin_size"])
+
+    def test_count_transactions_all_postcodes(self):
+        # The dataset version lookup, the outlier bounds and the bins.
+        with self.assertNumQueries(3):
+            response = self.client.get("/api/v1/properties/count_transactions")
+
+        expected_bins = expected_histogram(self.expected.price_counts())
+        self.assertEqual(expected_bins, [dict(item) for item in response.data])
+
+    def test_count_transactions_single_transaction(self):
+        property = Property.objects.create(
+            postcode=Postcode.intern("SW1A 1AA"),
+            property_type="D",
+            price=1250000,
+            transfer_date=datetime.date(1999, 1, 1),
+        )
+        params = {"date": "1999-01", "postal_code": property.postal_code}
+
+        response = self.client.get("/api/v1/properties/count_transactions", params)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [dict(item) for item in response.data],
+            [{"bin_range": "£1250k - £1250k", "bin_size": 1}],
+        )
+
+    def test_count_transactions_empty(self):
+        params = {"date": "1990-01"}
+
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                "/api/v1/properties/count_transactions", params
+            )
+
+        self.assertEqual(response.data, [])
+
+    @override_settings(QUANTILE_SKETCH_ENABLED=True)
+    def test_count_transactions_sketch_bounds(self):
+        call_command("build_rollups", stdout=StringIO())
+        accuracy = settings.QUANTILE_SKETCH_RELATIVE_ACCURACY
+        postal_code = random.choice(self.post_codes)
+
+        for filters in [{}, {"postal_code": postal_code}]:
+            queryset = Property.objects.filter(
+                **{f"postcode__{name}": value for name, value in filters.items()}
+            )
+            count, min_price, max_price = outlier_bounds(queryset)
+            sketch_count, sketch_min, sketch_max = sketch_outlier_bounds(**filters)
+
+            self.assertEqual(sketch_count, count)
+            self.assertLessEqual(abs(sketch_min - min_price), accuracy * min_price + 1)
+            self.assertLessEqual(abs(sketch_max - max_price), accuracy * max_price + 1)
+
+            response = self.client.get("/api/v1/properties/count_transactions", filters)
+            self.assertEqual(sum(item["bin_size"] for item in response.data), count)
+
+    @override_settings(QUANTILE_SKETCH_ENABLED=True)
+    def test_sketches_keep_their_accuracy(self):
+        def sketch_rows():
+            return list(
+                PriceQuantileSketch.objects.order_by(
+                    "postal_code", "year", "month"
+                ).values_list("postal_code", "year", "month", "bucket_keys")
+            )
+
+        call_command("build_rollups", stdout=StringIO())
+        expected = sketch_outlier_bounds()
+
+        with self.settings(QUANTILE_SKETCH_RELATIVE_ACCURACY=0.2):
+            # Read and updated at the accuracy they were built at.
+            self.assertEqual(sketch_outlier_bounds(), expected)
+            Property.objects.create(
+                postcode=Postcode.intern("LS7 1NJ"),
+                property_type="T",
+                price=250000,
+                transfer_date=datetime.date(2001, 6, 15),
+            )
+            updated = sketch_rows()
+            call_command("build_rollups", stdout=StringIO())
+            self.assertEqual(DatasetVersion.current().sketch_relative_accuracy, 0.2)
+        call_command("build_rollups", stdout=StringIO())
+
+        self.assertEqual(
+            DatasetVersion.current().sketch_relative_accuracy,
+            settings.QUANTILE_SKETCH_RELATIVE_ACCURACY,
+        )
+        self.assertEqual(sketch_rows(), updated)
+
+    def test_sketch_accuracy_range(self):
+        for accuracy in [0.01, 0.00033, 0.99]:
+            check_accuracy(accuracy)
+        # Keys of the highest prices would overflow their smallints.
+        for accuracy in [0, 1, -0.5, 0.0003]:
+            with self.assertRaises(ImproperlyConfigured):
+                check_accuracy(accuracy)
+
+    @override_settings(QUANTILE_SKETCH_ENABLED=True)
+    def test_count_transactions_sketch_fallback(self):
+        PriceQuantileSketch.objects.all().delete()
+
+        response = self.client.get("/api/v1/properties/count_transactions")
+
+        expected_bins = expected_histogram(self.expected.price_counts())
+        self.assertEqual(expected_bins, [dict(item) for item in response.data])
+
+    @override_settings(FINE_HISTOGRAMS_ENABLED=True)
+    def test_count_transactions_fine_histograms(self):
+        postal_code = random.choice(self.post_codes)
+        district = postal_code_levels(postal_code)[1]
+        date = (self.year, self.month)
+        for params, filters in [
+            ({}, {}),
+            ({"date": f"{self.year}-{self.month:02}"}, {"date": date}),
+            ({"postal_district": district}, {"postal_district": district}),
+            (
+                {"postal_code": postal_code, "date": f"{self.year}-{self.month:02}"},
+                {"postal_code": postal_code, "date": date},
+            ),
+        ]:
+            # The dataset version lookup and the merged bucket counts.
+            with self.assertNumQueries(2):
+                response = self.client.get(
+                    "/api/v1/properties/count_transactions", params
+                )
+
+            expected_bins = expected_histogram(
+                self.expected.price_counts(**filters), PRICE_BUCKET_WIDTH
+            )
+            self.assertEqual(expected_bins, [dict(item) for item in response.data])
+
+    @override_settings(FINE_HISTOGRAMS_ENABLED=True)
+    def test_count_transactions_fine_histograms_fallback(self):
+        FinePriceHistogram.objects.all().delete()
+
+        response = self.client.get("/api/v1/properties/count_transactions")
+
+        expected_bins = expected_histogram(self.expected.price_counts())
+        self.assertEqual(expected_bins, [dict(item) for item in response.data])
+
+    @override_settings(FINE_HISTOGRAMS_ENABLED=True)
+    def test_count_transactions_fine_histograms_round_prices(self):
+        # Bounds which are multiples of the bucket width give the exact bins.
+        for number in range(40):
+            Property.objects.create(
+                postcode=Postcode.intern("SW1A 1AA"),
+                property_type="D",
+                price=random.randint(100, 5000) * 1000,
+                transfer_date=datetime.date(1999, 1, 1 + number % 28),
+            )
+        params = {"postal_code": "SW1A 1AA"}
+
+        response = self.client.get("/api/v1/properties/count_transactions", params)
+
+        with self.settings(FINE_HISTOGRAMS_ENABLED=False):
+            exact = self.client.get("/api/v1/properties/count_transactions", params)
+        self.assertEqual(response.data, exact.data)
+
+
+@override_settings(
+    API_CACHE_ENABLED=True,
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "api": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "api-tests",
+        },
+    },
+)
+class ResponseCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for price in [100000, 150000, 250000]:
+            Property.objects.create(
+                postcode=Postcode.intern("LS7 1NJ"),
+                property_type="F",
+                price=price,
+                transfer_date=datetime.date(2020, 5, 1),
+            )
+
+    def setUp(self):
+        caches["api"].clear()
+
+    def test_cache_hit_for_normalized_params(self):
+        for url in [
+            "/api/v1/properties/avg_prices",
+            "/api/v1/properties/count_transactions",
+        ]:
+            response = self.client.get(url, {"postal_code": "ls7 1nj"})
+            self.assertEqual(response["X-Cache"], "MISS")
+
+            with self.assertNumQueries(1):
+                cached = self.client.get(url, {"postal_code": "LS71NJ"})
+
+            self.assertEqual(cached["X-Cache"], "HIT")
+            self.assertEqual(cached.content, response.content)
+
+        stats = cache_stats(["avg_prices", "count_transactions"])
+        self.assertEqual(stats["avg_prices"], {"hits": 1, "misses": 1})
+        self.assertEqual(stats["count_transactions"], {"hits": 1, "misses": 1})
+
+    def test_cache_invalidated_by_dataset_version(self):
+        params = {"from": "2020-5", "to": "2020-05"}
+        response = self.client.get("/api/v1/properties/avg_prices", params)
+        self.assertEqual(response["X-Cache"], "MISS")
+
+        Property.objects.create(
+            postcode=Postcode.intern("LS7 1NJ"),
+            property_type="F",
+            price=50000,
+            transfer_date=datetime.date(2020, 5, 2),
+        )
+
+        response = self.client.get("/api/v1/properties/avg_prices", params)
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(response.data[0]["avg_price"], "137500.00")
+
+    def test_invalid_date_not_cached(self):
+        params = {"date": "2020-13"}
+        for _ in range(2):
+            response = self.client.get("/api/v1/properties/count_transactions", params)
+            self.assertEqual(response.status_code, 400)
+
+
+class ConditionalGetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Property.objects.create(
+            postcode=Postcode.intern("SE1 7GU"),
+            property_type="T",
+            price=420000,
+            transfer_date=datetime.date(2019, 3, 4),
+        )
+
+    def test_etag_and_cache_control(self):
+        response = self.client.get(
+            "/api/v1/properties/avg_prices", {"postal_code": "SE1 7GU"}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response["ETag"].startswith("W/"))
+        self.assertIn("Last-Modified", response)
+        self.assertIn("s-maxage=", response["Cache-Control"])
+
+        other = self.client.get(
+            "/api/v1/properties/avg_prices", {"postal_code": "LS7 1NJ"}
+        )
+        self.assertNotEqual(other["ETag"], response["ETag"])
+
+    def test_etag_per_representation(self):
+        url = "/api/v1/properties/avg_prices"
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(
+            self.client.get(url, HTTP_ACCEPT="application/json; q=0.9")["ETag"], etag
+        )
+
+        etags = {etag}
+        for params, accept in [
+            ({"format": "api"}, "text/html"),
+            ({}, "application/json; indent=2"),
+            ({}, "application/json; indent=4"),
+        ]:
+            response = self.client.get(url, params, HTTP_ACCEPT=accept)
+            self.assertNotIn(response["ETag"], etags, accept)
+            etags.add(response["ETag"])
+
+            # The plain JSON ETag does not validate another representation.
+            response = self.client.get(
+                url, params, HTTP_ACCEPT=accept, HTTP_IF_NONE_MATCH=etag
+            )
+            self.assertEqual(response.status_code, 200, accept)
+
+    def test_if_none_match(self):
+        for url in [
+            "/api/v1/properties/avg_prices",
+            "/api/v1/properties/count_transactions",
+        ]:
+            etag = self.client.get(url)["ETag"]
+
+            # Only the dataset version is read.
+            with self.assertNumQueries(1):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response["ETag"], etag)
+            self.assertEqual(response.content, b"")
+
+    def test_if_modified_since(self):
+        response = self.client.get("/api/v1/properties/count_transactions")
+        last_modified = response["Last-Modified"]
+
+        response = self.client.get(
+            "/api/v1/properties/count_transactions",
+            HTTP_IF_MODIFIED_SINCE=last_modified,
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_new_dataset_version_changes_etag(self):
+        etag = self.client.get("/api/v1/properties/avg_prices")["ETag"]
+
+        DatasetVersion.bump()
+
+        response = self.client.get(
+            "/api/v1/properties/avg_prices", HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_invalid_date_is_not_conditional(self):
+        response = self.client.get(
+            "/api/v1/properties/avg_prices",
+            {"from": "2015/10", "to": "2015-12"},
+            HTTP_IF_NONE_MATCH="*",
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class PartitionTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for year in [2019, 2020, 2090]:
+            Property.objects.create(
+                postcode=Postcode.intern("SE1 7GU"),
+                property_type="T",
+                price=420000,
+                transfer_date=datetime.date(year, 3, 4),
+            )
+
+    def test_date_filter_prunes_partitions(self):
+        plan = Property.objects.filter(
+            postcode__postal_code="SE1 7GU",
+            transfer_date__range=[
+                datetime.date(2020, 3, 1),
+                datetime.date(2020, 3, 31),
+            ],
+        ).explain()
+
+        self.assertIn(partition_name(2020), plan)
+        self.assertNotIn(partition_name(2019), plan)
+        self.assertNotIn(default_partition_name(), plan)
+
+    def test_create_year_partition_moves_default_rows(self):
+        self.assertNotIn(2090, year_partitions())
+
+        self.assertEqual(create_year_partitions([2020, 2090]), [2090])
+
+        self.assertTrue(year_partitions()[2090][0])
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {default_partition_name()}")
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute(f"SELECT COUNT(*) FROM {partition_name(2090)}")
+            self.assertEqual(cursor.fetchone()[0], 1)
+        self.assertEqual(Property.objects.count(), 3)
+
+    def test_detach_and_attach_year(self):
+        call_command("partitions", "detach", "2019", stdout=StringIO())
+
+        self.assertFalse(year_partitions()[2019][0])
+        self.assertEqual(Property.objects.count(), 2)
+        self.assertFalse(PropertyMonthlyRollup.objects.filter(year=2019).exists())
+
+        call_command("partitions", "attach", "2019", stdout=StringIO())
+
+        self.assertEqual(Property.objects.count(), 3)
+        self.assertTrue(PropertyMonthlyRollup.objects.filter(year=2019).exists())
+
+
+class PropertyStorageTest(TestCase):
+    def test_compact_columns(self):
+        for property_type in ["T", "F"]:
+            Property.objects.create(
+                postcode=Postcode.intern("SE1 7GU"),
+                property_type=property_type,
+                price=420000,
+                transfer_date=datetime.date(2019, 3, 4),
+            )
+
+        self.assertEqual(Postcode.objects.count(), 1)
+        self.assertEqual(
+            list(
+                Property.objects.filter(property_type__in=["T", "D"]).values_list(
+                    "postcode__postal_code", "property_type", "transfer_date"
+                )
+            ),
+            [("SE1 7GU", "T", datetime.date(2019, 3, 4))],
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT property_type FROM {Property._meta.db_table} ORDER BY 1"
+            )
+            self.assertEqual(cursor.fetchall(), [(3,), (4,)])
+
+
+class PostcodeLevelTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = []
+        postal_codes = ["LS7 1NJ", "LS7 1AB", "LS7 2CD", "LS8 3EF", "SE1 7GU"]
+        for number in range(200):
+            property = Property.objects.create(
+                postcode=Postcode.intern(postal_codes[number % len(postal_codes)]),
+                property_type=random.choice(["T", "D", "S", "F"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(2020, 1 + number % 3, 1 + number % 28),
+            )
+            cls.data.append({**property.__dict__, "postal_code": property.postal_code})
+
+    def test_postcode_levels(self):
+        self.assertEqual(postal_code_levels("LS7 1NJ"), ("LS", "LS7", "LS7 1"))
+        self.assertEqual(
+            list(
+                Postcode.objects.filter(postal_code="SE1 7GU").values_list(
+                    "postal_area", "postal_district", "postal_sector"
+                )
+            ),
+            [("SE", "SE1", "SE1 7")],
+        )
+
+    def test_average_prices_by_level(self):
+        for params, prefix in [
+            ({"postal_area": "ls"}, "LS"),
+            ({"postal_district": " ls7"}, "LS7 "),
+            ({"postal_sector": "LS71"}, "LS7 1"),
+        ]:
+            response = self.client.get("/api/v1/properties/avg_prices", params)
+
+            expected = defaultdict(list)
+            for item in self.data:
+                if item["postal_code"].startswith(prefix):
+                    key = (
+                        item["property_type"],
+                        item["transfer_date"].year,
+                        item["transfer_date"].month,
+                    )
+                    expected[key].append(item["price"])
+            self.assertEqual(len(response.data), len(expected))
+            for item in response.data:
+                prices = expected[(item["property_type"], item["year"], item["month"])]
+                self.assertEqual(
+                    float(item["avg_price"]), round(sum(prices) / len(prices), 2)
+                )
+
+    def test_level_rollups_rebuild_matches_incremental(self):
+        def level_rows():
+            return list(
+                PropertyMonthlyRollup.objects.filter(postal_code__contains=":")
+                .order_by("postal_code", "property_type", "year", "month")
+                .values_list(
+                    "postal_code",
+                    "property_type",
+                    "year",
+                    "month",
+                    "price_sum",
+                    "price_count",
+                )
+            )
+
+        incremental = level_rows()
+        call_command("build_rollups", stdout=StringIO())
+
+        self.assertEqual(level_rows(), incremental)
+        self.assertEqual(
+            {row[0] for row in incremental},
+            {
+                "area:LS",
+                "area:SE",
+                "district:LS7",
+                "district:LS8",
+                "district:SE1",
+                "sector:LS7 1",
+                "sector:LS7 2",
+                "sector:LS8 3",
+                "sector:SE1 7",
+            },
+        )
+
+    def test_count_transactions_by_district(self):
+        response = self.client.get(
+            "/api/v1/properties/count_transactions",
+            {"postal_district": "LS7", "date": "2020-02"},
+        )
+
+        expected_bins = expected_histogram(
+            sorted(
+                Counter(
+                    item["price"]
+                    for item in self.data
+                    if item["postal_code"].startswith("LS7 ")
+                    and item["transfer_date"].month == 2
+                ).items()
+            )
+        )
+        self.assertEqual(expected_bins, [dict(item) for item in response.data])
+
+    def test_one_postcode_filter_only(self):
+        for url in ["avg_prices", "count_transactions"]:
+            response = self.client.get(
+                f"/api/v1/properties/{url}",
+                {"postal_code": "LS7 1NJ", "postal_district": "LS7"},
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("postal_district", response.data["error"])
+
+
+class AveragePriceBatchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        postal_codes = ["LS7 1NJ", "LS7 2CD", "SE1 7GU"]
+        for number in range(120):
+            Property.objects.create(
+                postcode=Postcode.intern(postal_codes[number % len(postal_codes)]),
+                property_type=random.choice(["T", "D", "S", "F", "O"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(2019 + number % 2, 1 + number % 12, 3),
+            )
+
+    def post(self, specs):
+        return self.client.post(
+            "/api/v1/properties/avg_prices/batch",
+            {"specs": specs},
+            content_type="application/json",
+        )
+
+    def test_batch_matches_single_requests(self):
+        specs = [
+            {"postal_code": "ls71nj"},
+            {"postal_code": "SE1 7GU", "from": "2019-03", "to": "2020-02"},
+            {
+                "id": "leeds",
+                "postal_district": "LS7",
+                "from": "2020-01",
+                "to": "2020-12",
+            },
+            {"postal_code": "ZZ9 9ZZ"},
+            {},
+        ]
+
+        with self.assertNumQueries(1):
+            response = self.post(specs)
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual(list(results), ["0", "1", "leeds", "3", "4"])
+        order = itemgetter("year", "month", "property_type")
+        for spec_id, spec in zip(results, specs):
+            params = {name: value for name, value in spec.items() if name != "id"}
+            single = self.client.get("/api/v1/properties/avg_prices", params).json()
+            self.assertEqual(
+                sorted(results[spec_id]["data"], key=order), sorted(single, key=order)
+            )
+        self.assertEqual(results["3"], {"data": []})
+
+    def test_batch_spec_errors(self):
+        response = self.post(
+            [
+                {"postal_code": "LS7 1NJ", "from": "2019/01", "to": "2019-05"},
+                {"postal_code": "LS7 1NJ", "postal_sector": "LS7 1"},
+                {"postal_code": 7},
+                {"postal_code": "LS7 1NJ", "from": "2019-01", "to": "2019-05"},
+            ]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual(
+            results["0"]["error"],
+            "Date should be in '%Y-%m' format in acceptable ranges",
+        )
+        self.assertIn("postal_sector", results["1"]["error"])
+        self.assertIn("error", results["2"])
+        self.assertTrue(results["3"]["data"])
+
+    @override_settings(BATCH_MAX_SPECS=2)
+    def test_batch_size_cap(self):
+        response = self.post([{}, {}, {}])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "At most 2 specs can be given"})
+
+        response = self.post([{"id": "a"}, {"id": "a"}])
+        self.assertEqual(response.status_code, 400)
+
+
+class ColumnarFormatTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for number in range(60):
+            Property.objects.create(
+                postcode=Postcode.intern(["LS7 1NJ", "SE1 7GU"][number % 2]),
+                property_type=random.choice(["T", "D", "S", "F"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(2020, 1 + number % 4, 5),
+            )
+
+    def test_columnar_formats_match_json(self):
+        for url, params in [
+            ("/api/v1/properties/avg_prices", {"postal_code": "LS7 1NJ"}),
+            ("/api/v1/properties/count_transactions", {"date": "2020-02"}),
+        ]:
+            expected = self.client.get(url, params).json()
+
+            response = self.client.get(url, {**params, "format": "arrow"})
+            self.assertEqual(response["Content-Type"], ArrowStreamRenderer.media_type)
+            arrow = pyarrow.ipc.open_stream(response.content).read_all().to_pydict()
+
+            response = self.client.get(
+                url, params, HTTP_ACCEPT=ParquetRenderer.media_type
+            )
+            self.assertEqual(response["Content-Type"], ParquetRenderer.media_type)
+            parquet = pyarrow.parquet.read_table(
+                pyarrow.BufferReader(response.content)
+            ).to_pydict()
+
+            self.assertEqual(arrow, parquet)
+            if "avg_price" in arrow:
+                arrow["avg_price"] = [f"{price:.2f}" for price in arrow["avg_price"]]
+            self.assertEqual(
+                arrow, {name: [row[name] for row in expected] for name in arrow}
+            )
+            self.assertEqual(list(arrow), list(expected[0]))
+
+    def test_columnar_errors_are_json(self):
+        response = self.client.get(
+            "/api/v1/properties/avg_prices",
+            {"from": "2020/01", "to": "2020-02", "format": "arrow"},
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertIn("error", response.json())
+
+    @override_settings(
+        API_CACHE_ENABLED=True,
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "api": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "api-columnar-tests",
+            },
+        },
+    )
+    def test_formats_cached_separately(self):
+        url = "/api/v1/properties/avg_prices"
+        json_response = self.client.get(url)
+        arrow_response = self.client.get(url, {"format": "arrow"})
+
+        self.assertNotEqual(json_response["ETag"], arrow_response["ETag"])
+        self.assertIn("Accept", arrow_response["Vary"])
+        self.assertEqual(arrow_response["X-Cache"], "MISS")
+        cached = self.client.get(url, {"format": "arrow"})
+        self.assertEqual(cached["X-Cache"], "HIT")
+        self.assertEqual(cached.content, arrow_response.content)
+
+
+class FastJSONTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # 100000.125 on average, rounded half to even like DecimalField.
+        for price in [100000] * 7 + [100001]:
+            Property.objects.create(
+                postcode=Postcode.intern("SE1 7GU"),
+                property_type="T",
+                price=price,
+                transfer_date=datetime.date(2019, 3, 4),
+            )
+        for number in range(40):
+            Property.objects.create(
+                postcode=Postcode.intern("LS7 1NJ"),
+                property_type=random.choice(["T", "D", "S", "F"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(2020, 1 + number % 4, 5),
+            )
+
+    def test_same_bytes_as_serializers(self):
+        for view, url, params in [
+            (PropertyAveragePriceList, "/api/v1/properties/avg_prices", {}),
+            (
+                PropertyTransactionCountList,
+                "/api/v1/properties/count_transactions",
+                {"postal_code": "LS7 1NJ"},
+            ),
+        ]:
+            fast = self.client.get(url, params)
+            self.assertIsInstance(fast.data, JSONRows)
+            with mock.patch.object(view, "fast_json", False):
+                serialized = self.client.get(url, params)
+            self.assertNotIsInstance(serialized.data, JSONRows)
+
+            self.assertEqual(fast.content, serialized.content)
+
+    def test_decimals_rounded_half_to_even(self):
+        response = self.client.get(
+            "/api/v1/properties/avg_prices", {"postal_code": "SE1 7GU"}
+        )
+
+        self.assertEqual(
+            response.content,
+            b'[{"property_type":"T","month":3,"year":2019,"avg_price":"100000.12"}]',
+        )
+
+    def test_indent_falls_back_to_serializer_output(self):
+        response = self.client.get(
+            "/api/v1/properties/avg_prices",
+            {"postal_code": "SE1 7GU"},
+            HTTP_ACCEPT="application/json; indent=2",
+        )
+
+        self.assertEqual(
+            response.content.decode(),
+            '[\n  {\n    "property_type": "T",\n    "month": 3,\n    "year": 2019,\n'
+            '    "avg_price": "100000.12"\n  }\n]',
+        )
+
+
+class AsyncViewTest(TransactionTestCase):
+    # The async views query through their own connections, which only see
+    # committed rows.
+    def setUp(self):
+        for number in range(80):
+            Property.objects.create(
+                postcode=Postcode.intern(["LS7 1NJ", "LS7 2CD", "SE1 7GU"][number % 3]),
+                property_type=random.choice(["T", "D", "S", "F"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(2020, 1 + number % 4, 5),
+            )
+
+    def get(self, view, params, **headers):
+        # The async request factory takes the query string in the path and
+        # plain header names.
+        request = AsyncRequestFactory().get(f"/?{urlencode(params)}", **headers)
+
+        async def get():
+            try:
+                return await view(request)
+            finally:
+                await close_pool()
+
+        return async_to_sync(get)()
+
+    def test_same_responses_as_sync_views(self):
+        for view, url, params in [
+            (async_views.average_prices, "avg_prices", {}),
+            (
+                async_views.average_prices,
+                "avg_prices",
+                {"postal_district": "ls7", "from": "2020-02", "to": "2020-03"},
+            ),
+            (async_views.count_transactions, "count_transactions", {}),
+            (
+                async_views.count_transactions,
+                "count_transactions",
+                {"postal_code": "SE1 7GU", "date": "2020-03"},
+            ),
+            (
+                async_views.count_transactions,
+                "count_transactions",
+                {"postal_code": "ZZ9 9ZZ"},
+            ),
+        ]:
+            # Served by Django as async views.
+            self.assertTrue(asyncio.iscoroutinefunction(view))
+            expected = self.client.get(f"/api/v1/properties/{url}", params)
+            response = self.get(view, params)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, expected.content)
+            for header in ["Content-Type", "ETag", "Last-Modified", "Cache-Control"]:
+                self.assertEqual(response[header], expected[header])
+
+    @override_settings(QUANTILE_SKETCH_ENABLED=True)
+    def test_sketch_bounds(self):
+        params = {"postal_district": "LS7"}
+        expected = self.client.get("/api/v1/properties/count_transactions", params)
+
+        response = self.get(async_views.count_transactions, params)
+
+        self.assertEqual(response.content, expected.content)
+
+    @override_settings(FINE_HISTOGRAMS_ENABLED=True)
+    def test_fine_histograms(self):
+        for params in [{}, {"postal_district": "LS7", "date": "2020-02"}]:
+            expected = self.client.get("/api/v1/properties/count_transactions", params)
+
+            response = self.get(async_views.count_transactions, params)
+
+            self.assertEqual(response.content, expected.content)
+
+    def test_columnar_formats_and_memory_engine_served_by_sync_views(self):
+        url = "/api/v1/properties/avg_prices"
+        expected = self.client.get(url, {"format": "arrow"})
+        response = self.get(async_views.average_prices, {"format": "arrow"})
+        self.assertEqual(response["Content-Type"], ArrowStreamRenderer.media_type)
+        self.assertEqual(response.content, expected.content)
+
+        expected = self.client.get(url, HTTP_ACCEPT=ParquetRenderer.media_type)
+        response = self.get(
+            async_views.average_prices, {}, Accept=ParquetRenderer.media_type
+        )
+        self.assertEqual(response["Content-Type"], ParquetRenderer.media_type)
+        self.assertEqual(response.content, expected.content)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        column_store.export_column_store(directory.name)
+        with override_settings(
+            API_QUERY_ENGINE="memory", COLUMN_STORE_DIR=directory.name
+        ), mock.patch.object(column_store, "_loaded", None), mock.patch.object(
+            column_store.ColumnStore, "price_histogram", return_value=[]
+        ):
+            response = self.get(async_views.count_transactions, {})
+        self.assertEqual(json.loads(response.content), [])
+
+    def test_conditional_and_invalid_requests(self):
+        etag = self.get(async_views.average_prices, {})["ETag"]
+        response = self.get(async_views.average_prices, {}, **{"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        for view, params in [
+            (async_views.average_prices, {"from": "2020/01", "to": "2020-02"}),
+            (
+                async_views.count_transactions,
+                {"postal_code": "LS7 1NJ", "postal_area": "LS"},
+            ),
+        ]:
+            response = self.get(view, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("error", json.loads(response.content))
+
+    def test_server_timing(self):
+        middleware = ServerTimingMiddleware(async_views.count_transactions)
+
+        response = self.get(middleware, {"postal_code": "LS7 1NJ"})
+
+        timings = server_timings(response)
+        self.assertEqual(
+            list(timings),
+            ["db", "quantile", "binning", "serialization", "render", "total"],
+        )
+        # The dataset version, outlier bounds and bins queries.
+        self.assertEqual(timings["db"][1], "3 queries")
+
+    @override_settings(
+        API_CACHE_ENABLED=True,
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "api": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "api-async-tests",
+            },
+        },
+    )
+    def test_cache_shared_with_sync_views(self):
+        params = {"postal_code": "LS7 1NJ"}
+        response = self.get(async_views.average_prices, params)
+        self.assertEqual(response["X-Cache"], "MISS")
+
+        cached = self.client.get("/api/v1/properties/avg_prices", params)
+
+        self.assertEqual(cached["X-Cache"], "HIT")
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(self.get(async_views.average_prices, params)["X-Cache"], "HIT")
+
+
+class ConnectionPoolTest(TestCase):
+    def connect(self):
+        return psycopg2.connect(**connection.get_connection_params())
+
+    def test_connections_reused(self):
+        pool = ConnectionPool(size=2)
+        first = pool.checkout(self.connect)
+        pool.checkin(first)
+
+        self.assertIs(pool.checkout(self.connect), first)
+        self.assertEqual(pool.stats.connects, 1)
+        self.assertEqual(pool.stats.checkouts, 2)
+        pool.checkin(first)
+        pool.close_idle()
+        self.assertTrue(first.closed)
+
+    def test_wait_timeout(self):
+        pool = ConnectionPool(size=1, timeout=0.05)
+        busy = pool.checkout(self.connect)
+
+        with self.assertLogs("common.postgresql_pool", "WARNING"):
+            with self.assertRaises(psycopg2.OperationalError):
+                pool.checkout(self.connect)
+
+        self.assertEqual(pool.stats.waits, 1)
+        self.assertEqual(pool.stats.timeouts, 1)
+        self.assertGreaterEqual(pool.stats.wait_seconds, 0.05)
+        pool.checkin(busy)
+        pool.close_idle()
+
+    def test_broken_and_expired_connections_replaced(self):
+        pool = ConnectionPool(size=1, health_check_interval=0)
+        broken = pool.checkout(self.connect)
+        pool.checkin(broken)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_terminate_backend(%s)", [broken.get_backend_pid()]
+            )
+
+        replacement = pool.checkout(self.connect)
+        self.assertIsNot(replacement, broken)
+        with replacement.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        pool.checkin(replacement)
+
+        pool.max_lifetime = 0
+        renewed = pool.checkout(self.connect)
+        self.assertIsNot(renewed, replacement)
+        self.assertEqual(pool.stats.discarded, 2)
+        pool.checkin(renewed)
+        pool.close_idle()
+
+    def test_open_transaction_rolled_back(self):
+        pool = ConnectionPool(size=1)
+        conn = pool.checkout(self.connect)
+        conn.autocommit = False
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        pool.checkin(conn)
+
+        self.assertEqual(
+            conn.get_transaction_status(),
+            psycopg2.extensions.TRANSACTION_STATUS_IDLE,
+        )
+        pool.close_idle()
+
+    @mock.patch.object(pool_module, "_pools", {})
+    @mock.patch.object(pool_module, "_pools_pid", None)
+    def test_pools_not_inherited_by_forks(self):
+        pool = get_pool(("fork-test",), size=1)
+        self.assertIs(get_pool(("fork-test",), size=1), pool)
+
+        with mock.patch("os.getpid", return_value=-1):
+            self.assertIsNot(get_pool(("fork-test",), size=1), pool)
+
+
+class ColumnStoreTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        postal_codes = ["LS7 1NJ", "LS7 1AB", "LS7 2CD", "LS8 3EF", "SE1 7GU"]
+        for number in range(300):
+            Property.objects.create(
+                postcode=Postcode.intern(postal_codes[number % len(postal_codes)]),
+                property_type=random.choice(["T", "D", "S", "F", "O"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=random_date_generate(
+                    datetime.date(2019, 1, 1), datetime.date(2020, 12, 31)
+                ),
+            )
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # Each test exports the same generation again.
+        patcher = mock.patch.object(column_store, "_loaded", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.memory_engine = override_settings(
+            API_QUERY_ENGINE="memory", COLUMN_STORE_DIR=directory.name
+        )
+        self.store = column_store.export_column_store(directory.name)
+
+    def test_same_responses_as_postgres(self):
+        order = itemgetter("year", "month", "property_type")
+        for url, params in [
+            ("avg_prices", {}),
+            (
+                "avg_prices",
+                {"postal_code": "LS7 1NJ", "from": "2019-03", "to": "2020-02"},
+            ),
+            ("avg_prices", {"postal_district": "LS7"}),
+            ("avg_prices", {"postal_area": "SE", "from": "2020-01", "to": "2020-12"}),
+            ("avg_prices", {"postal_code": "ZZ9 9ZZ"}),
+            ("count_transactions", {}),
+            ("count_transactions", {"postal_sector": "LS7 1"}),
+            ("count_transactions", {"postal_code": "SE1 7GU", "date": "2020-05"}),
+            ("count_transactions", {"postal_area": "LS", "date": "2019-11"}),
+            ("count_transactions", {"date": "2030-01"}),
+        ]:
+            expected = self.client.get(f"/api/v1/properties/{url}", params).json()
+            with self.memory_engine:
+                response = self.client.get(f"/api/v1/properties/{url}", params)
+                arrow = self.client.get(
+                    f"/api/v1/properties/{url}", {**params, "format": "arrow"}
+                )
+
+            if url == "avg_prices":
+                expected.sort(key=order)
+            self.assertEqual(response.json(), expected)
+            self.assertEqual(
+                len(pyarrow.ipc.open_stream(arrow.content).read_all()), len(expected)
+            )
+
+    def test_histogram_of_equal_prices(self):
+        # A lower outlier, then both bounds at the highest price.
+        for price in [50000] + [900000000] * 20:
+            Property.objects.create(
+                postcode=Postcode.intern("YO1 7HH"),
+                property_type="D",
+                price=price,
+                transfer_date=datetime.date(2020, 6, 1),
+            )
+        column_store.export_column_store(os.path.dirname(self.store.path))
+        params = {"postal_code": "YO1 7HH"}
+        expected = self.client.get("/api/v1/properties/count_transactions", params)
+
+        # Bins 1 wide, not counted in one counter per pound up to the top.
+        with self.memory_engine, mock.patch.object(
+            column_store.np, "bincount", side_effect=AssertionError
+        ):
+            response = self.client.get("/api/v1/properties/count_transactions", params)
+
+        self.assertEqual(response.json(), expected.json())
+        self.assertEqual([row["bin_size"] for row in response.json()], [1, 20])
+
+    def test_postcode_slices_sorted_by_date(self):
+        values, starts, ends = self.store.postcode_filters["postal_district"]
+        self.assertEqual(list(values), ["LS7", "LS8", "SE1"])
+        rows = self.store.row_slice({"postal_district": "LS7"})
+        self.assertEqual(rows.stop - rows.start, 180)
+
+        for postal_code in ["LS7 1NJ", "SE1 7GU"]:
+            months = self.store.month[
+                self.store.row_slice({"postal_code": postal_code})
+            ]
+            self.assertEqual(list(months), sorted(months))
+
+    def test_stale_export_not_used(self):
+        Property.objects.create(
+            postcode=Postcode.intern("LS7 1NJ"),
+            property_type="T",
+            price=5000000,
+            transfer_date=datetime.date(2021, 1, 1),
+        )
+
+        with self.memory_engine, self.assertLogs("pricepaid.column_store", "WARNING"):
+            response = self.client.get(
+                "/api/v1/properties/avg_prices",
+                {"postal_code": "LS7 1NJ", "from": "2021-01", "to": "2021-01"},
+            )
+
+        self.assertEqual(response.json()[0]["avg_price"], "5000000.00")
+
+    def test_empty_dataset(self):
+        Property.objects.all().delete()
+        DatasetVersion.bump()
+        store = column_store.export_column_store(self.store.path + "-empty")
+        self.addCleanup(shutil.rmtree, self.store.path + "-empty")
+
+        self.assertEqual(store.rows, 0)
+        self.assertEqual(store.average_prices({}), [])
+        self.assertEqual(store.price_histogram({"postal_code": "LS7 1NJ"}), [])
+
+
+class BenchmarkTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = SyntheticDataset(3000, seed=7, first_year=2018, last_year=2020)
+        cls.dataset.load(chunk_size=1000)
+        rebuild_monthly_rollups()
+
+    def test_dataset_is_deterministic(self):
+        same = SyntheticDataset(3000, seed=7, first_year=2018, last_year=2020)
+        other = SyntheticDataset(3000, seed=8, first_year=2018, last_year=2020)
+
+        self.assertEqual(same.postal_codes, self.dataset.postal_codes)
+        for chunk, same_chunk, other_chunk in zip(
+            self.dataset.chunks(1000), same.chunks(1000), other.chunks(1000)
+        ):
+            for column, same_column in zip(chunk, same_chunk):
+                self.assertTrue((column == same_column).all())
+            self.assertFalse((chunk[2] == other_chunk[2]).all())
+
+    def test_loaded_rows(self):
+        self.assertEqual(Property.objects.count(), 3000)
+        prices, dates = zip(*Property.objects.values_list("price", "transfer_date"))
+        self.assertGreater(min(prices), 0)
+        self.assertEqual(min(dates).year, 2018)
+        self.assertEqual(max(dates).year, 2020)
+        for postcode in Postcode.objects.all():
+            self.assertEqual(
+                (
+                    postcode.postal_area,
+                    postcode.postal_district,
+                    postcode.postal_sector,
+                ),
+                postal_code_levels(postcode.postal_code),
+            )
+
+    def test_replay_report(self):
+        requests = benchmark.query_mix(self.dataset, 60, seed=7)
+        self.assertEqual(requests, benchmark.query_mix(self.dataset, 60, seed=7))
+        self.assertEqual(
+            {scenario for _, scenario, _ in requests},
+            {scenario for _, scenario, _, _ in benchmark.QUERY_MIX},
+        )
+
+        report = benchmark.summarize(*benchmark.replay(requests, warmup=10))
+
+        self.assertEqual(report["overall"]["requests"], 50)
+        self.assertEqual(report["overall"]["errors"], 0)
+        self.assertGreater(report["overall"]["queries_per_request"], 0)
+        for summary in report["scenarios"].values():
+            self.assertLessEqual(summary["p50_ms"], summary["p95_ms"])
+            self.assertLessEqual(summary["p95_ms"], summary["p99_ms"])
+
+        changes = benchmark.compare(report, report)
+        self.assertEqual(changes["overall"]["p95_ms"][2], 0)
+        self.assertEqual(
+            set(changes), {"overall", *report["endpoints"], *report["scenarios"]}
+        )
+
+    @override_settings(DB_REPLICAS=["replica_0"])
+    def test_replay_skips_replicas(self):
+        def replay(requests, warmup):
+            # The replicas do not hold the benchmark database.
+            self.assertEqual(settings.DB_REPLICAS, [])
+            self.assertEqual(routers.choose_read_alias(), "default")
+            return [], 1.0
+
+        options = {
+            "warmup": 0,
+            "requests": 5,
+            "seed": 7,
+            "query_engine": "postgres",
+            "cache": False,
+        }
+        with mock.patch.object(benchmark_api, "replay", replay), mock.patch.object(
+            benchmark_api, "summarize", return_value={}
+        ):
+            benchmark_api.Command().run(self.dataset, options)
+
+
+class SyntheticDataTest(TestCase):
+    def test_generate_data_matches_expected_aggregates(self):
+        Property.objects.create(
+            postcode=Postcode.intern("LS7 1NJ"),
+            property_type="T",
+            price=100000,
+            transfer_date=datetime.date(2019, 1, 1),
+        )
+        dataset = SyntheticDataset(5000, seed=3, first_year=2019, last_year=2020)
+
+        call_command(
+            "generate_data",
+            "--rows=5000",
+            "--seed=3",
+            "--first-year=2019",
+            "--last-year=2020",
+            "--chunk-size=2000",
+            "--replace",
+            stdout=StringIO(),
+        )
+
+        self.assertEqual(Property.objects.count(), 5000)
+        expected = ExpectedAggregates(dataset, chunk_size=1500)
+        rollups = {
+            (row.property_type, row.year, row.month): (row.price_sum, row.price_count)
+            for row in PropertyMonthlyRollup.objects.filter(postal_code="*")
+        }
+        self.assertEqual(rollups, expected.price_totals())
+
+        district = dataset.postcode_levels[0][1]
+        rows = Property.objects.filter(
+            postcode__postal_district=district,
+            transfer_date__year=2020,
+            transfer_date__month=7,
+        )
+        self.assertEqual(
+            expected.price_counts((2020, 7), postal_district=district),
+            sorted(Counter(rows.values_list("price", flat=True)).items()),
+        )
+
+
+class ServerTimingTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for number in range(40):
+            Property.objects.create(
+                postcode=Postcode.intern(["LS7 1NJ", "LS7 2CD"][number % 2]),
+                property_type=random.choice(["T", "D", "S", "F"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(2020, 1 + number % 4, 5),
+            )
+        DatasetVersion.bump()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.metrics_dir = directory.name
+        overridden = override_settings(
+            METRICS_DIR=self.metrics_dir, METRICS_FLUSH_INTERVAL=0
+        )
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        for metric in metrics.METRICS.values():
+            patcher = mock.patch.object(metric, "series", {})
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                "/api/v1/properties/count_transactions", {"postal_code": "LS7 1NJ"}
+            )
+
+        timings = server_timings(response)
+        self.assertEqual(
+            list(timings),
+            ["db", "quantile", "binning", "serialization", "render", "total"],
+        )
+        self.assertEqual(timings["db"][1], f"{len(queries)} queries")
+        for name, (duration, _) in timings.items():
+            self.assertLessEqual(duration, timings["total"][0], name)
+
+        response = self.client.get("/api/v1/properties/avg_prices", {"format": "arrow"})
+        self.assertEqual(
+            list(server_timings(response)), ["db", "serialization", "render", "total"]
+        )
+
+    @override_settings(API_METRICS_ENABLED=False)
+    def test_disabled(self):
+        response = self.client.get("/api/v1/properties/avg_prices")
+        self.assertNotIn("Server-Timing", response)
+
+    def test_metrics_summed_over_workers(self):
+        for _ in range(2):
+            self.client.get("/api/v1/properties/avg_prices")
+        self.client.get(
+            "/api/v1/properties/avg_prices", {"from": "2020/01", "to": "2020-02"}
+        )
+        # The file of another worker which answered the same requests.
+        own = os.path.join(self.metrics_dir, f"{os.getpid()}.json")
+        shutil.copy(own, os.path.join(self.metrics_dir, "1.json"))
+
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        lines = response.content.decode().splitlines()
+        route = 'route="api/v1/properties/avg_prices"'
+        self.assertIn("# TYPE pricepaid_request_duration_seconds histogram", lines)
+        for status, count in [(200, 4), (400, 2)]:
+            self.assertIn(
+                "pricepaid_request_duration_seconds_count"
+                f'{{{route},status="{status}"}} {count}',
+                lines,
+            )
+        self.assertIn(f'pricepaid_request_db_queries_count{{{route}}} 6', lines)
+        self.assertIn(
+            "pricepaid_request_phase_duration_seconds_count"
+            f'{{{route},phase="render"}} 6',
+            lines,
+        )
+        # Buckets are cumulative.
+        prefix = f"pricepaid_request_db_queries_bucket{{{route},"
+        counts = [
+            int(line.rsplit(" ", 1)[1]) for line in lines if line.startswith(prefix)
+        ]
+        self.assertEqual(counts, sorted(counts))
+        self.assertEqual(counts[-1], 6)
+
+    def test_pool_metrics(self):
+        def connect():
+            return psycopg2.connect(**connection.get_connection_params())
+
+        pool = ConnectionPool(size=1, timeout=0.05, name="test")
+        busy = pool.checkout(connect)
+        with self.assertLogs("common.postgresql_pool", "WARNING"):
+            with self.assertRaises(psycopg2.OperationalError):
+                pool.checkout(connect)
+        pool.checkin(busy)
+        pool.close_idle()
 
-        min_price = filtered_set[normal_range_start - 1]["price"]
-        max_price = filtered_set[normal_range_end - 1]["price"]
+        lines = self.client.get("/metrics").content.decode().splitlines()
 
-        bin_width = (max_price - min_price) / (MAX_BIN_COUNT - 1)
-        mask_digit = pow(10, DECIMAL_PLACES)
-        bin_width = math.ceil(bin_width / mask_digit) * mask_digit
-        bin_width = 1 if bin_width == 0 else bin_width
+        for line in [
+            'pricepaid_db_pool_checkouts_total{pool="test"} 1',
+            'pricepaid_db_pool_connects_total{pool="test"} 1',
+            'pricepaid_db_pool_discarded_total{pool="test"} 1',
+            'pricepaid_db_pool_timeouts_total{pool="test"} 1',
+            'pricepaid_db_pool_wait_seconds_count{pool="test"} 1',
+            'pricepaid_db_pool_wait_seconds_bucket{pool="test",le="0.025"} 0',
+        ]:
+            self.assertIn(line, lines)
 
-        bin_counts = defaultdict(int)
-        for item in filtered_set:
-            if item["price"] > max_price:
-                bin_floor = int(max_price / bin_width) * bin_width
-            else:
-                bin_floor = int(item["price"] / bin_width) * bin_width
-            bin_counts[bin_floor] += 1
+    @override_settings(METRICS_DIR="")
+    def test_clear_without_directory(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.metrics_dir)
+        open("data.json", "w").close()
+
+        metrics.clear()
+
+        self.assertTrue(os.path.exists("data.json"))
+
+
+class SlowQueryLogTest(TestCase):
+    url = "/api/v1/properties/count_transactions"
+    params = {"postal_code": "LS7 1NJ", "date": "2020-01"}
+
+    @classmethod
+    def setUpTestData(cls):
+        for number in range(40):
+            Property.objects.create(
+                postcode=Postcode.intern(["LS7 1NJ", "LS7 2CD"][number % 2]),
+                property_type=random.choice(["T", "D", "S", "F"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(2020, 1 + number % 4, 5),
+            )
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        overridden = override_settings(
+            SLOW_QUERY_LOG_ENABLED=True, SLOW_QUERY_LOG_DIR=directory.name
+        )
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.addCleanup(slow_queries.wait_for_plans)
+
+    def get(self, *args):
+        response = self.client.get(*args)
+        # Entries are written by the explain thread.
+        slow_queries.wait_for_plans()
+        return response
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_EXPLAIN_ANALYZE=True)
+    def test_queries_recorded_with_plans(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.get(self.url, self.params)
+
+        entries = slow_queries.entries()
+        # Explained on another connection.
+        self.assertEqual(len(entries), len(queries))
+        self.assertFalse(any("EXPLAIN" in query["sql"] for query in queries))
+        for entry in entries:
+            self.assertEqual(entry["endpoint"], "api/v1/properties/count_transactions")
+            self.assertEqual(entry["shape"], "date&postal_code")
+            self.assertEqual(entry["reason"], "slow")
+        bounds = next(entry for entry in entries if "percentile_disc" in entry["sql"])
+        self.assertIn("LS7 1NJ", bounds["params"])
+        self.assertTrue(any("actual time=" in line for line in bounds["plan"]))
+        # The transaction is still usable.
+        self.assertEqual(Property.objects.count(), 40)
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0)
+    def test_only_planned_by_default(self):
+        self.get(self.url, self.params)
+
+        for entry in slow_queries.entries():
+            self.assertTrue(entry["plan"])
+            self.assertFalse(any("actual time=" in line for line in entry["plan"]))
+
+    @override_settings(
+        SLOW_QUERY_THRESHOLD_MS=200,
+        SLOW_QUERY_EXPLAIN_ANALYZE=True,
+        SLOW_QUERY_EXPLAIN_TIMEOUT_MS=50,
+    )
+    def test_analyze_timeout_falls_back_to_plan(self):
+        def slow_histogram(queryset, bounds):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_sleep(0.3)")
+            return []
+
+        with mock.patch("pricepaid.views.price_histogram", slow_histogram):
+            self.get(self.url, self.params)
+
+        (entry,) = slow_queries.entries()
+        self.assertEqual(entry["sql"], "SELECT pg_sleep(0.3)")
+        self.assertNotIn("explain_error", entry)
+        self.assertEqual(len(entry["plan"]), 1)
+        self.assertNotIn("actual time=", entry["plan"][0])
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=60000, SLOW_QUERY_SAMPLE_RATE=1)
+    def test_sampled_queries(self):
+        self.get(self.url, self.params)
+        reasons = {entry["reason"] for entry in slow_queries.entries()}
+        self.assertEqual(reasons, {"sampled"})
+
+        slow_queries.clear()
+        with self.settings(SLOW_QUERY_SAMPLE_RATE=0):
+            self.get(self.url, self.params)
+        self.assertEqual(slow_queries.entries(), [])
+
+    @override_settings(
+        SLOW_QUERY_THRESHOLD_MS=60000, API_STATEMENT_TIMEOUTS={"count_transactions": 50}
+    )
+    def test_failed_queries(self):
+        def slow_histogram(queryset, bounds):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_sleep(1)")
+
+        with mock.patch("pricepaid.views.price_histogram", slow_histogram):
+            response = self.get(self.url, self.params)
+
+        self.assertEqual(response.status_code, 503)
+        (entry,) = slow_queries.entries()
+        self.assertEqual(entry["reason"], "failed")
+        self.assertEqual(entry["sql"], "SELECT pg_sleep(1)")
+        self.assertIn("statement timeout", entry["error"])
+        self.assertGreaterEqual(entry["duration_ms"], 50)
+        # Only planned.
+        self.assertEqual(len(entry["plan"]), 1)
+        self.assertNotIn("actual time=", entry["plan"][0])
+
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_LOG_SIZE=3)
+    def test_ring_buffer_bounded(self):
+        for month in range(1, 5):
+            self.get(self.url, {"date": f"2020-{month:02}"})
+
+        entries = slow_queries.entries()
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries[-1]["query_string"], "date=2020-04")
+        self.assertEqual(
+            len(glob.glob(os.path.join(settings.SLOW_QUERY_LOG_DIR, "*.json"))), 3
+        )
+
+    def test_fingerprint_ignores_in_list_length(self):
+        self.assertEqual(
+            slow_queries.fingerprint("SELECT 1 WHERE a IN (%s, %s)"),
+            slow_queries.fingerprint("SELECT 1\n WHERE a IN (%s,%s, %s)"),
+        )
 
-        bins = sorted(bin_counts.items(), key=lambda item: item[0])
+    @override_settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_EXPLAIN_ANALYZE=True)
+    def test_summary_command(self):
+        self.get(self.url, self.params)
+        self.get("/api/v1/properties/avg_prices")
+
+        output = StringIO()
+        call_command("slow_queries", "--clear", stdout=output)
+
+        output = output.getvalue()
+        self.assertIn("api/v1/properties/count_transactions ?date&postal_code", output)
+        self.assertIn("api/v1/properties/avg_prices ?(no parameters)", output)
+        self.assertIn("actual time=", output)
+        self.assertEqual(slow_queries.entries(), [])
+
+
+class ReplicaRoutingTest(TransactionTestCase):
+    # The replicas are other connections to the test database, which only
+    # see committed rows.
+    url = "/api/v1/properties/avg_prices"
+
+    def setUp(self):
+        for number in range(40):
+            Property.objects.create(
+                postcode=Postcode.intern(["LS7 1NJ", "SE1 7GU"][number % 2]),
+                property_type=random.choice(["T", "D", "S", "F"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(2020, 1 + number % 4, 5),
+            )
+        DatasetVersion.bump()
+        self.add_database("replica_a")
+        self.add_database("replica_b")
+        # Nothing listens on port 1.
+        self.add_database("replica_down", PORT="1")
+        routers.forget_lags()
+        self.addCleanup(routers.forget_lags)
+
+    def add_database(self, alias, **settings_dict):
+        connections.databases[alias] = dict(
+            connections["default"].settings_dict, **settings_dict
+        )
+
+        def remove():
+            connections[alias].close()
+            delattr(connections._connections, alias)
+            del connections.databases[alias]
+
+        self.addCleanup(remove)
+
+    @override_settings(DB_REPLICAS=["replica_a", "replica_b"])
+    def test_round_robin_over_replicas(self):
+        self.assertEqual(
+            {routers.choose_read_alias() for _ in range(4)}, {"replica_a", "replica_b"}
+        )
+
+        with override_settings(DB_REPLICAS=[]):
+            expected = self.client.get(self.url, {"postal_code": "LS7 1NJ"}).json()
+        with CaptureQueriesContext(connection) as primary, CaptureQueriesContext(
+            connections["replica_a"]
+        ) as replica_a, CaptureQueriesContext(connections["replica_b"]) as replica_b:
+            responses = [
+                self.client.get(self.url, {"postal_code": "LS7 1NJ"}) for _ in range(2)
+            ]
+
+        self.assertTrue(expected)
+        self.assertEqual([response.json() for response in responses], [expected] * 2)
+        self.assertEqual(len(primary), 0)
+        self.assertTrue(replica_a and replica_b)
+
+    @override_settings(DB_REPLICAS=["replica_down", "replica_a"])
+    def test_unreachable_replica_skipped(self):
+        with mock.patch.object(
+            routers, "check_lag", wraps=routers.check_lag
+        ) as check_lag, self.assertLogs("common.routers", "WARNING") as logs:
+            aliases = {routers.choose_read_alias() for _ in range(4)}
+        self.assertEqual(aliases, {"replica_a"})
+        # Checked again after DB_REPLICA_CHECK_INTERVAL only.
+        self.assertEqual(check_lag.call_count, 2)
+        self.assertIn("Replica replica_down is unavailable", logs.output[0])
+
+        routers.forget_lags()
+        with override_settings(DB_REPLICAS=["replica_down"]), self.assertLogs(
+            "common.routers", "WARNING"
+        ):
+            self.assertEqual(routers.choose_read_alias(), "default")
+            with CaptureQueriesContext(connection) as primary:
+                response = self.client.get(self.url, {"postal_code": "LS7 1NJ"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(primary)
+
+    @override_settings(
+        DB_REPLICAS=["replica_a", "replica_b"],
+        DB_REPLICA_SELECTION="least_lag",
+        DB_REPLICA_MAX_LAG=30,
+    )
+    def test_least_lagging_replica(self):
+        lags = {"replica_a": 5.0, "replica_b": 1.0}
+        with mock.patch.object(routers, "check_lag", side_effect=lags.get):
+            self.assertEqual(routers.choose_read_alias(), "replica_b")
+
+        routers.forget_lags()
+        lags["replica_b"] = 60.0
+        with mock.patch.object(routers, "check_lag", side_effect=lags.get):
+            self.assertEqual(routers.choose_read_alias(), "replica_a")
+
+        routers.forget_lags()
+        lags["replica_a"] = None
+        with mock.patch.object(routers, "check_lag", side_effect=lags.get):
+            self.assertEqual(routers.choose_read_alias(), "default")
+
+    def test_lag_of_a_primary(self):
+        self.assertEqual(routers.check_lag("replica_a"), 0)
+        with self.assertLogs("common.routers", "WARNING"):
+            self.assertIsNone(routers.check_lag("replica_down"))
+
+    def test_writes_go_to_primary(self):
+        with read_replica("replica_a"), CaptureQueriesContext(
+            connection
+        ) as primary, CaptureQueriesContext(connections["replica_a"]) as replica:
+            self.assertEqual(router.db_for_write(Property), "default")
+            sale = Property.objects.select_related("postcode").first()
+            sale.price += 1
+            sale.save()
+            DatasetVersion.bump()
+
+        self.assertEqual(sale._state.db, "default")
+        self.assertTrue(all(query["sql"].startswith("SELECT") for query in replica))
+        self.assertTrue(
+            any(query["sql"].startswith("UPDATE") for query in primary), primary
+        )
+        # Outside of the block, reads go to the primary too.
+        self.assertEqual(router.db_for_read(Property), "default")
+
+
+class AdmissionControlTest(TransactionTestCase):
+    # A timed out query aborts the transaction it runs in.
+    url = "/api/v1/properties/count_transactions"
+    route = "api/v1/properties/count_transactions"
+
+    def setUp(self):
+        for number in range(40):
+            Property.objects.create(
+                postcode=Postcode.intern(["LS7 1NJ", "LS7 2CD"][number % 2]),
+                property_type=random.choice(["T", "D", "S", "F"]),
+                price=random.randint(50000, 1000000),
+                transfer_date=datetime.date(2020, 1 + number % 4, 5),
+            )
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        overridden = override_settings(
+            ADMISSION_DIR=directory.name,
+            EXPENSIVE_QUERY_CONCURRENCY=1,
+            EXPENSIVE_QUERY_QUEUE_SIZE=1,
+            METRICS_DIR="",
+        )
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        for counter in (metrics.REQUESTS_SHED, metrics.REQUESTS_TIMED_OUT):
+            patcher = mock.patch.object(counter, "series", {})
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def hold(self, kind):
+        """Takes the first slot or queue file as another worker would."""
+        file = open(os.path.join(settings.ADMISSION_DIR, f"{kind}-0.lock"), "a")
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.addCleanup(file.close)
+        return file
+
+    def assertOverloaded(self, response):
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "5")
+        self.assertIn("error", json.loads(response.content))
+
+    def test_expensive_requests_shed_when_queue_full(self):
+        self.client.get(self.url, {"postal_code": "LS7 1NJ"})
+        self.hold("slot")
+        self.hold("queue")
+
+        self.assertOverloaded(self.client.get(self.url))
+        self.assertOverloaded(self.client.get(self.url, {"postal_district": "LS7"}))
+        # Narrowed by a postcode or a date, or average prices.
+        for url, params in [
+            (self.url, {"postal_code": "LS7 1NJ"}),
+            (self.url, {"date": "2020-01"}),
+            ("/api/v1/properties/avg_prices", {}),
+        ]:
+            self.assertEqual(self.client.get(url, params).status_code, 200)
+
+        self.assertEqual(
+            metrics.REQUESTS_SHED.series, {(self.route, "queue_full"): [2]}
+        )
+        self.assertIn(
+            f'pricepaid_requests_shed_total{{route="{self.route}",'
+            'reason="queue_full"} 2',
+            metrics.render_metrics(),
+        )
+
+    @override_settings(EXPENSIVE_QUERY_QUEUE_TIMEOUT=0.05)
+    def test_queued_request_shed_after_timeout(self):
+        self.hold("slot")
+
+        self.assertOverloaded(self.client.get(self.url))
+        self.assertEqual(
+            metrics.REQUESTS_SHED.series, {(self.route, "queue_timeout"): [1]}
+        )
+
+    @override_settings(EXPENSIVE_QUERY_QUEUE_TIMEOUT=10)
+    def test_queued_request_served_once_a_slot_is_free(self):
+        expected = self.client.get(self.url)
+        slot = self.hold("slot")
+        threading.Timer(0.1, slot.close).start()
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.content, expected.content)
+        self.assertEqual(metrics.REQUESTS_SHED.series, {})
+
+    @override_settings(
+        API_CACHE_ENABLED=True,
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "api": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "api-admission-tests",
+            },
+        },
+    )
+    def test_cached_and_not_modified_responses_not_admitted(self):
+        caches["api"].clear()
+        cached = self.client.get(self.url)
+        self.assertEqual(cached["X-Cache"], "MISS")
+        self.hold("slot")
+        self.hold("queue")
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Cache"], "HIT")
+        self.assertEqual(response.content, cached.content)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=cached["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.get_async(async_views.count_transactions, {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Cache"], "HIT")
+        # Headers of the ASGI scope, under their own names.
+        response = self.get_async(
+            async_views.count_transactions, {}, **{"if-none-match": cached["ETag"]}
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(metrics.REQUESTS_SHED.series, {})
+
+    @override_settings(API_STATEMENT_TIMEOUTS={"count_transactions": 50})
+    def test_statement_timeout(self):
+        def slow_histogram(queryset, bounds):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_sleep(1)")
+
+        with mock.patch("pricepaid.views.price_histogram", slow_histogram):
+            self.assertOverloaded(self.client.get(self.url, {"postal_code": "LS7 1NJ"}))
+        self.assertEqual(metrics.REQUESTS_TIMED_OUT.series, {(self.route,): [1]})
+
+        # Reset on the connection afterwards.
+        self.assertEqual(
+            self.client.get(self.url, {"postal_code": "LS7 1NJ"}).status_code, 200
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW statement_timeout")
+            self.assertEqual(cursor.fetchone()[0], "0")
+
+    def get_async(self, view, params, **headers):
+        request = AsyncRequestFactory().get(f"/?{urlencode(params)}", **headers)
+
+        async def get():
+            try:
+                return await view(request)
+            finally:
+                await close_pool()
+
+        return async_to_sync(get)()
+
+    def test_async_views(self):
+        self.hold("slot")
+        self.hold("queue")
+
+        self.assertOverloaded(self.get_async(async_views.count_transactions, {}))
+        response = self.get_async(
+            async_views.count_transactions, {"postal_code": "LS7 1NJ"}
+        )
+        self.assertEqual(response.status_code, 200)
 
-        for expected, actual in zip(bins, response.data):
-            bin_start = expected[0] // THOUSAND2K
-            bin_end = (expected[0] + bin_width) // THOUSAND2K
-            expected_count = expected[1]
-            expected_bin_range = f"£{bin_start}k - £{bin_end}k"
+        async def sleep():
+            try:
+                with query_timeout(0.05):
+                    await fetch("SELECT pg_sleep(1)")
+            finally:
+                await close_pool()
 
-            self.assertEqual(expected_bin_range, actual["bin_range"])
-            self.assertEqual(expected_count, actual["bin_size"])
+        with self.assertRaises(asyncio.TimeoutError):
+            async_to_sync(sleep)()
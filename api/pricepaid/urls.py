@@ -1,8 +1,19 @@
+from django.conf import settings
 from django.urls import path
 
-from .views import PropertyAveragePriceList, PropertyTransactionCountList
+from . import async_views
+from .views import (PropertyAveragePriceBatch, PropertyAveragePriceList,
+                    PropertyTransactionCountList)
+
+if settings.API_ASYNC_VIEWS:
+    average_prices = async_views.average_prices
+    count_transactions = async_views.count_transactions
+else:
+    average_prices = PropertyAveragePriceList.as_view()
+    count_transactions = PropertyTransactionCountList.as_view()
 
 urlpatterns = [
-    path("properties/avg_prices", PropertyAveragePriceList.as_view()),
-    path("properties/count_transactions", PropertyTransactionCountList.as_view()),
+    path("properties/avg_prices", average_prices),
+    path("properties/avg_prices/batch", PropertyAveragePriceBatch.as_view()),
+    path("properties/count_transactions", count_transactions),
 ]
@@ -1,31 +1,185 @@
-import math
-
-from common.utils import from_year_month_to_datetime
-from django.db.models import (Avg, CharField, Count, F, IntegerField, Max, Sum,
-                              Value, Window)
-from django.db.models.functions import (Concat, ExtractMonth, ExtractYear,
-                                        Floor, Ntile)
-from django_cte import With
+import calendar
+from contextlib import ExitStack, contextmanager
+
+import pyarrow as pa
+from common import admission, metrics
+from common.exceptions import IllegalDateError, IllegalFilterError
+from common.routers import current_read_alias, mark_unavailable, read_replica
+from common.timing import phase
+from common.utils import (canonical_postal_code, canonical_postal_prefix,
+                          canonical_postal_sector, from_year_month_to_datetime)
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError
+from django.db.models import DecimalField, F, FloatField, Q, Sum
+from django.db.models.functions import Cast
 from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import (OpenApiExample, OpenApiParameter,
                                    extend_schema, extend_schema_serializer,
                                    inline_serializer)
-from rest_framework import generics, serializers
+from rest_framework import generics, serializers, views
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
-from .models import Property
+from .batch import ALL_PERIODS, AVERAGE_PRICE_TYPES, batch_average_prices
+from .cache import CachedListMixin
+from .column_store import current_column_store
+from .fine_histograms import fine_price_histogram
+from .histogram import price_histogram
+from .models import (ALL_POSTAL_CODES, POSTAL_LEVELS, Property,
+                     PropertyMonthlyRollup, postal_level_key)
+from .renderers import (ArrowStreamRenderer, ColumnarListMixin,
+                        FastJSONListMixin, FastJSONRenderer, ParquetRenderer)
 from .serializers import AvgPriceSerializer, TransactionCountSerializer
+from .sketches import sketch_outlier_bounds
+
+# Rollup sums and counts are divided as numerics, like Avg("price") does.
+ROLLUP_NUMERIC = DecimalField(max_digits=20, decimal_places=0)
+
+# JSON by default, Arrow IPC or Parquet on request.
+LIST_RENDERER_CLASSES = [
+    FastJSONRenderer,
+    *[
+        renderer
+        for renderer in api_settings.DEFAULT_RENDERER_CLASSES
+        if renderer.format != "json"
+    ],
+    ArrowStreamRenderer,
+    ParquetRenderer,
+]
+
+# Postcode query parameters and their canonical forms, at most one of them
+# filters a request.
+POSTCODE_FILTERS = {
+    "postal_code": canonical_postal_code,
+    "postal_area": canonical_postal_prefix,
+    "postal_district": canonical_postal_prefix,
+    "postal_sector": canonical_postal_sector,
+}
+
+
+# OpenAPI parameters of the postcode level filters, shared by the views.
+POSTCODE_LEVEL_PARAMETERS = [
+    OpenApiParameter(
+        name=name,
+        type=str,
+        description=f"Filter by postcode {level} (case and spacing insensitive).<br>"
+        "<b>Also note that only one of the postcode parameters can be given</b>.",
+        required=False,
+        examples=[
+            OpenApiExample(
+                f"Example {number}",
+                summary=value,
+                description=f"Postcode {level} : {value}",
+                value=value,
+            )
+            for number, value in enumerate(examples, start=1)
+        ],
+    )
+    for name, level, examples in [
+        ("postal_area", "area", ["LS", "SE"]),
+        ("postal_district", "district", ["LS7", "SE1"]),
+        ("postal_sector", "sector", ["LS7 1", "SE1 7"]),
+    ]
+]
+
+
+def get_postcode_filter(query_params):
+    """
+    The canonical postcode filter of the query parameters as a
+    {parameter: value} dict, empty if there is none.
+    """
+    filters = {
+        name: canonical(query_params[name])
+        for name, canonical in POSTCODE_FILTERS.items()
+        if query_params.get(name) is not None
+    }
+    if len(filters) > 1:
+        raise IllegalFilterError(
+            f"Only one of {', '.join(POSTCODE_FILTERS)} can be given"
+        )
+    for name, value in filters.items():
+        # The key of the rollup rows over all postcodes.
+        if ALL_POSTAL_CODES in value:
+            raise IllegalFilterError(f"{name} cannot contain '{ALL_POSTAL_CODES}'")
+    return filters
+
+
+def get_average_price_filters(params):
+    """Normalized average price filters of the query parameters or spec."""
+    filters = get_postcode_filter(params)
+    start = params.get("from")
+    end = params.get("to")
+
+    if start is not None and end is not None:
+        filters["from"] = from_year_month_to_datetime(start)
+        filters["to"] = from_year_month_to_datetime(end, last_day=True)
+
+    return filters
+
+
+class ReplicaReadMixin:
+    """Runs the read-only view on a read replica, see common.routers."""
+
+    def dispatch(self, request, *args, **kwargs):
+        with read_replica() as alias:
+            try:
+                return super().dispatch(request, *args, **kwargs)
+            except OperationalError:
+                if alias != DEFAULT_DB_ALIAS:
+                    mark_unavailable(alias)
+                raise
+
+
+class AdmissionControlMixin:
+    """
+    Runs the queries answering the view under the statement timeout of its
+    endpoint, and those of expensive requests in an admission slot, see
+    common.admission. Listed after CachedListMixin, so that conditional
+    requests and cache hits are answered without waiting for a slot.
+    """
+
+    endpoint = None
+
+    @contextmanager
+    def admitted(self):
+        """Runs the queries of the block as the endpoint's."""
+        with ExitStack() as stack:
+            if self.is_expensive():
+                stack.enter_context(admission.admitted(metrics.route_of(self.request)))
+            stack.enter_context(
+                admission.statement_timeout(
+                    current_read_alias(), admission.statement_timeout_ms(self.endpoint)
+                )
+            )
+            yield
+
+    def list(self, request, *args, **kwargs):
+        with self.admitted():
+            return super().list(request, *args, **kwargs)
+
+    def is_expensive(self):
+        return False
+
+    def handle_exception(self, exc):
+        if admission.is_statement_timeout(exc):
+            exc = admission.timed_out(metrics.route_of(self.request))
+        return super().handle_exception(exc)
+
+
+def is_expensive_count(filters):
+    """
+    Whether a transaction count with the filters may scan a large share of
+    the rows, i.e. is narrowed by neither a date nor a postcode or sector.
+    """
+    return not filters.keys() & {"date", "postal_code", "postal_sector"}
 
-# Bin count is not constant.
-MAX_BIN_COUNT = 8
-# Zeros (i.e. masks) the last DECIMAL_PLACES digits of bin_width
-# to show more clear bin seperations.
-DECIMAL_PLACES = 2
-# Calculate bin_widht according to significant property prices.
-# (max_price - min_price)/bin_count produces very bad histograms.
-LOWER_OUTLIER_BOUNDARY = 0.05
-UPPER_OUTLIER_BOUNDARY = 0.95
-# To represent numbers in packed kilo metric.
-THOUSAND2K = 1000
+
+def rollup_key(filters):
+    """Key of the rollup rows matching the postcode filter."""
+    for level in POSTAL_LEVELS:
+        if f"postal_{level}" in filters:
+            return postal_level_key(level, filters[f"postal_{level}"])
+    return filters.get("postal_code", ALL_POSTAL_CODES)
 
 
 @extend_schema(
@@ -34,7 +188,7 @@ THOUSAND2K = 1000
         OpenApiParameter(
             name="postal_code",
             type=str,
-            description="Filter by postal code",
+            description="Filter by postal code (case and spacing insensitive)",
             required=False,
             examples=[
                 OpenApiExample(
@@ -51,6 +205,7 @@ THOUSAND2K = 1000
                 ),
             ],
         ),
+        *POSTCODE_LEVEL_PARAMETERS,
         OpenApiParameter(
             name="from",
             type=OpenApiTypes.DATE,
@@ -112,35 +267,172 @@ THOUSAND2K = 1000
         )(inline_serializer("Error400", {"string": serializers.CharField()})),
     },
 )
-class PropertyAveragePriceList(generics.ListAPIView):
+class PropertyAveragePriceList(
+    ReplicaReadMixin,
+    CachedListMixin,
+    AdmissionControlMixin,
+    ColumnarListMixin,
+    FastJSONListMixin,
+    generics.ListAPIView,
+):
     serializer_class = AvgPriceSerializer
+    renderer_classes = LIST_RENDERER_CLASSES
+    cache_name = endpoint = "avg_prices"
+    columnar_schema = pa.schema(
+        [
+            ("property_type", pa.string()),
+            ("month", pa.int16()),
+            ("year", pa.int16()),
+            ("avg_price", pa.float64()),
+        ]
+    )
 
-    def get_queryset(self):
-        queryset = Property.objects.all()
-        postal_code = self.request.query_params.get("postal_code")
-        if postal_code is not None:
-            queryset = queryset.filter(postal_code=postal_code)
+    def get_filters(self):
+        return get_average_price_filters(self.request.query_params)
 
-        start = self.request.query_params.get("from")
-        end = self.request.query_params.get("to")
+    def get_queryset(self):
+        filters = self.get_filters()
+        # Answered from the monthly rollups, see pricepaid.rollups.
+        queryset = PropertyMonthlyRollup.objects.filter(postal_code=rollup_key(filters))
 
-        if start is not None and end is not None:
-            start_date = from_year_month_to_datetime(start)
-            end_date = from_year_month_to_datetime(end, last_day=True)
-            queryset = queryset.filter(transfer_date__range=[start_date, end_date])
+        if "from" in filters:
+            start_date, end_date = filters["from"], filters["to"]
+            queryset = queryset.filter(
+                Q(year__gt=start_date.year)
+                | Q(year=start_date.year, month__gte=start_date.month),
+                Q(year__lt=end_date.year)
+                | Q(year=end_date.year, month__lte=end_date.month),
+            )
 
         queryset = (
-            queryset.annotate(
-                month=ExtractMonth("transfer_date"), year=ExtractYear("transfer_date")
-            )
-            .filter(property_type__in=["T", "D", "S", "F"])
+            queryset.filter(property_type__in=AVERAGE_PRICE_TYPES)
             .values("property_type", "month", "year")
-            .annotate(avg_price=Avg("price"))
-            .order_by("year", "month")
+            .annotate(
+                avg_price=Cast(Sum("price_sum"), ROLLUP_NUMERIC)
+                / Cast(Sum("price_count"), ROLLUP_NUMERIC)
+            )
+            .order_by("year", "month", "property_type")
         )
 
         return queryset
 
+    def get_json_rows(self):
+        store = current_column_store(self.dataset_version.generation)
+        if store is not None:
+            return store.average_prices(self.get_filters())
+        return self.get_queryset().values_list(
+            "property_type", "month", "year", "avg_price"
+        )
+
+    def get_columnar_rows(self):
+        store = current_column_store(self.dataset_version.generation)
+        if store is not None:
+            return [
+                (property_type, month, year, float(avg_price))
+                for property_type, month, year, avg_price in store.average_prices(
+                    self.get_filters()
+                )
+            ]
+        return (
+            self.get_queryset()
+            .annotate(avg_price_value=Cast(F("avg_price"), FloatField()))
+            .values_list("property_type", "month", "year", "avg_price_value")
+        )
+
+
+@extend_schema(
+    description="Average property prices of many specs in one request. Each "
+    "spec takes the parameters of /properties/avg_prices and an optional id "
+    "(defaults to its position in the list), results and errors are keyed by "
+    "spec id.",
+    request=inline_serializer(
+        "AvgPriceBatchRequest",
+        {
+            "specs": serializers.ListField(
+                child=inline_serializer(
+                    "AvgPriceSpec",
+                    {
+                        name: serializers.CharField(required=False)
+                        for name in ["id", *POSTCODE_FILTERS, "from", "to"]
+                    },
+                )
+            )
+        },
+    ),
+    responses={
+        200: inline_serializer(
+            "AvgPriceBatchResponse",
+            {
+                "results": serializers.DictField(
+                    child=inline_serializer(
+                        "AvgPriceSpecResult",
+                        {
+                            "data": AvgPriceSerializer(many=True, required=False),
+                            "error": serializers.CharField(required=False),
+                        },
+                    )
+                )
+            },
+        ),
+        400: extend_schema_serializer(
+            many=False,
+            examples=[
+                OpenApiExample(
+                    "Invalid Request",
+                    value={"error": "At most 5000 specs can be given"},
+                    status_codes=["400"],
+                )
+            ],
+        )(inline_serializer("BatchError400", {"string": serializers.CharField()})),
+    },
+)
+class PropertyAveragePriceBatch(ReplicaReadMixin, AdmissionControlMixin, views.APIView):
+    endpoint = "avg_prices_batch"
+
+    def post(self, request, *args, **kwargs):
+        specs = request.data.get("specs") if isinstance(request.data, dict) else None
+        if not isinstance(specs, list):
+            raise IllegalFilterError("'specs' should be a list of filters")
+        if len(specs) > settings.BATCH_MAX_SPECS:
+            raise IllegalFilterError(
+                f"At most {settings.BATCH_MAX_SPECS} specs can be given"
+            )
+
+        results, valid = {}, {}
+        for position, spec in enumerate(specs):
+            spec_id = str(position)
+            if isinstance(spec, dict) and "id" in spec:
+                spec_id = str(spec["id"])
+            if spec_id in results:
+                raise IllegalFilterError(f"Spec id {spec_id} is given twice")
+            try:
+                filters = self.get_spec_filters(spec)
+            except (IllegalDateError, IllegalFilterError) as error:
+                results[spec_id] = {"error": error.message}
+                continue
+            periods = ALL_PERIODS
+            if "from" in filters:
+                periods = tuple(
+                    filters[name].year * 100 + filters[name].month
+                    for name in ("from", "to")
+                )
+            results[spec_id] = None
+            valid[spec_id] = (rollup_key(filters), *periods)
+
+        with self.admitted():
+            rows_by_spec = batch_average_prices(valid)
+        for spec_id, rows in rows_by_spec.items():
+            results[spec_id] = {"data": AvgPriceSerializer(rows, many=True).data}
+        return Response({"results": results})
+
+    def get_spec_filters(self, spec):
+        if not isinstance(spec, dict):
+            raise IllegalFilterError("A spec should be an object of filters")
+        params = {name: value for name, value in spec.items() if name != "id"}
+        if not all(isinstance(value, str) for value in params.values()):
+            raise IllegalFilterError("Spec filters should be strings")
+        return get_average_price_filters(params)
+
 
 @extend_schema(
     description="Number of transactions over time",
@@ -148,7 +440,7 @@ class PropertyAveragePriceList(generics.ListAPIView):
         OpenApiParameter(
             name="postal_code",
             type=str,
-            description="Filter by postal code",
+            description="Filter by postal code (case and spacing insensitive)",
             required=False,
             examples=[
                 OpenApiExample(
@@ -165,6 +457,7 @@ class PropertyAveragePriceList(generics.ListAPIView):
                 ),
             ],
         ),
+        *POSTCODE_LEVEL_PARAMETERS,
         OpenApiParameter(
             name="date",
             type=OpenApiTypes.DATE,
@@ -203,102 +496,74 @@ class PropertyAveragePriceList(generics.ListAPIView):
         )(inline_serializer("Error400", {"string": serializers.CharField()})),
     },
 )
-class PropertyTransactionCountList(generics.ListAPIView):
+class PropertyTransactionCountList(
+    ReplicaReadMixin,
+    CachedListMixin,
+    AdmissionControlMixin,
+    ColumnarListMixin,
+    FastJSONListMixin,
+    generics.ListAPIView,
+):
     serializer_class = TransactionCountSerializer
+    renderer_classes = LIST_RENDERER_CLASSES
+    cache_name = endpoint = "count_transactions"
+    columnar_schema = pa.schema([("bin_range", pa.string()), ("bin_size", pa.int64())])
 
-    def get_queryset(self):
-        queryset = Property.objects.all()
-        postal_code = self.request.query_params.get("postal_code")
-        if postal_code is not None:
-            queryset = queryset.filter(postal_code=postal_code)
+    def is_expensive(self):
+        return is_expensive_count(self.get_filters())
+
+    def get_filters(self):
+        filters = get_postcode_filter(self.request.query_params)
 
         date = self.request.query_params.get("date")
 
         if date is not None:
-            start_date = from_year_month_to_datetime(date)
-            end_date = from_year_month_to_datetime(date, last_day=True)
-            queryset = queryset.filter(transfer_date__range=[start_date, end_date])
+            filters["date"] = from_year_month_to_datetime(date)
 
-        # check if queryset is empyty
-        if not queryset:
-            return queryset.none()
+        return filters
 
-        queryset_count = queryset.count()
+    def get_queryset(self):
+        filters = self.get_filters()
+        queryset = Property.objects.all()
+        # Levels are matched on the indexed postcode dictionary columns.
+        for name in POSTCODE_FILTERS:
+            if name in filters:
+                queryset = queryset.filter(**{f"postcode__{name}": filters[name]})
 
-        normal_range_start = math.ceil(LOWER_OUTLIER_BOUNDARY * queryset_count)
-        normal_range_end = math.ceil(UPPER_OUTLIER_BOUNDARY * queryset_count)
+        year = month = None
+        if "date" in filters:
+            start_date = filters["date"].date()
+            last_day = calendar.monthrange(start_date.year, start_date.month)[1]
+            end_date = start_date.replace(day=last_day)
+            queryset = queryset.filter(transfer_date__range=[start_date, end_date])
+            year, month = start_date.year, start_date.month
 
-        quartiles_cte = With(
-            queryset.annotate(
-                price_quartile=Window(
-                    expression=Ntile(num_buckets=queryset_count),
-                    order_by=F("price").asc(),
-                )
-            ).values("price", "price_quartile")
-        )
-        iqr = (
-            quartiles_cte.queryset()
-            .with_cte(quartiles_cte)
-            .values("price_quartile")
-            .filter(price_quartile__in=[normal_range_start, normal_range_end])
-            .annotate(quartile_break=Max("price"))
-            .order_by("price_quartile")
-        )
+        if settings.FINE_HISTOGRAMS_ENABLED:
+            with phase("binning"):
+                rows = fine_price_histogram(rollup_key(filters), year, month)
+            if rows is not None:
+                return rows
 
-        if len(iqr) == 2:
-            min_price = iqr[0]["quartile_break"]
-            max_price = iqr[1]["quartile_break"]
-            bin_width = (max_price - min_price) / (MAX_BIN_COUNT - 1)
-            mask_digit = pow(10, DECIMAL_PLACES)
-            bin_width = math.ceil(bin_width / mask_digit) * mask_digit
-            bin_width = 1 if bin_width == 0 else bin_width  # if max_price == min_price
-        else:  # if there is only one item in queryset
-            bin_width = 1
-
-        gt_count = queryset.filter(price__gt=max_price).count()
-
-        lte_max_price = (
-            queryset.annotate(bin_floor=Floor(F("price") / bin_width) * bin_width)
-            .values("bin_floor")
-            .filter(price__lte=max_price)
-            .annotate(count=Count("id"))
-        )
-        gt_max_price = (
-            queryset.annotate(
-                bin_floor=Value(
-                    int(max_price / bin_width) * bin_width,
-                    output_field=IntegerField(),
-                ),
-                count=Value(gt_count, output_field=IntegerField()),
-            )
-            .values("bin_floor", "count")
-            .filter(price__gt=max_price)
-        )
+        bounds = None
+        if settings.QUANTILE_SKETCH_ENABLED:
+            # Falls back to the exact bounds if no sketch covers the request.
+            with phase("quantile"):
+                bounds = sketch_outlier_bounds(
+                    rollup_key(filters),
+                    year,
+                    month,
+                    self.dataset_version.sketch_relative_accuracy,
+                )
 
-        union_cte = With(gt_max_price.union(lte_max_price))
+        return price_histogram(queryset, bounds)
 
-        queryset = (
-            union_cte.queryset()
-            .with_cte(union_cte)
-            .values("bin_floor")
-            .annotate(bin_size=Sum("count"))
-            .order_by("bin_floor")
-        )
-        queryset = (
-            queryset.values("bin_floor", "bin_size")
-            .annotate(
-                bin_range=Concat(
-                    Value("£"),
-                    Floor(F("bin_floor") / THOUSAND2K),
-                    Value("k"),
-                    Value(" - "),
-                    Value("£"),
-                    Floor((F("bin_floor") + bin_width) / THOUSAND2K),
-                    Value("k"),
-                    output_field=CharField(),
-                )
-            )
-            .order_by("bin_floor")
-        )
+    def get_json_rows(self):
+        store = current_column_store(self.dataset_version.generation)
+        if store is not None:
+            rows = store.price_histogram(self.get_filters())
+        else:
+            rows = self.get_queryset()
+        return [(row["bin_range"], row["bin_size"]) for row in rows]
 
-        return queryset
+    def get_columnar_rows(self):
+        return self.get_json_rows()
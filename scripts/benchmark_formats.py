@@ -0,0 +1,85 @@
+"""Benchmark Formats
+Usage:
+  benchmark_formats.py [--api-url=<str>] [--repeat=<int>] [--formats=<str>]
+  benchmark_formats.py (-h | --help)
+
+Fetches the same requests in each response format and reports the payload
+size and the end-to-end time until the response is a pandas DataFrame,
+which is what the notebook client does with it.
+
+Example, try:
+  python benchmark_formats.py --api-url=http://localhost:8000 --repeat=10
+
+Options:
+  -h --help                                  Show this screen.
+  --api-url=<str>                            Base URL of the API [default: http://localhost:8000].
+  --repeat=<int>                             Requests per format, the median time is reported
+                                             [default: 5].
+  --formats=<str>                            Comma separated response formats to compare
+                                             [default: json,arrow,parquet].
+"""
+
+import io
+import statistics
+import sys
+import time
+
+import pandas as pd
+import pyarrow as pa
+import requests
+from docopt import docopt
+
+REQUESTS = [
+    ("avg_prices", {}),
+    ("avg_prices", {"postal_district": "LS7"}),
+    ("count_transactions", {}),
+]
+
+
+def to_dataframe(response_format, content):
+    if response_format == "json":
+        return pd.read_json(io.BytesIO(content), orient="records")
+    if response_format == "arrow":
+        return pa.ipc.open_stream(content).read_pandas()
+    return pd.read_parquet(io.BytesIO(content))
+
+
+def fetch(session, url, params, response_format):
+    """Returns (payload bytes, seconds, rows) of one request."""
+    started = time.perf_counter()
+    response = session.get(url, params={**params, "format": response_format})
+    response.raise_for_status()
+    frame = to_dataframe(response_format, response.content)
+    return len(response.content), time.perf_counter() - started, len(frame)
+
+
+def main(api_url, repeat, response_formats):
+    session = requests.Session()
+    print(
+        f"{'request':<40} {'format':>8} {'rows':>7} {'bytes':>10} {'median ms':>10}"
+    )
+    for endpoint, params in REQUESTS:
+        url = f"{api_url}/api/v1/properties/{endpoint}"
+        name = endpoint + "".join(f" {key}={value}" for key, value in params.items())
+        for response_format in response_formats:
+            # The first request warms the server side caches.
+            size, _, rows = fetch(session, url, params, response_format)
+            times = [
+                fetch(session, url, params, response_format)[1] for _ in range(repeat)
+            ]
+            print(
+                f"{name:<40} {response_format:>8} {rows:>7} {size:>10} "
+                f"{statistics.median(times) * 1000:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+
+    response_formats = args["--formats"].split(",")
+    unknown = set(response_formats) - {"json", "arrow", "parquet"}
+    if unknown:
+        print(f"Error: unknown format(s) {', '.join(sorted(unknown))}")
+        sys.exit(1)
+
+    main(args["--api-url"].rstrip("/"), int(args["--repeat"]), response_formats)
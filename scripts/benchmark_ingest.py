@@ -0,0 +1,112 @@
+"""Benchmark Ingest
+Usage:
+  benchmark_ingest.py --price-paid-data=<str> --db-name=<str> --db-user=<str> --db-pass=<str> --db-host=<str> [--copy-formats=<str>] [--chunk-sizes=<str>]
+  benchmark_ingest.py (-h | --help)
+
+Copies the same file with each COPY format into a temporary load table
+(nothing is committed) and reports the throughput and the peak memory
+of the loading process.
+
+Example, try:
+  python benchmark_ingest.py --price-paid-data=pp-2020.csv --db-name=mydb --db-user=myuser --db-pass=secret --db-host=localhost
+
+Options:
+  -h --help                                  Show this screen.
+  -pp, --price-paid-data=<str>               Price paid data file name.
+  -db, --db-name=<str>                       DB name.
+  -u, --db-user=<str>                        DB user.
+  -p, --db-pass=<str>                        DB password.
+  -hn, --db-host=<str>                       DB hostname.
+  --copy-formats=<str>                       Comma separated COPY formats to compare
+                                             [default: pandas,csv,binary].
+  --chunk-sizes=<str>                        Comma separated chunk sizes to run each format
+                                             with [default: 10000,100000].
+"""
+
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import psycopg2
+from docopt import docopt
+
+import populate_db
+
+
+def run(db_info, csv_file, copy_format, chunk_size, results):
+    """Benchmark process: copies the whole file once and reports the figures."""
+    populate_db.CHUNK_SIZE = chunk_size
+    conn = psycopg2.connect(**db_info)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMP TABLE pricepaid_benchmark ({populate_db.LOAD_TABLE_COLUMNS})"
+            )
+        started = time.perf_counter()
+        rows = populate_db.copy_rows(
+            conn, "pricepaid_benchmark", csv_file, copy_format=copy_format
+        )
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.rollback()
+        conn.close()
+    # ru_maxrss is in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results.put((rows, elapsed, peak))
+
+
+def main(db_info, csv_file, copy_formats, chunk_sizes):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    size = os.path.getsize(csv_file) / 2 ** 20
+    print(f"{csv_file}: {size:.0f} MiB")
+    print(
+        f"{'format':>8} {'chunk':>8} {'rows':>10} {'seconds':>8} "
+        f"{'rows/sec':>10} {'peak MiB':>9}"
+    )
+    for copy_format in copy_formats:
+        for chunk_size in chunk_sizes:
+            process = context.Process(
+                target=run,
+                args=(db_info, csv_file, copy_format, chunk_size, results),
+            )
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f"{copy_format:>8} {chunk_size:>8} failed")
+                continue
+            rows, elapsed, peak = results.get()
+            print(
+                f"{copy_format:>8} {chunk_size:>8} {rows:>10} {elapsed:>8.1f} "
+                f"{rows / elapsed:>10.0f} {peak:>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+
+    db_info = {
+        "host": args["--db-host"],
+        "database": args["--db-name"],
+        "user": args["--db-user"],
+        "password": args["--db-pass"],
+    }
+    copy_formats = args["--copy-formats"].split(",")
+    chunk_sizes = [int(chunk_size) for chunk_size in args["--chunk-sizes"].split(",")]
+
+    assert os.path.exists(
+        args["--price-paid-data"]
+    ), f"Price paid file {args['--price-paid-data']} does not exist!"
+    unknown = set(copy_formats) - set(populate_db.COPY_FORMATS)
+    if unknown:
+        print(f"Error: unknown copy format(s) {', '.join(sorted(unknown))}")
+        sys.exit(1)
+
+    main(
+        db_info,
+        args["--price-paid-data"],
+        copy_formats,
+        chunk_sizes,
+    )
@@ -0,0 +1,98 @@
+"""Load Test
+Usage:
+  load_test.py [--api-url=<str>] [--clients=<str>] [--duration=<int>]
+  load_test.py (-h | --help)
+
+Keeps each number of concurrent clients sending a mix of list requests for
+a fixed duration and reports the throughput and latency percentiles, to
+compare deployments (e.g. the sync and the async profile of
+api/docker-compose.yaml) under the same load.
+
+Example, try:
+  python load_test.py --api-url=http://localhost:8001 --clients=1,16,64
+
+Options:
+  -h --help                                  Show this screen.
+  --api-url=<str>                            Base URL of the API [default: http://localhost:8000].
+  --clients=<str>                            Comma separated numbers of concurrent clients
+                                             [default: 1,8,32].
+  --duration=<int>                           Seconds each number of clients runs [default: 10].
+"""
+
+import itertools
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from docopt import docopt
+
+REQUESTS = [
+    ("avg_prices", {}),
+    ("avg_prices", {"postal_district": "LS7", "from": "2015-01", "to": "2020-12"}),
+    ("count_transactions", {"date": "2020-06"}),
+    ("count_transactions", {"postal_area": "SE"}),
+    ("count_transactions", {"postal_code": "LS7 1NJ"}),
+]
+
+
+def client(api_url, deadline, start):
+    """Sends requests until the deadline, returns (latencies, errors)."""
+    session = requests.Session()
+    latencies, errors = [], 0
+    for name, params in itertools.islice(itertools.cycle(REQUESTS), start, None):
+        if time.perf_counter() >= deadline:
+            break
+        started = time.perf_counter()
+        try:
+            response = session.get(f"{api_url}/api/v1/properties/{name}", params=params)
+            response.raise_for_status()
+        except requests.RequestException:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    return latencies, errors
+
+
+def run(api_url, clients, duration):
+    barrier = threading.Barrier(clients)
+
+    def start(number):
+        barrier.wait()
+        return client(api_url, time.perf_counter() + duration, number)
+
+    with ThreadPoolExecutor(clients) as executor:
+        results = list(executor.map(start, range(clients)))
+    latencies = sorted(itertools.chain.from_iterable(r for r, _ in results))
+    errors = sum(e for _, e in results)
+    return latencies, errors
+
+
+def main(api_url, client_counts, duration):
+    print(
+        f"{'clients':>7} {'requests':>9} {'errors':>7} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for clients in client_counts:
+        latencies, errors = run(api_url, clients, duration)
+        if not latencies:
+            print(f"{clients:>7} {0:>9} {errors:>7}")
+            continue
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(
+            f"{clients:>7} {len(latencies):>9} {errors:>7} "
+            f"{len(latencies) / duration:>8.1f} "
+            f"{statistics.median(latencies) * 1000:>8.1f} "
+            f"{quantiles[94] * 1000:>8.1f} {quantiles[98] * 1000:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+
+    main(
+        args["--api-url"].rstrip("/"),
+        [int(clients) for clients in args["--clients"].split(",")],
+        int(args["--duration"]),
+    )
@@ -1,10 +1,11 @@
 """Populate Database
 Usage:
-  populate_db.py --price-paid-data=<str> --db-table-name=<str> --db-name=<str> --db-user=<str> --db-pass=<str> --db-host=<str>
+  populate_db.py --price-paid-data=<str> --db-table-name=<str> --db-name=<str> --db-user=<str> --db-pass=<str> --db-host=<str> [--workers=<int>] [--copy-format=<str>] [--postcode-table=<str>]
+  populate_db.py --update --price-paid-data=<str> --db-table-name=<str> --db-name=<str> --db-user=<str> --db-pass=<str> --db-host=<str> [--affected-table=<str>] [--copy-format=<str>] [--postcode-table=<str>]
   populate_db.py (-h | --help)
 
 Example, try:
-  python populate_db.py -pp=pp-completed.csv -tn=pricepaid -db=mydb -u=myuser -p=secret -hn=localhost
+  python populate_db.py -pp=pp-completed.csv -tn=pricepaid -db=mydb -u=myuser -p=secret -hn=localhost -w=8
 
 Options:
   -h --help                                  Show this screen.
@@ -14,14 +15,32 @@ Options:
   -u, --db-user=<str>                        DB user.
   -p, --db-pass=<str>                        DB password.
   -hn, --db-host=<str>                       DB hostname.
+  -w, --workers=<int>                        Number of parallel ingest processes [default: 1].
+  --copy-format=<str>                        csv or binary to stream the file rows into COPY,
+                                             pandas to COPY them in DataFrame chunks
+                                             [default: csv].
+  --update                                   Apply a monthly update file (Record Status A/C/D)
+                                             instead of loading a complete file.
+  --affected-table=<str>                     DB table recording the postcode-months changed by
+                                             an update [default: pricepaid_affectedperiod].
+  --postcode-table=<str>                     DB table of the postcodes the table refers to
+                                             [default: pricepaid_postcode].
 """
 
 
+import csv
+import datetime
+import functools
+import io
+import itertools
+import multiprocessing
 import os
+import queue
+import struct
 import sys
+import time
 from io import StringIO
 
-import pandas as pd
 import psycopg2
 from docopt import docopt
 from tqdm import tqdm
@@ -45,29 +64,438 @@ PP_DATA_COLUMN_NAMES = [
     "Record Status",
 ]
 
+# Source columns loaded, with their load table column names.
+SOURCE_COLUMNS = {
+    "Transaction unique identifier": "transaction_id",
+    "Postcode": "postal_code",
+    "Property Type": "property_type",
+    "Price": "price",
+    "Date of Transfer": "transfer_date",
+}
+LOAD_COLUMNS = list(SOURCE_COLUMNS.values())
+# Monthly update files flag every row as (A)dded, (C)hanged or (D)eleted.
+UPDATE_COLUMNS = LOAD_COLUMNS + ["record_status"]
+# The table refers to the postcodes of its dictionary table by id.
+TABLE_COLUMNS = [
+    "transaction_id",
+    "postcode_id",
+    "property_type",
+    "price",
+    "transfer_date",
+]
+# Load table DDL: rows are COPYed into it and then inserted into the table.
+LOAD_TABLE_COLUMNS = """
+    transaction_id uuid,
+    postal_code varchar(50),
+    property_type smallint,
+    price integer,
+    transfer_date date
+"""
+
+# Land Registry property type codes, stored as their position in the tuple
+# (starting from 1), see pricepaid.models.PROPERTY_TYPES.
+PROPERTY_TYPES = ("D", "S", "T", "F", "O")
+PROPERTY_TYPE_NUMBERS = {
+    code: str(number) for number, code in enumerate(PROPERTY_TYPES, 1)
+}
+
 CHUNK_SIZE = 10000
 
+# First year of the price paid data. The table has one partition per year.
+FIRST_YEAR = 1995
+
+COPY_FORMATS = ("csv", "binary", "pandas")
+# Bytes requested from a CopyStream per read(), and rows rendered at a time.
+COPY_BUFFER_SIZE = 64 * 1024
+RENDER_BATCH_SIZE = 500
+
+# Binary COPY signature, flags field and header extension length.
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+PGCOPY_NULL = struct.pack("!i", -1)
+# Binary dates count days since 2000-01-01.
+PG_EPOCH_ORDINAL = datetime.date(2000, 1, 1).toordinal()
+
+
+class IngestError(Exception):
+    """Exception raised when a worker could not load its part of the file.
+
+    Attributes:
+        byte_range -- (start, end) byte offsets of the failed part
+        message -- explanation of the error
+    """
+
+    def __init__(self, byte_range, message):
+        self.byte_range = byte_range
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f"bytes {self.byte_range[0]}-{self.byte_range[1]} -> {self.message}"
+
+
+class ByteRangeReader(io.RawIOBase):
+    """Read-only file object limited to the [start, end) bytes of a file."""
+
+    def __init__(self, file_name, start, end):
+        super().__init__()
+        self._file = open(file_name, "rb")
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        read = self._file.readinto(memoryview(buffer)[:size])
+        self._remaining -= read
+        return read
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def line_aligned_ranges(csv_file, parts):
+    """
+    Splits the file into at most `parts` [start, end) byte ranges
+    which start and end on line boundaries.
+    """
+    size = os.path.getsize(csv_file)
+    offsets = [0]
+    with open(csv_file, "rb") as f:
+        for part in range(1, parts):
+            f.seek(max(size * part // parts, offsets[-1]))
+            f.readline()
+            offsets.append(f.tell())
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+
+def read_chunks(csv_file, start=0, end=None, update=False):
+    """
+    Yields the load table rows of the given byte range as DataFrame chunks,
+    with the record status column for update files.
+    """
+    # Only the pandas copy format needs pandas.
+    import pandas as pd
+
+    if end is None:
+        end = os.path.getsize(csv_file)
+    columns = {**SOURCE_COLUMNS, "Record Status": "record_status"}
+    with io.BufferedReader(ByteRangeReader(csv_file, start, end)) as source:
+        for chunk in pd.read_csv(
+            source,
+            names=PP_DATA_COLUMN_NAMES,
+            usecols=list(columns),
+            chunksize=CHUNK_SIZE,
+        ):
+            chunk.rename(columns=columns, inplace=True)
+            chunk["property_type"] = chunk["property_type"].map(PROPERTY_TYPE_NUMBERS)
+            chunk["transfer_date"] = chunk["transfer_date"].str[:10]
+            if update:
+                # Rows without postcode are merged as deletions.
+                yield chunk[UPDATE_COLUMNS]
+            else:
+                chunk = chunk[chunk["postal_code"].notna()]
+                yield chunk[LOAD_COLUMNS]
+
+
+def read_rows(csv_file, start=0, end=None, update=False):
+    """
+    Yields the load table rows of the given byte range as lists of strings, with
+    the record status column for update files. Empty strings stand for NULL.
+    """
+    if end is None:
+        end = os.path.getsize(csv_file)
+    names = list(SOURCE_COLUMNS) + (["Record Status"] if update else [])
+    indexes = [PP_DATA_COLUMN_NAMES.index(name) for name in names]
+    postal_code = LOAD_COLUMNS.index("postal_code")
+    property_type = LOAD_COLUMNS.index("property_type")
+    transfer_date = LOAD_COLUMNS.index("transfer_date")
+    source = io.BufferedReader(ByteRangeReader(csv_file, start, end))
+    with io.TextIOWrapper(source, encoding="utf-8", newline="") as lines:
+        for record in csv.reader(lines):
+            row = [record[index] for index in indexes]
+            # Rows without postcode are merged as deletions.
+            if update or row[postal_code]:
+                # Unknown property types are left for COPY to reject.
+                row[property_type] = PROPERTY_TYPE_NUMBERS.get(
+                    row[property_type], row[property_type]
+                )
+                row[transfer_date] = row[transfer_date][:10]
+                yield row
+
+
+# Binary fields are their byte length followed by the bytes.
+def _binary_text(value):
+    data = value.encode()
+    return struct.pack("!i", len(data)) + data
+
+
+def _binary_uuid(value):
+    data = bytes.fromhex(value.strip("{}").replace("-", ""))
+    if len(data) != 16:
+        raise ValueError("badly formed UUID")
+    return b"\x00\x00\x00\x10" + data
+
+
+def _binary_int4(value):
+    return struct.pack("!ii", 4, int(value))
+
+
+def _binary_int2(value):
+    return struct.pack("!ih", 2, int(value))
+
+
+# Transfer dates repeat a lot, the encoded dates are cached.
+@functools.lru_cache(maxsize=2 ** 16)
+def _binary_date(value):
+    days = datetime.date.fromisoformat(value).toordinal() - PG_EPOCH_ORDINAL
+    return struct.pack("!ii", 4, days)
+
+
+# Binary COPY field encoders of the load table columns.
+BINARY_ENCODERS = {
+    "transaction_id": _binary_uuid,
+    "postal_code": _binary_text,
+    "property_type": _binary_int2,
+    "price": _binary_int4,
+    "transfer_date": _binary_date,
+    "record_status": _binary_text,
+}
+
+
+class CopyStream(io.RawIOBase):
+    """
+    Read-only file object rendering rows as csv or binary COPY data as COPY
+    reads it, so that only about one read() worth of rows is held in memory.
+
+    on_rows(count) is called for every CHUNK_SIZE rendered rows and for the
+    remainder. Whatever it or the rendering raises aborts the COPY and is
+    kept in `error`.
+    """
+
+    def __init__(self, rows, columns, copy_format="csv", on_rows=None):
+        super().__init__()
+        self.rows = 0
+        self.error = None
+        self._columns = columns
+        self._rows = iter(rows)
+        self._on_rows = on_rows
+        self._reported = 0
+        self._pending = bytearray()
+        if copy_format == "binary":
+            self._encoders = [BINARY_ENCODERS[column] for column in columns]
+            self._field_count = struct.pack("!h", len(columns))
+            self._pending += PGCOPY_HEADER
+            self._trailer = PGCOPY_TRAILER
+            self._render = self._render_binary
+        else:
+            self._text = StringIO()
+            self._writer = csv.writer(self._text, lineterminator="\n")
+            self._trailer = b""
+            self._render = self._render_csv
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            self._fill(len(buffer))
+        except Exception as error:
+            self.error = error
+            raise
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        del self._pending[:size]
+        return size
+
+    def _fill(self, size):
+        while len(self._pending) < size and self._rows is not None:
+            batch = list(itertools.islice(self._rows, RENDER_BATCH_SIZE))
+            if batch:
+                self._pending += self._render(batch)
+                self.rows += len(batch)
+                if self.rows - self._reported >= CHUNK_SIZE:
+                    self._report()
+            else:
+                self._rows = None
+                self._pending += self._trailer
+                self._report()
+
+    def _report(self):
+        if self._on_rows is not None and self.rows > self._reported:
+            self._on_rows(self.rows - self._reported)
+        self._reported = self.rows
+
+    def _render_csv(self, rows):
+        # Empty strings are written unquoted, i.e. as NULL.
+        self._text.seek(0)
+        self._text.truncate()
+        self._writer.writerows(rows)
+        return self._text.getvalue().encode()
+
+    def _render_binary(self, rows):
+        fields = []
+        for line, row in enumerate(rows, self.rows + 1):
+            fields.append(self._field_count)
+            for column, value, encode in zip(self._columns, row, self._encoders):
+                if not value:
+                    fields.append(PGCOPY_NULL)
+                    continue
+                try:
+                    fields.append(encode(value))
+                except (ValueError, struct.error):
+                    raise ValueError(f"row {line}, column {column}: {value!r}")
+        return b"".join(fields)
+
+
+def copy_rows(
+    conn,
+    table,
+    csv_file,
+    start=0,
+    end=None,
+    update=False,
+    copy_format="csv",
+    on_rows=None,
+):
+    """
+    Copies the load table rows of the given byte range into the (load) table
+    in one of the COPY_FORMATS and returns their number. csv and binary stream the
+    rows into COPY, pandas copies them in DataFrame chunks of CHUNK_SIZE.
+
+    on_rows(count) is called as rows are copied. Errors are raised and
+    committing is left to the caller.
+    """
+    if copy_format == "pandas":
+        rows = 0
+        for chunk in read_chunks(csv_file, start, end, update):
+            rows += copy_from_stringio(conn, chunk, table)
+            if on_rows is not None:
+                on_rows(len(chunk))
+        return rows
+
+    columns = UPDATE_COLUMNS if update else LOAD_COLUMNS
+    stream = CopyStream(
+        read_rows(csv_file, start, end, update), columns, copy_format, on_rows
+    )
+    with conn.cursor() as cursor:
+        try:
+            cursor.copy_expert(
+                f"COPY {table} ({', '.join(columns)}) FROM STDIN "
+                f"WITH (FORMAT {copy_format})",
+                stream,
+                size=COPY_BUFFER_SIZE,
+            )
+        except psycopg2.Error:
+            # psycopg2 reports errors of the stream as a canceled COPY.
+            if stream.error is not None:
+                raise stream.error
+            raise
+    return stream.rows
+
+
+def intern_postcodes(conn, db_info, postcode_table, load_table):
+    """
+    Adds the postcodes of the load table missing from the postcode table,
+    with their area, district and sector.
+    They are committed right away over another connection, so that workers
+    adding the same postcode never wait for each other's load transaction.
+    """
+    new_postcodes = io.BytesIO()
+    with conn.cursor() as cursor:
+        cursor.copy_expert(
+            f"""
+            COPY (
+                SELECT DISTINCT l.postal_code FROM {load_table} AS l
+                WHERE l.postal_code IS NOT NULL AND NOT EXISTS (
+                    SELECT FROM {postcode_table} AS d
+                    WHERE d.postal_code = l.postal_code
+                )
+            ) TO STDOUT
+            """,
+            new_postcodes,
+        )
+    new_postcodes.seek(0)
+
+    dictionary_conn = psycopg2.connect(**db_info)
+    try:
+        with dictionary_conn.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMP TABLE pricepaid_new_postcodes (postal_code varchar(50))"
+            )
+            cursor.copy_expert("COPY pricepaid_new_postcodes FROM STDIN", new_postcodes)
+            # Inserted in order so that concurrent workers cannot deadlock.
+            # The levels are derived like common.utils.postal_code_levels():
+            # "LS7 1NJ" is in area "LS", district "LS7" and sector "LS7 1".
+            cursor.execute(
+                f"""
+                INSERT INTO {postcode_table}
+                    (postal_code, postal_area, postal_district, postal_sector)
+                SELECT postal_code, substring(district FROM '^[A-Z]*'), district,
+                       rtrim(district || ' ' || left(inward, 1))
+                FROM (
+                    SELECT postal_code, split_part(postal_code, ' ', 1) AS district,
+                           split_part(postal_code, ' ', 2) AS inward
+                    FROM pricepaid_new_postcodes
+                ) AS new_postcodes
+                ORDER BY 1
+                ON CONFLICT DO NOTHING
+                """
+            )
+        dictionary_conn.commit()
+    finally:
+        dictionary_conn.close()
+
 
 def copy_from_stringio(conn, df, table):
     """
     Here we are going save the dataframe in memory
-    and use copy_from() to copy it to the table
+    and use copy_expert() to copy it to the table.
+
+    Errors are raised and committing is left to the caller.
     """
     # save dataframe to an in memory buffer
     buffer = StringIO()
-    df.to_csv(buffer, index_label="id", header=False)
+    df.to_csv(buffer, index=False, header=False)
     buffer.seek(0)
 
-    cursor = conn.cursor()
+    with conn.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+    return len(df)
+
+
+def create_year_partitions(conn, table):
+    """
+    Creates the missing yearly partitions of the table up to this year, so
+    that new years do not end up in the default partition. Years detached
+    with `manage.py partitions detach` are left alone.
+    """
     try:
-        cursor.copy_from(buffer, table, sep=",")
+        with conn.cursor() as cursor:
+            for year in range(FIRST_YEAR, datetime.date.today().year + 1):
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table}_y{year} PARTITION OF {table} "
+                    f"FOR VALUES FROM (%s) TO (%s)",
+                    [datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)],
+                )
         conn.commit()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print("Error: %s" % error)
+    except psycopg2.Error as error:
         conn.rollback()
-        cursor.close()
-        return 1
-    cursor.close()
+        # e.g. rows of the year were inserted into the default partition.
+        raise IngestError(
+            (0, 0),
+            f"creating the partition of {year} failed, "
+            f"run `manage.py partitions create {year}`: {error}",
+        )
 
 
 def connect_postgres(params_dic):
@@ -84,28 +512,379 @@ def connect_postgres(params_dic):
     return conn
 
 
-def main(db_info, table_name, csv_file):
-    conn = connect_postgres(db_info)
-    for chunk in tqdm(
-        pd.read_csv(
+class IngestAborted(Exception):
+    """Raised in a worker to stop copying once another worker has failed."""
+
+
+def load_range(
+    db_info,
+    table_name,
+    postcode_table,
+    csv_file,
+    byte_range,
+    copy_format,
+    events,
+    decision,
+    abort,
+    load_table,
+    two_phase,
+):
+    """
+    Worker process: copies its byte range into its own load table, interns
+    its postcodes and inserts the rows into the table in a single
+    transaction, which it prepares for a two-phase commit (PREPARE
+    TRANSACTION, with the load table name as global id) if two_phase.
+    Reports ("prepared", rows) or ("failed", error), then commits or rolls
+    back as the coordinator decides, so that either every range is loaded
+    or none, and reports ("committed", rows). Stops early with ("aborted",
+    rows) once another worker has failed.
+    """
+    index = multiprocessing.current_process().name
+    try:
+        conn = psycopg2.connect(**db_info)
+    except Exception as error:
+        events.put((index, "failed", f"{type(error).__name__}: {error}"))
+        return
+
+    copied = 0
+
+    def on_rows(count):
+        nonlocal copied
+        if abort.is_set():
+            raise IngestAborted()
+        copied += count
+        events.put((index, "progress", count))
+
+    def rollback():
+        conn.tpc_rollback() if two_phase else conn.rollback()
+
+    try:
+        if two_phase:
+            conn.tpc_begin(load_table)
+        with conn.cursor() as cursor:
+            # Not a temporary table, which prepared transactions cannot use.
+            cursor.execute(f"CREATE UNLOGGED TABLE {load_table} ({LOAD_TABLE_COLUMNS})")
+        copy_rows(
+            conn,
+            load_table,
             csv_file,
-            names=PP_DATA_COLUMN_NAMES,
-            usecols=["Postcode", "Property Type", "Price", "Date of Transfer"],
-            chunksize=CHUNK_SIZE,
+            *byte_range,
+            copy_format=copy_format,
+            on_rows=on_rows,
+        )
+        intern_postcodes(conn, db_info, postcode_table, load_table)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table_name} ({", ".join(TABLE_COLUMNS)})
+                SELECT l.transaction_id, d.id, l.property_type, l.price,
+                       l.transfer_date
+                FROM {load_table} AS l
+                JOIN {postcode_table} AS d ON d.postal_code = l.postal_code
+                """
+            )
+            rows = cursor.rowcount
+        if two_phase:
+            # Survives this process and its connection from now on.
+            conn.tpc_prepare()
+        events.put((index, "prepared", rows))
+    except IngestAborted:
+        rollback()
+        conn.close()
+        events.put((index, "aborted", copied))
+        return
+    except Exception as error:
+        rollback()
+        conn.close()
+        events.put((index, "failed", f"{type(error).__name__}: {error}"))
+        return
+
+    try:
+        if decision.recv() == "commit":
+            conn.tpc_commit() if two_phase else conn.commit()
+            events.put((index, "committed", rows))
+        else:
+            rollback()
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {load_table}")
+        conn.commit()
+    except Exception as error:
+        events.put((index, "failed", f"{type(error).__name__}: {error}"))
+    finally:
+        conn.close()
+
+
+def finish_prepared(db_info, load_tables, outcome):
+    """
+    Commits or rolls back the load transactions still prepared, i.e. of the
+    workers which died or lost their connection after preparing, and drops
+    the load tables left behind. Returns the load tables whose transaction
+    it finished.
+    """
+    conn = connect_postgres(db_info)
+    conn.autocommit = True
+    finished = []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT gid FROM pg_prepared_xacts WHERE gid = ANY(%s)", [load_tables]
+            )
+            for (gid,) in cursor.fetchall():
+                command = "COMMIT" if outcome == "commit" else "ROLLBACK"
+                cursor.execute(f"{command} PREPARED %s", [gid])
+                finished.append(gid)
+            for load_table in load_tables:
+                cursor.execute(f"DROP TABLE IF EXISTS {load_table}")
+    finally:
+        conn.close()
+    return finished
+
+
+def _wait(events, workers):
+    """Gets the next worker event, failing the workers that died silently."""
+    while True:
+        try:
+            return events.get(timeout=1)
+        except queue.Empty:
+            for name, (process, _) in workers.items():
+                if not process.is_alive() and process.exitcode != 0:
+                    return name, "failed", f"exit code {process.exitcode}"
+
+
+def main(
+    db_info,
+    table_name,
+    csv_file,
+    workers=1,
+    copy_format="csv",
+    postcode_table="pricepaid_postcode",
+):
+    """
+    Loads the file with `workers` processes, each copying a line aligned
+    byte range over its own connection in the given COPY_FORMATS format.
+
+    With several workers their transactions are committed in two phases,
+    which needs max_prepared_transactions >= workers on the server: all are
+    prepared before any is committed, and those a worker fails to commit
+    afterwards are committed by the coordinator, so that the load is all or
+    nothing. Raises IngestError (and loads nothing) if any range fails. New
+    postcodes may still have been added to the postcode table.
+    """
+    conn = connect_postgres(db_info)
+    try:
+        create_year_partitions(conn, table_name)
+    finally:
+        conn.close()
+
+    ranges = line_aligned_ranges(csv_file, workers)
+    two_phase = len(ranges) > 1
+    context = multiprocessing.get_context("spawn")
+    events, abort = context.Queue(), context.Event()
+
+    processes, load_tables = {}, {}
+    for index, byte_range in enumerate(ranges):
+        decision, worker_decision = context.Pipe()
+        name = str(index)
+        load_tables[name] = f"pricepaid_load_{os.getpid()}_{index}"
+        process = context.Process(
+            target=load_range,
+            name=name,
+            args=(
+                db_info,
+                table_name,
+                postcode_table,
+                csv_file,
+                byte_range,
+                copy_format,
+                events,
+                worker_decision,
+                abort,
+                load_tables[name],
+                two_phase,
+            ),
         )
-    ):
-        chunk.rename(
-            columns={
-                "Date of Transfer": "transfer_date",
-                "Property Type": "property_type",
-                "Postcode": "postal_code",
-                "Price": "price",
-            },
-            inplace=True,
+        process.start()
+        processes[name] = (process, decision)
+
+    print(f"Loading {csv_file} with {len(processes)} worker(s)...")
+    started = time.perf_counter()
+    pending, errors, prepared = set(processes), {}, {}
+    with tqdm(unit="rows", unit_scale=True) as progress:
+        while pending:
+            name, event, value = _wait(events, processes)
+            if event == "progress":
+                progress.update(value)
+            elif event == "prepared":
+                pending.discard(name)
+                prepared[name] = value
+            elif event == "aborted":
+                pending.discard(name)
+            elif event == "failed":
+                pending.discard(name)
+                errors[name] = value
+                abort.set()
+
+    outcome = "rollback" if errors else "commit"
+    for name in prepared:
+        processes[name][1].send(outcome)
+
+    committed, commit_errors = 0, {}
+    if outcome == "commit":
+        waiting = set(prepared)
+        while waiting:
+            name, event, value = _wait(events, processes)
+            waiting.discard(name)
+            if event == "committed":
+                committed += value
+            elif event == "failed":
+                commit_errors[name] = value
+
+    for process, _ in processes.values():
+        process.join()
+
+    names = {load_table: name for name, load_table in load_tables.items()}
+    for load_table in finish_prepared(db_info, list(names), outcome):
+        if outcome == "commit":
+            committed += prepared[names[load_table]]
+            commit_errors.pop(names[load_table], None)
+    errors.update(commit_errors)
+
+    if errors:
+        first = min(errors, key=int)
+        raise IngestError(
+            ranges[int(first)],
+            f"{len(errors)} of {len(ranges)} worker(s) failed, "
+            f"{committed} rows committed, first error: {errors[first]}",
         )
-        chunk = chunk[chunk["postal_code"].notna()]
-        chunk = chunk[["postal_code", "property_type", "price", "transfer_date"]]
-        copy_from_stringio(conn, chunk, table_name)
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Loaded {committed} rows in {elapsed:.1f}s "
+        f"({committed / elapsed:.0f} rows/sec, {len(ranges)} worker(s))"
+    )
+    return committed
+
+
+def apply_update(
+    db_info,
+    table_name,
+    affected_table,
+    csv_file,
+    copy_format="csv",
+    postcode_table="pricepaid_postcode",
+):
+    """
+    Applies a monthly update file in one transaction: the rows are COPYed
+    into a staging table, the latest record of each transaction is merged
+    into the table (D deletes, A and C replace the rows of the transaction)
+    and the changed postcode-months are recorded in affected_table for
+    `manage.py build_rollups --affected`.
+    """
+    conn = connect_postgres(db_info)
+    started = time.perf_counter()
+    try:
+        create_year_partitions(conn, table_name)
+    except IngestError:
+        conn.close()
+        raise
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TEMP TABLE pricepaid_staging (
+                    seq bigserial,
+                    transaction_id uuid NOT NULL,
+                    postal_code varchar(50),
+                    property_type smallint,
+                    price integer,
+                    transfer_date date,
+                    record_status char(1) NOT NULL
+                ) ON COMMIT DROP
+                """
+            )
+        with tqdm(unit="rows", unit_scale=True) as progress:
+            staged = copy_rows(
+                conn,
+                "pricepaid_staging",
+                csv_file,
+                update=True,
+                copy_format=copy_format,
+                on_rows=progress.update,
+            )
+
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                CREATE TEMP TABLE pricepaid_latest ON COMMIT DROP AS
+                SELECT DISTINCT ON (transaction_id) *
+                FROM pricepaid_staging
+                ORDER BY transaction_id, seq DESC
+                """
+            )
+        intern_postcodes(conn, db_info, postcode_table, "pricepaid_latest")
+
+        with conn.cursor() as cursor:
+            # Postcode-months of the replaced rows and of the new versions.
+            cursor.execute(
+                f"""
+                INSERT INTO {affected_table} (postal_code, year, month)
+                SELECT d.postal_code,
+                       EXTRACT(YEAR FROM t.transfer_date),
+                       EXTRACT(MONTH FROM t.transfer_date)
+                FROM {table_name} AS t
+                JOIN pricepaid_latest AS l ON t.transaction_id = l.transaction_id
+                JOIN {postcode_table} AS d ON d.id = t.postcode_id
+                UNION
+                SELECT postal_code,
+                       EXTRACT(YEAR FROM transfer_date),
+                       EXTRACT(MONTH FROM transfer_date)
+                FROM pricepaid_latest
+                WHERE record_status <> 'D' AND postal_code IS NOT NULL
+                ON CONFLICT DO NOTHING
+                """
+            )
+            affected = cursor.rowcount
+            cursor.execute(
+                f"""
+                DELETE FROM {table_name} AS t
+                USING pricepaid_latest AS l
+                WHERE t.transaction_id = l.transaction_id
+                  AND (l.record_status = 'D' OR l.postal_code IS NULL)
+                """
+            )
+            deleted = cursor.rowcount
+            # Changed rows are replaced: transaction ids are not unique in
+            # the partitioned table, so there is nothing to upsert on.
+            cursor.execute(
+                f"""
+                DELETE FROM {table_name} AS t
+                USING pricepaid_latest AS l
+                WHERE t.transaction_id = l.transaction_id
+                """
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO {table_name} ({", ".join(TABLE_COLUMNS)})
+                SELECT l.transaction_id, d.id, l.property_type, l.price,
+                       l.transfer_date
+                FROM pricepaid_latest AS l
+                JOIN {postcode_table} AS d ON d.postal_code = l.postal_code
+                WHERE l.record_status <> 'D'
+                """
+            )
+            upserted = cursor.rowcount
+        conn.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        conn.rollback()
+        raise IngestError((0, os.path.getsize(csv_file)), str(error))
+    finally:
+        conn.close()
+
+    print(
+        f"Applied {staged} update records in {time.perf_counter() - started:.1f}s: "
+        f"{upserted} rows added or changed, {deleted} deleted, "
+        f"{affected} new postcode-months to refresh"
+    )
 
 
 if __name__ == "__main__":
@@ -118,8 +897,32 @@ if __name__ == "__main__":
         "password": args["--db-pass"],
     }
 
+    assert (
+        args["--copy-format"] in COPY_FORMATS
+    ), f"Copy format must be one of {', '.join(COPY_FORMATS)}!"
     assert os.path.exists(
         args["--price-paid-data"]
     ), f"Price paid file {args['--price-paid-data']} does not exist!"
 
-    main(db_info, args["--db-table-name"], args["--price-paid-data"])
+    try:
+        if args["--update"]:
+            apply_update(
+                db_info,
+                args["--db-table-name"],
+                args["--affected-table"],
+                args["--price-paid-data"],
+                copy_format=args["--copy-format"],
+                postcode_table=args["--postcode-table"],
+            )
+        else:
+            main(
+                db_info,
+                args["--db-table-name"],
+                args["--price-paid-data"],
+                workers=int(args["--workers"]),
+                copy_format=args["--copy-format"],
+                postcode_table=args["--postcode-table"],
+            )
+    except IngestError as error:
+        print("Error: %s" % error)
+        sys.exit(1)